@@ -1,20 +1,149 @@
 #!/usr/bin/python3
 from sys import argv, stderr
-from time import sleep
-from os import path, remove, rmdir
-
-import mysql.connector
+from time import sleep, monotonic
+from os import scandir, remove, rmdir
+from threading import Lock
 
 from common import is_help_request, \
         get_db_connection, \
-        assert_ok_dbname
+        close_game_connections, \
+        assert_ok_dbname, \
+        _load_config
 from stop import _main as stop
 
 usage = """Usage: ovo cleanup <id: string>
 
 Removes all the information about the game with the given id, including uploaded files
+
+The files are removed by `workers` threads of the `[cleanup]` section of /etc/ovo.conf (16 by
+default). The database sessions still using the game database are killed, the database is
+dropped in `timeout` seconds (60 by default) or the command fails
 """
 
+PROGRESS_INTERVAL = 0.5 # seconds
+DROP_LOCK_WAIT = 5 # seconds, one attempt to drop the database
+
+def _scan(folder:str) -> tuple:
+    """Lists the game files folder: the files stored by ids, the blobs (see
+        `owo.blob_path`) and the unfinished uploads
+    Parameters:
+        folder(str): The game files folder
+    Returns:
+        tuple: (files paths, folders paths), the nested folders go first
+    """
+    files, folders = [], []
+    with scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                nested_files, nested_folders = _scan(entry.path)
+                files += nested_files
+                folders += nested_folders
+            else:
+                files.append(entry.path)
+    folders.append(folder)
+    return (files, folders)
+
+def _remove_file(file_path:str) -> str:
+    """Removes the file
+    Returns:
+        str or NoneType: None if removed, 'missing' if it doesn't exist,
+            the warning otherwise
+    """
+    try:
+        remove(file_path)
+    except FileNotFoundError:
+        return 'missing'
+    except PermissionError:
+        return "Important warning: couldn't delete a file, because of permissions"
+    except OSError as e:
+        return "Important warning: couldn't delete a file, because of OSError ({})".format(e)
+    except Exception as e:
+        return "Important warning: couldn't delete a file, because of unknown error ({})".format(e)
+
+def _remove_files(files:list, workers:int) -> tuple:
+    """Removes the files in parallel, printing the progress
+    Parameters:
+        files(list[str]): The files paths
+        workers(int): Number of the threads removing the files
+    Returns:
+        tuple: (removed, missing, failed) numbers of files
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    counts = {'removed': 0, 'missing': 0, 'failed': 0}
+    lock = Lock()
+    last_print = [monotonic()]
+    progress_shown = [False]
+
+    def job(file_path):
+        warning = _remove_file(file_path)
+        with lock:
+            if warning is None:
+                counts['removed'] += 1
+            elif warning == 'missing':
+                counts['missing'] += 1
+            else:
+                counts['failed'] += 1
+                print("{} {}".format(warning, file_path), file=stderr)
+            if monotonic() - last_print[0] >= PROGRESS_INTERVAL:
+                last_print[0] = monotonic()
+                progress_shown[0] = True
+                print("Removing the files: {} of {}".format(sum(counts.values()), len(files)),
+                        file=stderr, end='\r')
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(job, files):
+            pass
+    if progress_shown[0]: # Ends the progress line, so the summary doesn't overwrite it
+        print("Removing the files: {} of {}".format(len(files), len(files)), file=stderr)
+    return (counts['removed'], counts['missing'], counts['failed'])
+
+def _kill_sessions(c, db_name:str) -> int:
+    """Kills the sessions (except the current one) using the database, i. e. the
+        pooled connections of the web server or of the OvO daemon left behind
+    Parameters:
+        c: mysql cursor
+        db_name(str): The database name
+    Returns:
+        int: Number of the killed sessions
+    """
+    c.execute('SELECT ID FROM information_schema.PROCESSLIST WHERE DB=(%s) AND ID <> CONNECTION_ID()',
+            (db_name,))
+    ans = 0
+    for session_id, in c.fetchall():
+        try:
+            c.execute('KILL {:d}'.format(session_id))
+            ans += 1
+        except Exception as e:
+            if getattr(e, 'errno', None) != 1094: # Unknown thread id, it has just gone
+                raise e
+    return ans
+
+def _drop_database(c, db_name:str, timeout:float) -> int:
+    """Drops the database, killing the sessions holding its locks
+    Parameters:
+        c: mysql cursor
+        db_name(str): The database name
+        timeout(float): Number of seconds to give up after
+    Returns:
+        int: Number of the killed sessions
+
+    Raises TimeoutError if the database couldn't be dropped in time
+    """
+    deadline = monotonic() + timeout
+    c.execute('SET SESSION lock_wait_timeout = {:d}'.format(DROP_LOCK_WAIT))
+    killed = 0
+    while True:
+        killed += _kill_sessions(c, db_name)
+        try:
+            c.execute('DROP DATABASE ' + db_name)
+            return killed
+        except Exception as e:
+            if getattr(e, 'errno', None) != 1205: # Lock wait timeout exceeded
+                raise e
+        if monotonic() >= deadline:
+            raise TimeoutError("Couldn't drop the database {} in {} seconds".format(db_name, timeout))
+        print("The database {} is still in use, retrying".format(db_name), file=stderr)
+
 def _main(game_id:str, timer:int=0):
     """Removes all the game info, including uploaded files
     Parameters:
@@ -22,6 +151,7 @@ def _main(game_id:str, timer:int=0):
         timer(int, optional): if specified, the user will be given `timer` seconds to interrupt
     """
     assert_ok_dbname(game_id)
+    config = _load_config()
     db = get_db_connection()
     c = db.cursor()
     c.execute('USE OvO_' + game_id)
@@ -40,31 +170,28 @@ identificator. You have {} seconds left to interrupt (Ctrl+C)".format(
 
     c.execute('SELECT files_folder FROM game_info')
     folder, = c.fetchone()
-    c.execute('SELECT id FROM files')
-    for filename in ['exit'] + list(map(lambda x: x[0], c.fetchall())):
-        try:
-            remove(path.join(folder, filename))
-        except FileNotFoundError:
-            print("Important warning: couldn't delete a file, because it doesn't exist", file=stderr)
-        except PermissionError:
-            print("Important warning: couldn't delete a file, because of permissions", file=stderr)
-        except OSError as e:
-            print("Important warning: couldn't delete a file, because of OSError ({})".format(e), file=stderr)
-        except Exception as e:
-            print("Important warning: couldn't delete a file, because of unknown error ({})".format(e), file=stderr)
+    removed = missing = failed = 0
     try:
-        rmdir(folder)
+        files, folders = _scan(folder)
     except FileNotFoundError:
         print("VERY important warning: directory for containing this game files doesn't exist", file=stderr)
-    except PermissionError:
-        print("Important warning: couldn't delete the folder, because of permissions", file=stderr)
-    except OSError as e:
-        print("Important warning: couldn't delete the folder, because of OSError ({})".format(e), file=stderr)
-    except Exception as e:
-        print("Important warning: couldn't delete the folder, because of unknown error ({})".format(e), file=stderr)
-    
-    c.execute('DROP DATABASE OvO_' + game_id) # The program freezes here until the database is freed
+    else:
+        removed, missing, failed = _remove_files(files, config.getint('cleanup', 'workers', fallback=16))
+        for directory in folders:
+            try:
+                rmdir(directory)
+            except PermissionError:
+                print("Important warning: couldn't delete the folder, because of permissions", file=stderr)
+            except OSError as e:
+                print("Important warning: couldn't delete the folder, because of OSError ({})".format(e), file=stderr)
+            except Exception as e:
+                print("Important warning: couldn't delete the folder, because of unknown error ({})".format(e), file=stderr)
+
+    close_game_connections(game_id)
+    killed = _drop_database(c, 'OvO_' + game_id, config.getint('cleanup', 'timeout', fallback=60))
     db.commit()
+    print("Removed {} files ({} were already missing, {} couldn't be removed), killed {} database \
+sessions, dropped the database OvO_{}".format(removed, missing, failed, killed, game_id), file=stderr)
 
 def main(args, timer=0):
     if is_help_request(args):
@@ -1,7 +1,17 @@
 from sys import stderr
+from os import cpu_count, register_at_fork
+from time import monotonic, time_ns
+from string import hexdigits
+from threading import Condition, Lock, BoundedSemaphore
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
 
 from configparser import ConfigParser
-import mysql.connector
+
+# mysql.connector, bcrypt, secrets and concurrent.futures take long to import, so they
+# are imported on the first use. Keep `ovo --startup-profile` output in mind
+# when adding module level imports here
 
 def is_help_request(l:list) -> bool:
     """Function for checking if the given arguments list (i. e. argv) is a help request
@@ -12,31 +22,500 @@ def is_help_request(l:list) -> bool:
     """
     return (len(l) == 2) and (l[1] in ['-h', '--help'])
 
+@lru_cache(maxsize=None)
+def _load_config() -> ConfigParser:
+    """Reads the conf file. The file is only read once per process
+    Returns:
+        ConfigParser: The parsed conf file
+    """
+    config = ConfigParser()
+    config.read('/etc/ovo.conf')
+    return config
+
 def _load_mysql_auth_data() -> tuple:
     """Extracts mysql username and password from the conf file
     Returns:
         tuple: (username, password)
     """
-    config = ConfigParser()
-    config.read('/etc/ovo.conf')
+    config = _load_config()
     return (config['mysql']['username'],
             config['mysql']['password'])
 
-def get_db_connection(autocommit=False):
+def get_db_connection(autocommit=False, database:str=None):
+    """Opens a new (not pooled) connection to mysql
+    Parameters:
+        autocommit(bool, optional): The autocommit mode of the connection
+        database(str, optional): The database the connection is bound to
+    Returns:
+        mysql.connector.MySQLConnection: The new connection
+    """
+    import mysql.connector
     mysql_username, mysql_password = _load_mysql_auth_data()
+    kwargs = {} if database is None else {'database': database}
     db = mysql.connector.connect(
             host='localhost',
             user=mysql_username,
-            passwd=mysql_password
+            passwd=mysql_password,
+            **kwargs
             )
     db.autocommit = autocommit
     return db
 
+class _ConnectionPool:
+    """A thread-safe pool of mysql connections. Every connection
+        is bound to the database of one game, so the pool is keyed
+        by the game identifier. The games served by one process (see
+        `main.GameDispatcher` of the web server) share the pool: when
+        `total` connections are open, an idle connection of another
+        game is rebound to the game that needs one
+    Parameters:
+        size(int): Max number of connections per game
+        recycle(float): Idle connections older than `recycle` seconds are reopened
+        ping_after(float): Idle connections older than `ping_after` seconds are
+            health-checked before being given out
+        timeout(float): Max number of seconds to wait for a free connection
+        total(int, optional): Max number of connections for all the games,
+            not limited by default
+    """
+    def __init__(self, size:int, recycle:float, ping_after:float, timeout:float, total:int=None):
+        self.size = size
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self.timeout = timeout
+        self.total = total
+        self._idle = {} # game_id -> list of (connection, last release time)
+        self._given = {} # game_id -> number of connections given out or being opened
+        self._open = 0 # Number of connections open or being opened
+        self._cond = Condition()
+
+    def acquire(self, game_id:str):
+        """Gives a connection bound to the game database. Waits for
+            a free one if there are already `size` connections for the game
+            or `total` connections busy
+        Parameters:
+            game_id(str): The game identifier
+        Returns:
+            mysql.connector.MySQLConnection: The connection
+
+        Raises TimeoutError if no connection got free in `timeout` seconds
+        """
+        deadline = monotonic() + self.timeout
+        rebind = False
+        with self._cond:
+            while True:
+                idle = self._idle.setdefault(game_id, [])
+                given = self._given.get(game_id, 0)
+                if idle:
+                    db, released_at = idle.pop()
+                    break
+                if given < self.size:
+                    if self.total is None or self._open < self.total:
+                        db, released_at = (None, None)
+                        self._open += 1
+                        break
+                    stolen = self._take_oldest_idle()
+                    if stolen is not None:
+                        db, released_at = stolen
+                        rebind = True
+                        break
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("No free database connection for the game {}".format(game_id))
+                self._cond.wait(remaining)
+            self._given[game_id] = given + 1
+
+        try:
+            if db is not None:
+                idle_for = monotonic() - released_at
+                if idle_for > self.recycle:
+                    self._close_quietly(db)
+                    db = None
+                elif idle_for > self.ping_after:
+                    db.ping(reconnect=True, attempts=1)
+                    rebind = True # A reconnected connection is bound to the database it was opened with
+            if db is None:
+                db = get_db_connection(database='OvO_' + game_id)
+            elif rebind:
+                db.database = 'OvO_' + game_id
+        except BaseException:
+            self._forget(game_id)
+            raise
+        return db
+
+    def _take_oldest_idle(self) -> tuple:
+        """Takes the longest idle connection of any game. Call with `_cond` held
+        Returns:
+            tuple or NoneType: (connection, last release time), None if all are busy
+        """
+        oldest = None
+        for idle in self._idle.values():
+            if idle and (oldest is None or idle[0][1] < oldest[0][1]):
+                oldest = idle
+        return None if oldest is None else oldest.pop(0)
+
+    def release(self, game_id:str, db):
+        """Returns the connection to the pool. The current transaction
+            (if any) is rolled back, so the connection doesn't hold
+            any locks while idle
+        Parameters:
+            game_id(str): The game identifier
+            db: The connection got from `acquire`
+        """
+        try:
+            db.rollback()
+        except Exception:
+            self._close_quietly(db)
+            self._forget(game_id)
+            return
+        with self._cond:
+            self._given[game_id] -= 1
+            self._idle.setdefault(game_id, []).append((db, monotonic()))
+            self._cond.notify_all() # The waiters of any game may take it
+
+    def close(self, game_id:str):
+        """Closes all the idle connections to the game database
+        Parameters:
+            game_id(str): The game identifier
+        """
+        with self._cond:
+            idle = self._idle.pop(game_id, [])
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for db, _ in idle:
+            self._close_quietly(db)
+
+    def _forget(self, game_id:str):
+        """Forgets a connection given out, which is closed or was never opened"""
+        with self._cond:
+            self._given[game_id] -= 1
+            self._open -= 1
+            self._cond.notify_all()
+
+    @staticmethod
+    def _close_quietly(db):
+        try:
+            db.close()
+        except Exception:
+            pass
+
+_pool = None
+
+def _get_pool() -> _ConnectionPool:
+    """Creates the process-wide connection pool on the first call
+    Returns:
+        _ConnectionPool: The pool
+    """
+    global _pool
+    if _pool is None:
+        config = _load_config()
+        _pool = _ConnectionPool(
+                size=config.getint('pool', 'size', fallback=8),
+                recycle=config.getfloat('pool', 'recycle', fallback=3600),
+                ping_after=config.getfloat('pool', 'ping_after', fallback=30),
+                timeout=config.getfloat('pool', 'timeout', fallback=10),
+                total=config.getint('pool', 'total', fallback=None)
+                )
+    return _pool
+
+@contextmanager
+def game_db_connection(game_id:str):
+    """A context manager giving a pooled connection to the game database.
+        The connection is returned to the pool when the block is left,
+        uncommitted changes are rolled back
+    Parameters:
+        game_id(str): The game identifier
+    Returns:
+        mysql.connector.MySQLConnection: The connection (as the `with` target)
+
+    Example:
+        with game_db_connection(game_id) as db:
+            c = db.cursor()
+            c.execute('SELECT name FROM tasks')
+    """
+    assert_ok_dbname(game_id)
+    pool = _get_pool()
+    db = pool.acquire(game_id)
+    try:
+        yield db
+    finally:
+        pool.release(game_id, db)
+
+def close_game_connections(game_id:str):
+    """Closes all the idle pooled connections to the game database
+    Parameters:
+        game_id(str): The game identifier
+    """
+    if _pool is not None:
+        _pool.close(game_id)
+
+class TTLCache:
+    """A thread-safe cache of a bounded size. Entries expire `ttl` seconds
+        after being put, the least recently used ones are evicted first
+    Parameters:
+        size(int): Max number of entries
+        ttl(float): Entries lifetime in seconds
+    """
+    def __init__(self, size:int, ttl:float):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (expiration time, value)
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] < monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Removes the entry and returns its value, `default` if there is no
+            such entry or it has expired
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < monotonic():
+                return default
+            return entry[1]
+
+    def discard_if(self, predicate):
+        """Removes the entries for which `predicate(key, value)` is true
+        Parameters:
+            predicate(callable): The entries filter
+        """
+        with self._lock:
+            for key in [k for k, (_, v) in self._data.items() if predicate(k, v)]:
+                del self._data[key]
+
+_principals_cache = None
+
+def get_principals_cache() -> TTLCache:
+    """Returns the process-wide cache of session principals. The cache
+        maps (game_id, session_id) to {'login': str, 'is_captain': bool}
+    Returns:
+        TTLCache: The cache
+    """
+    global _principals_cache
+    if _principals_cache is None:
+        config = _load_config()
+        _principals_cache = TTLCache(
+                size=config.getint('cache', 'principals_size', fallback=1024),
+                ttl=config.getfloat('cache', 'principals_ttl', fallback=30)
+                )
+    return _principals_cache
+
+def forget_principal(game_id:str, login:str=None):
+    """Drops the cached principals of the user, so their sessions are
+        looked up again on the next request. Only the cache of the calling
+        process is cleared, the web processes drop the principals themselves
+        when they see the user's events
+    Parameters:
+        game_id(str): The game identifier
+        login(str, optional): The user identifier. The logins are compared
+            case-insensitively, like the database does. If not specified,
+            all the principals of the game are dropped
+    """
+    if _principals_cache is not None:
+        _principals_cache.discard_if(lambda k, v: k[0] == game_id and
+                (login is None or v['login'].lower() == login.lower()))
+
+def generate_id() -> str:
+    """Generates a time-ordered 128-bit id for an entity (the UUIDv7 layout:
+        48 bits of unix time in milliseconds followed by random bits), so new
+        rows are appended to the end of the primary key index
+    Returns:
+        str: The id as 32 hex digits
+    """
+    millis = (time_ns() // 1000000) & ((1 << 48) - 1)
+    import secrets
+    rand = secrets.randbits(74)
+    return '{:032x}'.format(
+            (millis << 80) | (0x7 << 76) | ((rand >> 62) << 64) | (0b10 << 62) | (rand & ((1 << 62) - 1))
+            )
+
+def generate_session_id() -> str:
+    """Generates an unpredictable 128-bit session id
+    Returns:
+        str: The session id as 32 hex digits
+    """
+    import secrets
+    return secrets.token_hex(16)
+
+def id_to_db(entity_id:str) -> bytes:
+    """Converts an id (got from `generate_id` or `generate_session_id`)
+        to the BINARY(16) value stored in the database
+    Parameters:
+        entity_id(str): The id
+    Returns:
+        bytes: The database value
+
+    Raises ValueError if the id is malformed
+    """
+    if type(entity_id) is not str or len(entity_id) != 32 or \
+            not all(map(lambda x: x in hexdigits, entity_id)):
+        raise ValueError("Malformed identifier")
+    return bytes.fromhex(entity_id)
+
+def id_from_db(value) -> str:
+    """Antonym for id_to_db
+    Parameters:
+        value(bytes or NoneType): The database value
+    Returns:
+        str or NoneType: The id, None if the value is None
+    """
+    return None if value is None else bytes(value).hex()
+
+def sha256_to_db(digest:str) -> bytes:
+    """Converts a sha256 hex digest to the BINARY(32) value stored in the database
+    Parameters:
+        digest(str): The hex digest
+    Returns:
+        bytes: The database value
+
+    Raises ValueError if the digest is malformed
+    """
+    if type(digest) is not str or len(digest) != 64 or \
+            not all(map(lambda x: x in hexdigits, digest)):
+        raise ValueError("Malformed sha256")
+    return bytes.fromhex(digest)
+
+FILE_READ_SIZE = 1 << 16
+
+def file_sha256(file_path:str) -> str:
+    """Returns the sha256 hex digest of the file content, reading it by parts"""
+    import hashlib
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for data in iter(lambda: f.read(FILE_READ_SIZE), b''):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+DEFAULT_BCRYPT_ROUNDS = 12
+
+class PasswordQueueFull(Exception):
+    """Raised when there are too many password hashing jobs waiting
+        for a worker, so the caller should retry later
+    """
+    pass
+
+_hashing_pool = None
+_hashing_slots = None
+
+def _get_hashing_pool():
+    """Creates the process-wide bcrypt workers pool on the first call
+    Returns:
+        ThreadPoolExecutor: The pool
+    """
+    global _hashing_pool, _hashing_slots
+    if _hashing_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        config = _load_config()
+        _hashing_slots = BoundedSemaphore(config.getint('bcrypt', 'queue', fallback=32))
+        _hashing_pool = ThreadPoolExecutor(
+                max_workers=config.getint('bcrypt', 'workers', fallback=cpu_count() or 1),
+                thread_name_prefix='bcrypt'
+                )
+    return _hashing_pool
+
+def _run_hashing_job(job):
+    """Runs the job in the bcrypt workers pool and waits for the result.
+        bcrypt releases the GIL, so the workers use all the cores while
+        the calling thread only waits
+    Parameters:
+        job(callable): The job, called with no arguments
+    Returns:
+        The job result
+
+    Raises PasswordQueueFull if the queue of the pool is full
+    """
+    pool = _get_hashing_pool()
+    if not _hashing_slots.acquire(blocking=False):
+        raise PasswordQueueFull("Too many passwords are being hashed, try again later")
+    try:
+        future = pool.submit(job)
+    except BaseException:
+        _hashing_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hashing_slots.release())
+    return future.result()
+
+def _bcrypt_hash(password:str, rounds:int) -> str:
+    import bcrypt
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _bcrypt_check(password:str, hashed:str) -> bool:
+    import bcrypt
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+def hash_password(password:str, rounds:int=DEFAULT_BCRYPT_ROUNDS) -> str:
+    """Hashes the password with bcrypt in the workers pool
+    Parameters:
+        password(str): The password
+        rounds(int, optional): The bcrypt cost
+    Returns:
+        str: The hash
+
+    Raises PasswordQueueFull if there are too many passwords being hashed
+    """
+    return _run_hashing_job(lambda: _bcrypt_hash(password, rounds))
+
+def hash_passwords(passwords:list, rounds:int=DEFAULT_BCRYPT_ROUNDS) -> list:
+    """Hashes many passwords at once, using all the bcrypt workers. Unlike
+        `hash_password`, isn't limited by the queue size, so it's meant for
+        administrative bulk operations, not for request handlers
+    Parameters:
+        passwords(list[str]): The passwords
+        rounds(int, optional): The bcrypt cost
+    Returns:
+        list[str]: The hashes in the same order
+    """
+    return list(_get_hashing_pool().map(
+            lambda password: _bcrypt_hash(password, rounds),
+            passwords
+            ))
+
+def check_password(password:str, hashed:str) -> bool:
+    """Checks the password against the bcrypt hash in the workers pool
+    Parameters:
+        password(str): The password
+        hashed(str): The hash
+    Returns:
+        bool: True, if the password is correct, otherwise False
+
+    Raises PasswordQueueFull if there are too many passwords being checked
+    """
+    return _run_hashing_job(lambda: _bcrypt_check(password, hashed))
+
+_inherited = [] # The state of the parent process, see `_forget_inherited_state`
+
+def _forget_inherited_state():
+    """Makes a forked child (i. e. a web server worker) open its own connections,
+        caches and workers on the first use. The inherited connections share
+        sockets with the parent, so they must never be used or closed by the
+        child. They are kept referenced not to be closed by the garbage collector
+    """
+    global _pool, _principals_cache, _hashing_pool, _hashing_slots
+    _inherited.append(_pool)
+    _pool = _principals_cache = _hashing_pool = _hashing_slots = None
+
+register_at_fork(after_in_child=_forget_inherited_state)
+
 def assert_ok_dbname(dbname:str):
     """Function for checking if dbname is an ok name for db
     Parameters:
         dbname(str): The name to be checked
-    
+
     Raises ValueError if dbname is not a correct name for db
     """
     if(not all(map(lambda x: x.isalpha() or x.isdigit() or x == '_', dbname))):
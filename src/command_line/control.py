@@ -0,0 +1,285 @@
+import socket
+from sys import stderr
+from os import path, remove, replace, umask, register_at_fork
+from time import monotonic, sleep
+from tempfile import gettempdir
+from threading import Thread, Condition
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+
+from common import _load_config
+
+# The control channel of a game web server: a Unix socket served by the main
+# process of the server (the gunicorn master or the uvicorn supervisor). The
+# server goes through the states `starting` -> `ready` -> `draining` -> `stopped`,
+# `ovo run` and `ovo stop` wait for the transitions on the socket.
+#
+# The commands are lines, every answer is a state line:
+#     status       The current state
+#     wait_ready   Waits until the server isn't starting anymore
+#     ready        Tells that a worker is ready (sent by the uvicorn workers)
+#     stop         Starts draining, answers `draining` and then `stopped`
+#
+# The host web server (`web/main.py --host`) serves the games with the `hosted`
+# engine under /g/<game id>/. It has a control socket of its own, the games are
+# registered with it in a file next to the sockets (see `register_game`).
+
+STATES = ['starting', 'ready', 'draining', 'stopped']
+
+def _control_dir() -> str:
+    return _load_config().get('control', 'dir', fallback=gettempdir())
+
+def socket_path(game_id:str=None) -> str:
+    """Returns the control socket path of the game, of the host web server if
+        the game isn't given. The folder is taken from the `dir` option of the
+        `[control]` section of /etc/ovo.conf
+    """
+    if game_id is None:
+        return path.join(_control_dir(), 'ovo-host.sock')
+    return path.join(_control_dir(), 'ovo-game-{}.sock'.format(game_id))
+
+def _timeout() -> float:
+    return _load_config().getfloat('control', 'timeout', fallback=60)
+
+class ControlServer:
+    """The control socket of the game web server, served by a thread
+    Parameters:
+        game_id(str or NoneType): The game identifier, None for the host web server
+        on_stop(function): Called once when the `stop` command is got. It must
+            start the graceful shutdown, after which `stopped` is to be called
+    """
+    def __init__(self, game_id:str, on_stop):
+        self.sock_path = socket_path(game_id)
+        self.state = 'starting'
+        self._on_stop = on_stop
+        self._cond = Condition()
+        self._waiters = 0 # Connections being answered
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.sock_path)
+        except FileNotFoundError:
+            pass
+        except ConnectionRefusedError: # A stale socket of a dead server
+            remove(self.sock_path)
+        else:
+            raise RuntimeError("The game server is already running ({})".format(self.sock_path))
+        finally:
+            probe.close()
+
+        control = self
+        class Handler(StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    control._handle(line.decode('utf-8').strip(), self.wfile)
+
+        old_umask = umask(0o177) # The socket is only accessible to its owner
+        try:
+            self._server = ThreadingUnixStreamServer(self.sock_path, Handler)
+        finally:
+            umask(old_umask)
+        self._server.daemon_threads = True
+        register_at_fork(after_in_child=self._server.socket.close) # Not the workers' business
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def _set(self, state:str):
+        with self._cond:
+            if STATES.index(state) > STATES.index(self.state):
+                self.state = state
+                self._cond.notify_all()
+
+    def _wait(self, predicate) -> str:
+        with self._cond:
+            self._cond.wait_for(predicate)
+            return self.state
+
+    def _handle(self, command:str, out):
+        with self._cond:
+            self._waiters += 1
+        try:
+            if command == 'status':
+                state = self.state
+            elif command == 'wait_ready':
+                state = self._wait(lambda: self.state != 'starting')
+            elif command == 'ready':
+                self.ready()
+                state = self.state
+            elif command == 'stop':
+                with self._cond:
+                    first = (self.state in ['starting', 'ready'])
+                self._set('draining')
+                if first:
+                    print("Stopping the game server", file=stderr)
+                    self._on_stop()
+                out.write(b'draining\n')
+                out.flush()
+                state = self._wait(lambda: self.state == 'stopped')
+            else:
+                state = 'unknown command'
+            out.write(state.encode('utf-8') + b'\n')
+            out.flush()
+        finally:
+            with self._cond:
+                self._waiters -= 1
+                self._cond.notify_all()
+
+    def ready(self):
+        """Marks the server as ready to serve the requests"""
+        self._set('ready')
+
+    def stopped(self, grace:float=1):
+        """Marks the server as stopped, lets the waiting clients know it and
+            removes the socket. Call it right before the process exits
+        Parameters:
+            grace(float, optional): Max number of seconds to wait for the
+                clients to be answered
+        """
+        self._set('stopped')
+        with self._cond:
+            self._cond.wait_for(lambda: self._waiters == 0, grace)
+        self._server.shutdown()
+        self._server.server_close()
+        try:
+            remove(self.sock_path)
+        except FileNotFoundError:
+            pass
+
+def _request(game_id:str, command:str, timeout:float=None):
+    """Sends the command to the game server
+    Parameters:
+        game_id(str): The game identifier
+        command(str): The command
+        timeout(float, optional): The socket timeout
+    Returns:
+        socket.SocketIO or NoneType: The answer lines, None if the server isn't running
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path(game_id))
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    sock.sendall(command.encode('utf-8') + b'\n')
+    f = sock.makefile('rb')
+    sock.close() # The file keeps the connection
+    return f
+
+def status(game_id:str) -> str:
+    """Returns the state of the game server, None if it isn't running"""
+    f = _request(game_id, 'status', _timeout())
+    if f is None:
+        return None
+    with f:
+        return f.readline().decode('utf-8').strip() or None
+
+def notify_ready(game_id:str):
+    """Tells the game server that the current worker is ready"""
+    f = _request(game_id, 'ready', _timeout())
+    if f is not None:
+        with f:
+            f.readline()
+
+def wait_ready(game_id:str, process) -> bool:
+    """Waits until the started game server is ready
+    Parameters:
+        game_id(str): The game identifier
+        process(subprocess.Popen): The server process
+    Returns:
+        bool: True if the server is ready, False if it has exited or hasn't got
+            ready in `timeout` seconds of the `[control]` section of /etc/ovo.conf
+    """
+    deadline = monotonic() + _timeout()
+    f = None
+    while f is None: # The socket isn't created yet
+        if process.poll() is not None or monotonic() > deadline:
+            return False
+        f = _request(game_id, 'wait_ready', max(deadline - monotonic(), 0.001))
+        if f is None:
+            sleep(0.05)
+    try:
+        with f:
+            return f.readline().decode('utf-8').strip() == 'ready'
+    except socket.timeout:
+        return False
+
+def hosted_games_path() -> str:
+    """Returns the path of the file listing the games registered with the host web server"""
+    return path.join(_control_dir(), 'ovo-host.games')
+
+def hosted_games() -> set:
+    """Returns the identifiers of the games registered with the host web server"""
+    try:
+        with open(hosted_games_path()) as f:
+            return set(f.read().split())
+    except FileNotFoundError:
+        return set()
+
+def _update_hosted_games(update) -> bool:
+    """Changes the registered games. The changes are serialized by a lock file,
+        the list is replaced atomically, so the host server never reads it half
+        written
+    Parameters:
+        update(function): Changes the given set of the games, returns False if
+            there is nothing to change
+    Returns:
+        bool: The `update` result
+    """
+    import fcntl
+    file_path = hosted_games_path()
+    with open(file_path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        games = hosted_games()
+        if not update(games):
+            return False
+        with open(file_path + '.tmp', 'w') as f:
+            f.write(''.join(game_id + '\n' for game_id in sorted(games)))
+        replace(file_path + '.tmp', file_path)
+    return True
+
+def register_game(game_id:str) -> bool:
+    """Makes the host web server serve the game
+    Returns:
+        bool: False if the game was registered already
+    """
+    def update(games):
+        if game_id in games:
+            return False
+        games.add(game_id)
+        return True
+    return _update_hosted_games(update)
+
+def unregister_game(game_id:str) -> bool:
+    """Makes the host web server stop serving the game. The requests to the
+        game are answered with 404 right after the call
+    Returns:
+        bool: False if the game wasn't registered
+    """
+    def update(games):
+        if game_id not in games:
+            return False
+        games.remove(game_id)
+        return True
+    return _update_hosted_games(update)
+
+def stop(game_id:str) -> bool:
+    """Stops the game server gracefully, returns when it has stopped
+    Parameters:
+        game_id(str or NoneType): The game identifier, None for the host web server
+    Returns:
+        bool: False if the server wasn't running
+
+    Raises TimeoutError if the server hasn't stopped in `timeout` seconds of the
+        `[control]` section of /etc/ovo.conf
+    """
+    f = _request(game_id, 'stop', _timeout())
+    if f is None:
+        return False
+    try:
+        with f:
+            for line in f:
+                if line.strip() == b'stopped':
+                    break
+    except socket.timeout:
+        raise TimeoutError("The game server hasn't stopped in time")
+    # EOF without `stopped` means the process has exited before answering
+    return True
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+from sys import argv, stderr
+import sys
+import io
+import json
+import socket
+import traceback
+from os import path, remove, umask, getuid
+from tempfile import gettempdir
+from threading import local
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+
+from common import is_help_request, \
+        _load_config
+
+usage = """Usage: ovo daemon [--socket <path: str>]
+
+Runs the OvO daemon in the foreground. The daemon keeps the interpreter, the mysql driver and
+the game databases connections warm, so `ovo owo` commands are forwarded to it instead of being
+run in a new process each time. When the daemon isn't running, `ovo owo` works as usual
+
+The socket path is taken from the `socket` option of the `[daemon]` section of /etc/ovo.conf,
+unless given with --socket. Only the user running the daemon can connect to it
+"""
+
+def socket_path() -> str:
+    """Returns the daemon socket path from the conf file
+    Returns:
+        str: The socket path
+    """
+    return _load_config().get('daemon', 'socket',
+            fallback=path.join(gettempdir(), 'ovo-{}.sock'.format(getuid())))
+
+def _forwardable(args:list) -> bool:
+    """Checks if the command can be run by the daemon. Commands reading
+        files or stdin are run in-process, because the daemon has neither
+        the caller's working directory nor its stdin
+    Parameters:
+        args(list[str]): The command arguments, i. e. argv[1:]
+    Returns:
+        bool: True if the command can be forwarded
+    """
+    return len(args) > 2 and args[0] == 'owo' and args[2] != 'import'
+
+def forward(args:list):
+    """Runs the command by the daemon, if it's running, printing its
+        output and exiting with its exit code
+    Parameters:
+        args(list[str]): The command arguments, i. e. argv[1:]
+    Returns:
+        NoneType: Only if the command wasn't forwarded (the daemon isn't
+            running or the command can't be forwarded)
+    """
+    if not _forwardable(args):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path())
+    except OSError: # No daemon
+        sock.close()
+        return
+    with sock, sock.makefile('rwb') as f:
+        f.write(json.dumps({'argv': args}).encode('utf-8') + b'\n')
+        f.flush()
+        line = f.readline()
+    if not line: # The daemon has died in the middle of the command
+        print("The OvO daemon has closed the connection", file=stderr)
+        exit(1)
+    ans = json.loads(line)
+    sys.stdout.write(ans['stdout'])
+    stderr.write(ans['stderr'])
+    exit(ans['code'])
+
+class _ThreadOutput(io.TextIOBase):
+    """A text stream writing to the buffer of the current thread, if it
+        has one (see `_run_captured`), otherwise to the original stream
+    Parameters:
+        original: The original stream
+    """
+    def __init__(self, original):
+        self.original = original
+        self._local = local()
+
+    def write(self, s:str) -> int:
+        buf = getattr(self._local, 'buf', None)
+        return (self.original if buf is None else buf).write(s)
+
+    def flush(self):
+        if getattr(self._local, 'buf', None) is None:
+            self.original.flush()
+
+_stdout = None
+_stderr = None
+
+def _install_outputs(modules:list):
+    """Replaces sys.stdout and sys.stderr with `_ThreadOutput`s. The modules
+        which have done `from sys import stderr` get the new stderr too
+    Parameters:
+        modules(list[module]): The modules to patch
+    """
+    global _stdout, _stderr
+    original_stderr = sys.stderr
+    _stdout = sys.stdout = _ThreadOutput(sys.stdout)
+    _stderr = sys.stderr = _ThreadOutput(sys.stderr)
+    for module in modules:
+        if getattr(module, 'stderr', None) is original_stderr:
+            module.stderr = _stderr
+
+def _run_captured(func, args:list) -> dict:
+    """Runs the command-line `main` function in the current thread, capturing
+        its output and exit code
+    Parameters:
+        func(function): The `main` function
+        args(list[str]): Its arguments
+    Returns:
+        dict: {'code': int, 'stdout': str, 'stderr': str}
+    """
+    out, err = io.StringIO(), io.StringIO()
+    _stdout._local.buf, _stderr._local.buf = out, err
+    try:
+        func(args)
+        code = 0
+    except SystemExit as e:
+        if e.code is None or type(e.code) is int:
+            code = e.code or 0
+        else:
+            err.write(str(e.code) + '\n')
+            code = 1
+    except BaseException:
+        err.write(traceback.format_exc())
+        code = 1
+    finally:
+        _stdout._local.buf = _stderr._local.buf = None
+    return {'code': code, 'stdout': out.getvalue(), 'stderr': err.getvalue()}
+
+class _Handler(StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            args = json.loads(line)['argv']
+        except (ValueError, KeyError, TypeError):
+            return
+        if not _forwardable(args):
+            ans = {'code': 1, 'stdout': '', 'stderr': "The command can't be run by the OvO daemon\n"}
+        else:
+            ans = _run_captured(self.server.owo, args)
+        self.wfile.write(json.dumps(ans).encode('utf-8') + b'\n')
+
+def _main(sock_path:str):
+    """Runs the daemon until it's interrupted
+    Parameters:
+        sock_path(str): The socket path
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(sock_path)
+    except FileNotFoundError:
+        pass
+    except ConnectionRefusedError: # A stale socket of a dead daemon
+        remove(sock_path)
+    else:
+        print("The OvO daemon is already running at {}".format(sock_path), file=stderr)
+        exit(1)
+    finally:
+        probe.close()
+
+    # Imported here, so that forwarding commands doesn't load them
+    import common
+    import schema
+    import owo
+    _install_outputs([common, schema, owo])
+
+    old_umask = umask(0o177) # The socket is only accessible to its owner
+    try:
+        server = ThreadingUnixStreamServer(sock_path, _Handler)
+    finally:
+        umask(old_umask)
+    server.daemon_threads = True
+    server.owo = owo.main
+    print("The OvO daemon is listening at {}".format(sock_path), file=stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        remove(sock_path)
+
+def main(args):
+    if is_help_request(args):
+        print(usage, file=stderr)
+        exit(0)
+    if len(args) == 1:
+        _main(socket_path())
+    elif len(args) == 3 and args[1] == '--socket':
+        _main(args[2])
+    else:
+        print("Wrong arguments. Try --help for usage", file=stderr)
+        exit(1)
+
+if __name__ == "__main__":
+    main(argv)
@@ -1,14 +1,12 @@
 #!/usr/bin/python3
-from sys import argv, stderr, path
+from sys import argv, stderr, path, executable
+from importlib import import_module
 
 path.append('/usr/ovo/command_line')
 from common import is_help_request
-from run import main as run
-from stop import main as stop
-from cleanup import main as cleanup
-from owo import main as owo
 
 usage = """Usage: ovo <command> [<args>]
+   or: ovo --startup-profile [<command> [<args>]]
 
 The CTF OvO Manager is an application that helps you controlling task distribution inside a team during a CTF game
 
@@ -17,23 +15,77 @@ These are ovo commands:
     rerun   run an existing stopped game
     stop    stop the game
     cleanup remove game's database and remove all the files
+    provision keep spare game databases, so `run` is fast (more info in `ovo provision --help`)
     owo     call an operation with a running game (more info in `ovo owo --help`)
+    daemon  run the daemon making `ovo owo` calls faster (more info in `ovo daemon --help`)
+
+--startup-profile runs the command (`ovo --help` if not given) and prints how long importing each
+module took, the slowest first
 """
 
+# command -> (module, keyword arguments of its `main`). Only the module of
+# the called command is imported
+commands = {
+        'run': ('run', {}),
+        'rerun': ('run', {'rerun': True}),
+        'stop': ('stop', {}),
+        'cleanup': ('cleanup', {}),
+        'provision': ('provision', {}),
+        'owo': ('owo', {}),
+        'daemon': ('daemon', {})
+        }
+
+def parse_importtime(output:str) -> list:
+    """Parses the stderr of `python -X importtime`
+    Parameters:
+        output(str): The stderr
+    Returns:
+        list[tuple]: (module name, self time, cumulative time, nesting level) for
+            each imported module in the import order. The times are in microseconds
+    """
+    ans = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        ans.append((name.strip(), int(self_us), int(cumulative_us),
+            (len(name) - len(name.lstrip()) - 1) // 2))
+    return ans
+
+def _startup_profile(args:list, top:int=20):
+    """Runs the command with `python -X importtime` and prints the modules
+        import times
+    Parameters:
+        args(list[str]): The command arguments, i. e. argv[2:]
+        top(int, optional): How many modules to print
+    """
+    from subprocess import run, PIPE
+    p = run([executable, '-X', 'importtime', __file__] + (args or ['--help']),
+            stderr=PIPE, universal_newlines=True)
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:'):
+            print(line, file=stderr)
+    imports = parse_importtime(p.stderr)
+    total = sum(i[2] for i in imports if i[3] == 0)
+    print("{:>10} {:>10}  {}".format('self, ms', 'total, ms', 'module'), file=stderr)
+    for name, self_us, cumulative_us, level in sorted(imports, key=lambda i: -i[2])[:top]:
+        print("{:10.1f} {:10.1f}  {}{}".format(self_us / 1000, cumulative_us / 1000,
+            '  ' * level, name), file=stderr)
+    print("Imported {} modules in {:.1f} ms".format(len(imports), total / 1000), file=stderr)
+    exit(p.returncode)
+
 if __name__ == "__main__":
     if(len(argv) == 1) or is_help_request(argv):
         print(usage, file=stderr)
         exit(len(argv) - 1)
-    elif(argv[1] == 'run'):
-        run(argv[1:])
-    elif(argv[1] == 'rerun'):
-        run(argv[1:], rerun=True)
-    elif(argv[1] == 'stop'):
-        stop(argv[1:])
-    elif(argv[1] == 'cleanup'):
-        cleanup(argv[1:])
-    elif(argv[1] == 'owo'):
-        owo(argv[1:])
+    elif(argv[1] == '--startup-profile'):
+        _startup_profile(argv[2:])
+    elif(argv[1] in commands):
+        if(argv[1] == 'owo'):
+            import daemon
+            daemon.forward(argv[1:]) # Exits if the daemon has run the command
+        module, kwargs = commands[argv[1]]
+        import_module(module).main(argv[1:], **kwargs)
     else:
         print("Unknown command {}. Try --help for usage".format(argv[1]), file=stderr)
         exit(1)
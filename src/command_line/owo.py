@@ -1,16 +1,22 @@
-from os import remove, path
-from sys import stderr, argv
-from random import random
-from hashlib import sha3_512
+from os import remove, rename, makedirs, path
+from sys import stderr, stdin, argv
+import io
+import csv
 import json
 from functools import reduce
 
-import mysql.connector
-import bcrypt
-
 from common import is_help_request, \
-        get_db_connection, \
-        assert_ok_dbname
+        game_db_connection, \
+        forget_principal, \
+        hash_password, \
+        hash_passwords, \
+        check_password, \
+        generate_id, \
+        generate_session_id, \
+        id_to_db, \
+        id_from_db, \
+        sha256_to_db, \
+        file_sha256
 
 usage = """Usage: ovo owo <game_id: str> <command> [<args>]
 
@@ -30,6 +36,11 @@ The following commands are avaliable:
         Adds a user. avatar is the file id (got after `ovo owo add file`)
     add comment <--user-id: str> <--text: str> <--task-id: str> [<--file-id: str>]
         Adds a comment. Can contain an attachment or attachmentS (--file-id)
+    import <tasks/users/files> [<path: str>]
+        Adds many entities in one transaction. The records are read from the
+            file (stdin if not specified or `-`) either as NDJSON or as CSV with
+            a header line. The fields are the arguments of the `add` command.
+            For tasks and files, the list of created ids is printed
     rm <task/file/user/comment> <entity_id: str>
         Removes the entity with the given id
     mark user <user_id: str> <captain/default>
@@ -43,6 +54,9 @@ The following commands are avaliable:
             tasks. One task can be taken by several users
     reject_task <--task-id: str> <--user-id: str>
         Antonym for take_task
+    compact_events [<keep: int>]
+        Removes all the events of the web API changes log except the latest `keep`
+            ones (10000 by default). The number of removed events is printed
     authorize ...
         The command is defined here, but you can't call it from the command line
 
@@ -52,32 +66,102 @@ Examples:
     cp /home/me/my_new_file ${GAME_FILES_FOLDER}/${FILE_ID}
     ovo owo MY_GAME_1 update_avatar user1 $FILE_ID
     ovo owo MY_GAME_1 mark user user1 captain
+    ovo owo MY_GAME_1 import tasks tasks.csv
 """
 
 
-def _generate_id() -> str:
-    """Generates a random id for an entity
+def _insert_with_id(c, query:str, values:tuple) -> str:
+    """Executes the insert query, generating a new id as its first value
+    Parameters:
+        c: mysql cursor
+        query(str): The query to be executed
+        values(tuple): The query values, except the id
     Returns:
-        str: random hash
+        str: The generated id
     """
-    return sha3_512(str(random()).encode('utf-8')).hexdigest()
-
-def _db_insert(game_id:str, query:str, values:tuple):
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
     while True: # Looking for id wasn't given before
-        local_id = _generate_id()
+        local_id = generate_id()
         try:
-            c.execute(query, [local_id] + list(values))
-            break
+            c.execute(query, [id_to_db(local_id)] + list(values))
+            return local_id
         except Exception as e:
             if e.errno == 1062: # The given id already exists
                 continue
             else:
                 raise e
-    db.commit()
+
+# event type -> the tables (see `schema.VERSIONED_TABLES`) changed by the event
+_EVENT_TABLES = {
+        'task_added': ['tasks'],
+        'task_removed': ['tasks', 'comments'],
+        'task_marked': ['tasks'],
+        'file_added': ['files'],
+        'file_removed': ['files'],
+        'user_added': ['users'],
+        'user_removed': ['users', 'solvings'],
+        'user_marked': ['users'],
+        'avatar_updated': ['users'],
+        'comment_added': ['comments'],
+        'comment_removed': ['comments'],
+        'task_taken': ['solvings'],
+        'task_rejected': ['solvings']
+        }
+
+def _bump_versions(c, event_type:str):
+    """Increments the versions of the tables changed by the event"""
+    tables = _EVENT_TABLES[event_type]
+    c.execute('UPDATE versions SET version = version + 1 WHERE name IN ({})'.format(
+        ', '.join(['%s'] * len(tables))), tuple(tables))
+
+def _lock_events(c):
+    """Takes the lock of the events log (the game_info row) until the end of the
+        transaction. The events ids are given under it, so they are in the commit
+        order: a missing id is always a rolled back transaction, never one still
+        to be committed. Must be the last lock the transaction takes, except the
+        versions ones
+    Parameters:
+        c: mysql cursor
+    """
+    c.execute('SELECT events_compacted FROM game_info FOR UPDATE')
+    c.fetchall()
+
+def _publish(c, event_type:str, data:dict):
+    """Records a change of the game for the event stream of the web API and
+        bumps the versions of the changed tables (for the ETags). Must be called
+        in the transaction making the change right before the commit, so the
+        event is seen if and only if the change is committed
+    Parameters:
+        c: mysql cursor
+        event_type(str): The event type, i. e. "task_added"
+        data(dict): The event data, as small as possible
+    """
+    _lock_events(c)
+    c.execute('INSERT INTO events(type, data) VALUES (%s, %s)', (event_type, json.dumps(data)))
+    _bump_versions(c, event_type)
+
+def _publish_many(c, event_type:str, data:list):
+    """The same as `_publish`, but for many events of the same type"""
+    _lock_events(c)
+    c.executemany('INSERT INTO events(type, data) VALUES (%s, %s)',
+            [(event_type, json.dumps(d)) for d in data])
+    _bump_versions(c, event_type)
+
+def _db_insert(game_id:str, query:str, values:tuple, event_type:str, event_data:dict):
+    """Inserts the row with a new id and publishes the event about it
+    Parameters:
+        game_id(str): The game identifier
+        query(str): The insert query
+        values(tuple): The query values, except the id
+        event_type(str): The event type
+        event_data(dict): The event data, except the id
+    Returns:
+        str: The generated id
+    """
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        local_id = _insert_with_id(c, query, values)
+        _publish(c, event_type, dict(event_data, id=local_id))
+        db.commit()
     return local_id
 
 def add_task(game_id:str, name:str, original_link:str=None,
@@ -95,27 +179,128 @@ def add_task(game_id:str, name:str, original_link:str=None,
     """
     query = 'INSERT INTO tasks(id, name, original_link, original_id, text) \
             VALUES (%s, %s, %s, %s, %s)'
-    return _db_insert(game_id, query, (name, original_link, original_id, text))
+    return _db_insert(game_id, query, (name, original_link, original_id, text), 'task_added',
+            {'name': name, 'original_link': original_link, 'original_id': original_id, 'text': text})
+
+def blob_path(files_folder:str, sha256:str) -> str:
+    """Returns the path of the file content with the given sha256 hex digest"""
+    return path.join(files_folder, 'blobs', sha256)
+
+def content_path(files_folder:str, file_id:str, sha256) -> str:
+    """Returns the path of the file content
+    Parameters:
+        files_folder(str): The game files folder
+        file_id(str): The file identifier
+        sha256(bytes or NoneType): The `files.sha256` value. The files added
+            without the content (by the command line) are stored by their ids
+    Returns:
+        str: The path
+    """
+    if sha256 is None:
+        return path.join(files_folder, id_from_db(id_to_db(file_id)))
+    return blob_path(files_folder, id_from_db(sha256))
 
-def add_file(game_id:str, name:str, silent:bool=False) -> str:
+def _remove_content(file_path:str):
+    """Removes the file content, warning if it can't be done"""
+    try:
+        remove(file_path)
+    except FileNotFoundError:
+        print("Important warning: couldn't delete a file, because it doesn't exist", file=stderr)
+    except PermissionError:
+        print("Important warning: couldn't delete a file, because of permissions", file=stderr)
+    except OSError as e:
+        print("Important warning: couldn't delete a file, because of OSError ({})".format(e), file=stderr)
+    except Exception as e:
+        print("Important warning: couldn't delete the folder, because of unknown error ({})".format(e), file=stderr)
+
+def _commit_file(db, c, folder:str, name:str, source:str, sha256:str=None) -> str:
+    """Adds the file and commits the transaction. The content is stored once
+        per sha256 (in `blob_path`), the `blobs` table counts the files referring
+        to it. A new content is moved from `source` before the commit, so the file
+        is never seen without it. A known one is just referred to, `source` is removed
+    Parameters:
+        db: mysql connection
+        c: its cursor
+        folder(str): The game files folder
+        name(str): The file name to be displayed
+        source(str or NoneType): The path of the file content, must be in the same
+            file system. May be None if the content is known
+        sha256(str, optional): The content sha256 hex digest, if known by the caller
+    Returns:
+        str: The created file id
+
+    Raises ValueError if the content is neither known nor given
+    """
+    if sha256 is None:
+        sha256 = file_sha256(source)
+    raw_sha256 = sha256_to_db(sha256.lower())
+    c.execute('SELECT refcount FROM blobs WHERE sha256=(%s) FOR UPDATE', (raw_sha256,))
+    known = (c.fetchone() is not None)
+    if known:
+        c.execute('UPDATE blobs SET refcount = refcount + 1 WHERE sha256=(%s)', (raw_sha256,))
+    elif source is None:
+        raise ValueError("The file content is unknown")
+    else:
+        c.execute('INSERT INTO blobs(sha256, size, refcount) VALUES (%s, %s, 1)',
+                (raw_sha256, path.getsize(source)))
+    file_id = _insert_with_id(c, 'INSERT INTO files(id, name, sha256) VALUES (%s, %s, %s)',
+            (name, raw_sha256))
+    _publish(c, 'file_added', {'name': name, 'id': file_id})
+    file_path = blob_path(folder, id_from_db(raw_sha256))
+    if not known:
+        makedirs(path.dirname(file_path), exist_ok=True)
+        rename(source, file_path)
+    try:
+        db.commit()
+    except Exception:
+        if not known:
+            rename(file_path, source)
+        raise
+    if known and source is not None:
+        remove(source)
+    return file_id
+
+def add_file(game_id:str, name:str, silent:bool=False, source:str=None) -> str:
     """Adds the file to the game database
     Parameters:
         game_id(str): The game identifier
         name(str): The file name to be displayed
         silent(bool, optional): If the function has to be quiet or \
                 it can print some hints to stderr
+        source(str, optional): The path of the file content. If given, the content
+            is moved to the game files folder (see `_commit_file`), the path must
+            be in the same file system. Otherwise the content is to be saved by
+            the caller as ${GAME_FILES_FOLDER}/${FILE_ID}
     Returns:
         str: The created file id
     """
+    if source is not None:
+        with game_db_connection(game_id) as db:
+            c = db.cursor()
+            c.execute('SELECT files_folder FROM game_info')
+            folder, = c.fetchone()
+            return _commit_file(db, c, folder, name, source)
     query = 'INSERT INTO files(id, name) VALUES (%s, %s)'
-    ans = _db_insert(game_id, query, (name,))
+    ans = _db_insert(game_id, query, (name,), 'file_added', {'name': name})
     if not silent:
         print("Please save your file to the game files folder, please use the \
 following name: {}".format(ans), file=stderr)
     return ans
 
+def _get_bcrypt_rounds(game_id:str) -> int:
+    """Returns the bcrypt cost of the game
+    Parameters:
+        game_id(str): The game identifier
+    Returns:
+        int: The bcrypt cost
+    """
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SELECT bcrypt_rounds FROM game_info')
+        return c.fetchone()[0]
+
 def add_user(game_id:str, login:str, password:str,
-        is_captain:bool=False, avatar:str=None):
+        is_captain:bool=False, avatar:str=None, bcrypt_rounds:int=None):
     """Adds the user to the game database
     Parameters:
         game_id(str): The game identifier
@@ -123,22 +308,26 @@ def add_user(game_id:str, login:str, password:str,
         password(str): User's password
         is_captain(bool, optional): if the user being registered must become captain
         avatar(str, optional): The avatar file id (got from add_file)
+        bcrypt_rounds(int, optional): The game bcrypt cost, if known by the caller
     """
     if login == 'DELETED':
         raise ValueError("The `DELETED` username is reserved by the OvO Manager")
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    query = 'INSERT INTO users(login, password, is_captain, avatar) \
-            VALUES (%s, %s, %s, %s)'
-    c.execute(query, (
-        login,
-        bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
-        'Y' if is_captain else 'N',
-        avatar
-        ))
-    db.commit()
+    if bcrypt_rounds is None:
+        bcrypt_rounds = _get_bcrypt_rounds(game_id)
+    hashed = hash_password(password, bcrypt_rounds)
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        query = 'INSERT INTO users(login, password, is_captain, avatar) \
+                VALUES (%s, %s, %s, %s)'
+        c.execute(query, (
+            login,
+            hashed,
+            'Y' if is_captain else 'N',
+            None if avatar is None else id_to_db(avatar)
+            ))
+        _publish(c, 'user_added', {'login': login, 'is_captain': bool(is_captain),
+            'avatar': None if avatar is None else avatar.lower()})
+        db.commit()
 
 def add_comment(game_id:str, user_id:str, task_id:str, text:str=None, files_ids:list=None) -> str:
     """Adds the comment to the game database
@@ -153,19 +342,153 @@ def add_comment(game_id:str, user_id:str, task_id:str, text:str=None, files_ids:
     """
     if files_ids is None:
         files_ids = []
-    assert(all(map(lambda x: type(x) is str, files_ids)))
+    for file_id in files_ids:
+        id_to_db(file_id) # Checking the id is well-formed
     query = 'INSERT INTO comments(id, task_id, user_id, text, attached_files_ids) \
+            VALUES (%s, %s, (SELECT id FROM users WHERE login=(%s)), %s, %s)'
+    return _db_insert(game_id, query, (id_to_db(task_id), user_id, text, json.dumps(files_ids)),
+            'comment_added', {'task_id': task_id.lower(), 'user_id': user_id, 'text': text,
+                'attached_files': files_ids})
+
+def _db_insert_many(game_id:str, query:str, rows:list, event_type:str, events_data:list) -> list:
+    """Inserts many rows in one transaction, generating a new id as the first
+        value of each row, and publishes the events about them
+    Parameters:
+        game_id(str): The game identifier
+        query(str): The insert query
+        rows(list[tuple]): The rows values, except the ids
+        event_type(str): The events type
+        events_data(list[dict]): The events data, except the ids, in the same order
+    Returns:
+        list[str]: The generated ids in the same order
+    """
+    ids = [generate_id() for _ in rows]
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.executemany(query, [[id_to_db(i)] + list(row) for i, row in zip(ids, rows)])
+        _publish_many(c, event_type, [dict(d, id=i) for i, d in zip(ids, events_data)])
+        db.commit()
+    return ids
+
+def _check_fields(record:dict, required:set, optional:set):
+    """Raises ValueError if the record misses a required field or has an unknown one"""
+    if not required.issubset(record.keys()) or not set(record.keys()).issubset(required | optional):
+        raise ValueError("Bad record {}. Required fields: {}, optional: {}".format(
+            record, sorted(required), sorted(optional)))
+
+def add_tasks(game_id:str, tasks:list) -> list:
+    """Adds many tasks to the game database in one transaction
+    Parameters:
+        game_id(str): The game identifier
+        tasks(list[dict]): The tasks, each one is a dict of `add_task` arguments
+    Returns:
+        list[str]: The created tasks ids in the same order
+    """
+    for task in tasks:
+        _check_fields(task, {'name'}, {'original_link', 'original_id', 'text'})
+    query = 'INSERT INTO tasks(id, name, original_link, original_id, text) \
             VALUES (%s, %s, %s, %s, %s)'
-    return _db_insert(game_id, query, (task_id, user_id, text, json.dumps(files_ids)))
+    rows = [(t['name'], t.get('original_link'), t.get('original_id'), t.get('text')) for t in tasks]
+    return _db_insert_many(game_id, query, rows, 'task_added',
+            [dict(zip(['name', 'original_link', 'original_id', 'text'], row)) for row in rows])
+
+def add_files(game_id:str, names:list) -> list:
+    """Adds many files to the game database in one transaction. The files
+        must be saved the same way as for `add_file`
+    Parameters:
+        game_id(str): The game identifier
+        names(list[str]): The files names to be displayed
+    Returns:
+        list[str]: The created files ids in the same order
+    """
+    query = 'INSERT INTO files(id, name) VALUES (%s, %s)'
+    return _db_insert_many(game_id, query, [(name,) for name in names], 'file_added',
+            [{'name': name} for name in names])
+
+def add_users(game_id:str, users:list):
+    """Adds many users to the game database in one transaction. The passwords
+        are hashed in parallel
+    Parameters:
+        game_id(str): The game identifier
+        users(list[dict]): The users, each one is a dict of `add_user` arguments
+    """
+    for user in users:
+        _check_fields(user, {'login', 'password'}, {'is_captain', 'avatar'})
+        if user['login'] == 'DELETED':
+            raise ValueError("The `DELETED` username is reserved by the OvO Manager")
+    hashes = hash_passwords([u['password'] for u in users], _get_bcrypt_rounds(game_id))
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        query = 'INSERT INTO users(login, password, is_captain, avatar) \
+                VALUES (%s, %s, %s, %s)'
+        c.executemany(query, [(
+            u['login'],
+            hashed,
+            'Y' if u.get('is_captain') else 'N',
+            None if u.get('avatar') is None else id_to_db(u['avatar'])
+            ) for u, hashed in zip(users, hashes)])
+        _publish_many(c, 'user_added', [{'login': u['login'], 'is_captain': bool(u.get('is_captain')),
+            'avatar': None if u.get('avatar') is None else u['avatar'].lower()} for u in users])
+        db.commit()
+
+def _read_records(source:str) -> list:
+    """Reads records for the bulk import from NDJSON (one JSON object per line)
+        or CSV (with a header line). The format is guessed by the file extension,
+        or by the first character for stdin
+    Parameters:
+        source(str): The file path or '-' for stdin
+    Returns:
+        list[dict]: The records. CSV fields are strings, their names may be written
+            with '-' instead of '_', empty fields are omitted
+    """
+    f = stdin if source == '-' else open(source, newline='')
+    try:
+        data = f.read()
+    finally:
+        if f is not stdin:
+            f.close()
+    if source.endswith('.csv'):
+        is_json = False
+    elif source.endswith(('.json', '.jsonl', '.ndjson')):
+        is_json = True
+    else:
+        is_json = data.lstrip().startswith('{')
+    if is_json:
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+    return [{k.strip().replace('-', '_'): v for k, v in row.items() if v != ''}
+            for row in csv.DictReader(io.StringIO(data))]
+
+def import_entities(game_id:str, entity:str, source:str) -> list:
+    """Adds many tasks, users or files from a file (see `_read_records`)
+    Parameters:
+        game_id(str): The game identifier
+        entity(str): Either "tasks", "users" or "files"
+        source(str): The file path or '-' for stdin
+    Returns:
+        list[str] or NoneType: The created ids in the input order (None for users)
+    """
+    records = _read_records(source)
+    if entity == 'tasks':
+        return add_tasks(game_id, records)
+    elif entity == 'files':
+        for record in records:
+            _check_fields(record, {'name'}, set())
+        return add_files(game_id, [r['name'] for r in records])
+    elif entity == 'users':
+        for record in records:
+            if type(record.get('is_captain')) is str:
+                record['is_captain'] = record['is_captain'].lower() in ['1', 'y', 'yes', 'true']
+        return add_users(game_id, records)
+    else:
+        raise ValueError("Unknown entities {}. Tasks, users, files are avaliable".format(entity))
 
 def _db_rmer(game_id:str, table_name:str, remove_field_id:str, entity_id:str):
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('SHOW TABLES')
-    assert(table_name in map(lambda x: x[0], c.fetchall()))
-    c.execute('DELETE FROM {} WHERE {}=(%s)'.format(table_name, remove_field_id), (entity_id,))
-    db.commit()
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SHOW TABLES')
+        assert(table_name in map(lambda x: x[0], c.fetchall()))
+        c.execute('DELETE FROM {} WHERE {}=(%s)'.format(table_name, remove_field_id), (entity_id,))
+        db.commit()
 
 def rm_task(game_id:str, task_id:str) -> list:
     """Removes the task from the game database
@@ -175,17 +498,16 @@ def rm_task(game_id:str, task_id:str) -> list:
     Returns:
         list[str]: ids of the files attached to the task
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT attached_files_ids FROM comments WHERE task_id=(%s)', (task_id,))
-    ans = []
-    for file_id in c.fetchall():
-        ans += json.loads(file_id[0])
-    c.execute('DELETE FROM comments WHERE task_id=(%s)', (task_id,))
-    c.execute('DELETE FROM tasks WHERE id=(%s)', (task_id,))
-    db.commit()
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SELECT attached_files_ids FROM comments WHERE task_id=(%s)', (id_to_db(task_id),))
+        ans = []
+        for file_id in c.fetchall():
+            ans += json.loads(file_id[0])
+        c.execute('DELETE FROM comments WHERE task_id=(%s)', (id_to_db(task_id),))
+        c.execute('DELETE FROM tasks WHERE id=(%s)', (id_to_db(task_id),))
+        _publish(c, 'task_removed', {'id': task_id.lower()})
+        db.commit()
     return ans
 
 def rm_file(game_id:str, file_id:str):
@@ -194,24 +516,43 @@ def rm_file(game_id:str, file_id:str):
         game_id(str): The game identifier
         file_id(str): The file identifier
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT files_folder FROM game_info')
-    folder, = c.fetchone()
-    try:
-        remove(path.join(folder, file_id))
-    except FileNotFoundError:
-        print("Important warning: couldn't delete a file, because it doesn't exist", file=stderr)
-    except PermissionError:
-        print("Important warning: couldn't delete a file, because of permissions", file=stderr)
-    except OSError as e:
-        print("Important warning: couldn't delete a file, because of OSError ({})".format(e), file=stderr)
-    except Exception as e:
-        print("Important warning: couldn't delete the folder, because of unknown error ({})".format(e), file=stderr)
-    c.execute('DELETE FROM files WHERE id=(%s)', (file_id,))
-    db.commit()
+    raw_id = id_to_db(file_id) # Also makes sure the id is safe to be used as a file name
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SELECT files_folder FROM game_info')
+        folder, = c.fetchone()
+        c.execute('SELECT sha256 FROM files WHERE id=(%s) FOR UPDATE', (raw_id,))
+        row = c.fetchone()
+        sha256 = None if row is None else row[0]
+        stored = doomed = None # The content is removed only once the removal is committed
+        if sha256 is None:
+            doomed = content_path(folder, file_id, None)
+        else: # The content is removed with the last file referring to it
+            c.execute('SELECT refcount FROM blobs WHERE sha256=(%s) FOR UPDATE', (sha256,))
+            refcount, = c.fetchone()
+            if refcount > 1:
+                c.execute('UPDATE blobs SET refcount = refcount - 1 WHERE sha256=(%s)', (sha256,))
+            else:
+                c.execute('DELETE FROM blobs WHERE sha256=(%s)', (sha256,))
+                # Moved aside before the commit, so the same content added right
+                # after the commit gets a blob of its own (see `_commit_file`)
+                stored = content_path(folder, file_id, sha256)
+                doomed = stored + '.removed-' + generate_id()
+                try:
+                    rename(stored, doomed)
+                except OSError as e:
+                    print("Important warning: couldn't move the file content aside ({})".format(e), file=stderr)
+                    stored = doomed = None
+        c.execute('DELETE FROM files WHERE id=(%s)', (raw_id,))
+        _publish(c, 'file_removed', {'id': id_from_db(raw_id)})
+        try:
+            db.commit()
+        except Exception:
+            if stored is not None:
+                rename(doomed, stored)
+            raise
+    if doomed is not None:
+        _remove_content(doomed)
 
 def rm_user(game_id:str, user_id:str) -> str:
     """Removes the user from the game database
@@ -221,14 +562,17 @@ def rm_user(game_id:str, user_id:str) -> str:
     Returns:
         str: The user's avatar file id to be removed
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT avatar FROM users WHERE login=(%s)', (user_id,))
-    ans, = c.fetchone()
-    c.execute('DELETE FROM users WHERE login=(%s)', (user_id,))
-    db.commit()
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SELECT id, avatar FROM users WHERE login=(%s)', (user_id,))
+        uid, avatar = c.fetchone()
+        c.execute('DELETE FROM solvings WHERE user_id=(%s)', (uid,))
+        c.execute('DELETE FROM session_data WHERE user_id=(%s)', (uid,))
+        c.execute('DELETE FROM users WHERE id=(%s)', (uid,))
+        _publish(c, 'user_removed', {'login': user_id})
+        db.commit()
+    ans = id_from_db(avatar)
+    forget_principal(game_id, user_id)
     return ans
 
 def rm_comment(game_id:str, comment_id:str) -> list:
@@ -239,14 +583,13 @@ def rm_comment(game_id:str, comment_id:str) -> list:
     Returns:
         list[str]: ids of the files attached to the comment
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT attached_files_ids FROM comments WHERE id=(%s)', (comment_id,))
-    ans, = c.fetchone()
-    c.execute('DELETE FROM comments WHERE id=(%s)', (comment_id,))
-    db.commit()
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SELECT attached_files_ids FROM comments WHERE id=(%s)', (id_to_db(comment_id),))
+        ans, = c.fetchone()
+        c.execute('DELETE FROM comments WHERE id=(%s)', (id_to_db(comment_id),))
+        _publish(c, 'comment_removed', {'id': comment_id.lower()})
+        db.commit()
     return json.loads(ans)
 
 
@@ -257,18 +600,19 @@ def mark_user(game_id:str, user_id:str, new_type:str):
         user_id(str): The user identifier
         new_type(str): Either "captain" or "default"
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    query = 'UPDATE users SET is_captain=(%s) WHERE login=(%s)'
-    if new_type == "captain":
-        c.execute(query, ('Y', user_id))
-    elif new_type == "default":
-        c.execute(query, ('N', user_id))
-    else:
-        raise ValueError("Unknown user type. Must be either captain or default")
-    db.commit()
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        query = 'UPDATE users SET is_captain=(%s) WHERE login=(%s)'
+        if new_type == "captain":
+            c.execute(query, ('Y', user_id))
+        elif new_type == "default":
+            c.execute(query, ('N', user_id))
+        else:
+            raise ValueError("Unknown user type. Must be either captain or default")
+        if c.rowcount > 0:
+            _publish(c, 'user_marked', {'login': user_id, 'is_captain': new_type == "captain"})
+        db.commit()
+    forget_principal(game_id, user_id)
 
 def mark_task(game_id:str, task_id:str, new_type:str):
     """Marks the task as solved or not solved
@@ -277,18 +621,18 @@ def mark_task(game_id:str, task_id:str, new_type:str):
         task_id(str): The task identifier
         new_type(str): Either "solved" or "unsolved"
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE  OvO_' + game_id)
-    query = 'UPDATE tasks SET is_solved=(%s)'
-    if new_type == "solved":
-        c.execute(query, ('Y',))
-    elif new_type == "unsolved":
-        c.execute(query, ('N',))
-    else:
-        raise ValueError("Unknown task type. Must be either solved or unsolved")
-    db.commit()
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        query = 'UPDATE tasks SET is_solved=(%s) WHERE id=(%s)'
+        if new_type == "solved":
+            c.execute(query, ('Y', id_to_db(task_id)))
+        elif new_type == "unsolved":
+            c.execute(query, ('N', id_to_db(task_id)))
+        else:
+            raise ValueError("Unknown task type. Must be either solved or unsolved")
+        if c.rowcount > 0:
+            _publish(c, 'task_marked', {'id': task_id.lower(), 'is_solved': new_type == "solved"})
+        db.commit()
 
 def update_avatar(game_id:str, user_id:str, avatar:str):
     """Updates the user's avatar with the given
@@ -297,12 +641,12 @@ def update_avatar(game_id:str, user_id:str, avatar:str):
         user_id(str): The user identifier
         avatar(str): The avatar file id (got from add_file)
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('UPDATE users SET avatar=(%s) WHERE login=(%s)', (avatar, user_id))
-    db.commit()
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('UPDATE users SET avatar=(%s) WHERE login=(%s)', (id_to_db(avatar), user_id))
+        if c.rowcount > 0:
+            _publish(c, 'avatar_updated', {'login': user_id, 'avatar': avatar.lower()})
+        db.commit()
 
 def take_task(game_id:str, task_id:str, user_id:str):
     """Creates a connection between the user and the task
@@ -313,12 +657,14 @@ def take_task(game_id:str, task_id:str, user_id:str):
             task_id(str): The task identifier
             user_id(str): The user identifier
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('INSERT INTO solvings(task_id, user_id) VALUES (%s, %s)', (task_id, user_id))
-    db.commit()
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('INSERT INTO solvings(task_id, user_id) SELECT %s, id FROM users WHERE login=(%s)',
+                (id_to_db(task_id), user_id))
+        if c.rowcount == 0:
+            raise ValueError("Unknown user {}".format(user_id))
+        _publish(c, 'task_taken', {'task_id': task_id.lower(), 'user_id': user_id})
+        db.commit()
 
 def reject_task(game_id:str, task_id:str, user_id:str):
     """Antonym for take_task
@@ -327,12 +673,115 @@ def reject_task(game_id:str, task_id:str, user_id:str):
             task_id(str): The task identifier
             user_id(str): The user identifier
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('DELETE FROM solvings WHERE task_id=(%s) AND user_id=(%s)', (task_id, user_id))
-    db.commit()
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('DELETE s FROM solvings s JOIN users u ON u.id = s.user_id \
+                WHERE s.task_id=(%s) AND u.login=(%s)', (id_to_db(task_id), user_id))
+        if c.rowcount > 0:
+            _publish(c, 'task_rejected', {'task_id': task_id.lower(), 'user_id': user_id})
+        db.commit()
+
+def upload_path(files_folder:str, upload_id:str) -> str:
+    """Returns the path of the content of the unfinished upload"""
+    return path.join(files_folder, '.upload-' + id_from_db(id_to_db(upload_id)))
+
+def create_upload(game_id:str, name:str, size:int, sha256:str=None) -> dict:
+    """Starts a chunked upload of a file (see the web API `/api/create_upload`).
+        The content is written to `upload_path` and becomes a file
+        in `finish_upload`
+    Parameters:
+        game_id(str): The game identifier
+        name(str): The file name to be displayed
+        size(int): The file size in bytes
+        sha256(str, optional): The content sha256 hex digest. If the content is
+            known already, the upload is complete at once
+    Returns:
+        dict: {'id': str, 'received': int}, the upload id and the number of
+            bytes already received
+    """
+    if size < 0:
+        raise ValueError("The file size can't be negative")
+    raw_sha256 = None if sha256 is None else sha256_to_db(sha256.lower())
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SELECT files_folder FROM game_info')
+        folder, = c.fetchone()
+        if raw_sha256 is not None:
+            c.execute('SELECT size FROM blobs WHERE sha256=(%s)', (raw_sha256,))
+            if c.fetchone() != (size,):
+                raw_sha256 = None
+        received = 0 if raw_sha256 is None else size
+        upload_id = _insert_with_id(c, 'INSERT INTO uploads(id, name, size, received, sha256) \
+                VALUES (%s, %s, %s, %s, %s)', (name, size, received, raw_sha256))
+        if raw_sha256 is None:
+            open(upload_path(folder, upload_id), 'wb').close()
+        db.commit()
+    return {'id': upload_id, 'received': received}
+
+def finish_upload(game_id:str, upload_id:str, sha256:str) -> str:
+    """Turns the complete upload into a file
+    Parameters:
+        game_id(str): The game identifier
+        upload_id(str): The upload identifier
+        sha256(str): The content sha256 hex digest
+    Returns:
+        str or NoneType: The created file id, None if the upload doesn't exist
+
+    Raises ValueError if not all the content was received. If the upload was
+        complete at once, but the content has been removed since then, the upload
+        is restarted from the beginning and ValueError is raised too
+    """
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SELECT files_folder FROM game_info')
+        folder, = c.fetchone()
+        c.execute('SELECT name, size, received, sha256 FROM uploads WHERE id=(%s) FOR UPDATE',
+                (id_to_db(upload_id),))
+        row = c.fetchone()
+        if row is None:
+            return None
+        name, size, received, known_sha256 = row
+        if received != size:
+            raise ValueError("The upload isn't complete, {} of {} bytes received".format(received, size))
+        source = None
+        if known_sha256 is None:
+            source = upload_path(folder, upload_id)
+        else:
+            c.execute('SELECT size FROM blobs WHERE sha256=(%s) FOR UPDATE', (known_sha256,))
+            if c.fetchone() is None:
+                c.execute('UPDATE uploads SET received=0, sha256=NULL WHERE id=(%s)', (id_to_db(upload_id),))
+                open(upload_path(folder, upload_id), 'wb').close()
+                db.commit()
+                raise ValueError("The file content was removed, upload it again")
+        c.execute('DELETE FROM uploads WHERE id=(%s)', (id_to_db(upload_id),))
+        return _commit_file(db, c, folder, name, source, sha256)
+
+DEFAULT_EVENTS_KEPT = 10000
+
+def compact_events(game_id:str, keep:int=DEFAULT_EVENTS_KEPT) -> int:
+    """Removes the old events from the changes log. The web API clients
+        which have missed the removed events are told to resync
+    Parameters:
+        game_id(str): The game identifier
+        keep(int, optional): Number of the latest events to be kept
+    Returns:
+        int: Number of the removed events
+    """
+    if keep < 0:
+        raise ValueError("Number of the events to be kept can't be negative")
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        _lock_events(c) # Taken before the events ones, like the publishing transactions do
+        c.execute('SELECT COALESCE(MAX(id), 0) FROM events')
+        last_id, = c.fetchone()
+        if last_id <= keep:
+            return 0
+        c.execute('DELETE FROM events WHERE id <= (%s)', (last_id - keep,))
+        ans = c.rowcount
+        c.execute('UPDATE game_info SET events_compacted = GREATEST(events_compacted, %s)',
+                (last_id - keep,))
+        db.commit()
+    return ans
 
 def authorize(game_id:str, login:str, password:str) -> str:
     """Either creates a session key or gives an existing one
@@ -344,24 +793,32 @@ def authorize(game_id:str, login:str, password:str) -> str:
     Returns:
         str: The session key
 
-    Raises ValueError if the password isn't correct
+    Raises ValueError if the user doesn't exist or the password isn't correct
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT password FROM users WHERE login=(%s)',
-            (login,))
-    if not bcrypt.checkpw(password.encode('utf-8'), c.fetchone()[0].encode('utf-8')):
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SELECT id, password FROM users WHERE login=(%s)',
+                (login,))
+        tmp = c.fetchone()
+    if tmp is None:
+        raise ValueError("The user doesn't exist")
+    uid, hashed = tmp
+    # The connection is not held while the password is being checked
+    if not check_password(password, hashed):
         raise ValueError("The password is not correct")
 
-    c.execute('SELECT session_id FROM session_data WHERE user_id=(%s)',
-            (login,))
-    tmp = c.fetchone()
-    if tmp is not None:
-        return tmp[0]
-    query = 'INSERT INTO session_data (session_id, user_id) VALUES (%s, %s)'
-    return _db_insert(game_id, query, (login,))
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SELECT session_id FROM session_data WHERE user_id=(%s)',
+                (uid,))
+        tmp = c.fetchone()
+        if tmp is not None:
+            return id_from_db(tmp[0])
+        session_id = generate_session_id()
+        c.execute('INSERT INTO session_data (session_id, user_id) VALUES (%s, %s)',
+                (id_to_db(session_id), uid))
+        db.commit()
+    return session_id
 
 def main(args: list):
     ans = None
@@ -414,6 +871,10 @@ def main(args: list):
                 raise ValueError("Unknown entitie {}. Task, file, user, comment are avaliable".format(args[2]))
             ans = {'task': add_task, 'file': add_file, 'user': add_user, 'comment': add_comment} \
                     [args[3]](game_id, **d)
+        elif args[2] == 'import':
+            if len(args) > 5:
+                raise ValueError("Wrong number of arguments specified. Try --help for usage")
+            ans = import_entities(game_id, args[3], args[4] if len(args) == 5 else '-')
         elif args[2] == 'rm':
             ans = {'task': rm_task, 'file': rm_file, 'user': rm_user, 'comment': rm_comment} \
                     [args[3]](game_id, args[4])
@@ -431,6 +892,10 @@ def main(args: list):
                 d[now_insertable[2:].replace('-', '_')] = arg
                 now_insertable = None
             ans = {'take_task': take_task, 'reject_task': reject_task}[args[2]](game_id, **d)
+        elif args[2] == 'compact_events':
+            if len(args) > 4:
+                raise ValueError("Wrong number of arguments specified. Try --help for usage")
+            ans = compact_events(game_id, *map(int, args[3:]))
         else:
             raise ValueError("Unknown command {}. Try --help for usage".format(args[2]))
     except IndexError:
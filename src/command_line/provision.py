@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+import re
+from sys import argv, stderr, executable
+from os import path
+from time import monotonic
+
+from common import is_help_request, \
+        get_db_connection, \
+        generate_id, \
+        _load_config
+import schema
+
+usage = """Usage: ovo provision [<count: int>]
+
+Creates the spare game databases, so `ovo run` only moves the tables of one to the new game
+database instead of creating them. Keeps `count` spare databases (`spares` of the `[provision]`
+section of /etc/ovo.conf, 2 by default), removes the ones of the older schema versions and
+prints how long creating each one took.
+
+After taking a spare database, `ovo run` starts `ovo provision` in the background. No spare
+databases are kept until `ovo provision` is called once
+"""
+
+SPARE_PREFIX = 'OvOspare_'
+PROVISION_LOCK = 'OvOprovision' # Serializes the `ovo provision` runs
+
+_TABLE_NAMES = {re.match(r'CREATE TABLE (\w+)', query).group(1) for query in schema.TABLES}
+
+def _spare_prefix() -> str:
+    """Returns the name prefix of the spare databases of the current schema version"""
+    return '{}{}_'.format(SPARE_PREFIX, schema.SCHEMA_VERSION)
+
+def _lock(c, name:str, timeout:int=0) -> bool:
+    """Takes the named mysql lock for the session
+    Parameters:
+        c: mysql cursor
+        name(str): The lock name
+        timeout(int, optional): Max number of seconds to wait, -1 for no limit
+    Returns:
+        bool: True if the lock is taken
+    """
+    c.execute('SELECT GET_LOCK(%s, %s)', (name, timeout))
+    return c.fetchone()[0] == 1
+
+def _unlock(c, name:str):
+    c.execute('SELECT RELEASE_LOCK(%s)', (name,))
+    c.fetchone()
+
+def list_spares(c) -> tuple:
+    """Lists the spare databases
+    Parameters:
+        c: mysql cursor
+    Returns:
+        tuple: (names of the current schema spares, the oldest first; names of
+            the other schema versions spares)
+    """
+    c.execute('SHOW DATABASES')
+    names = [name for name, in c.fetchall() if name.startswith(SPARE_PREFIX)]
+    current = sorted(name for name in names if name.startswith(_spare_prefix()))
+    return (current, [name for name in names if not name.startswith(_spare_prefix())])
+
+def create_spare(c) -> str:
+    """Creates a spare database with the current schema. It's locked until
+        created, so it's never taken half made
+    Parameters:
+        c: mysql cursor
+    Returns:
+        str: The spare database name
+    """
+    name = _spare_prefix() + generate_id() # The ids grow with time, see `list_spares`
+    _lock(c, name, -1)
+    try:
+        schema.create_db(name, c)
+    finally:
+        _unlock(c, name)
+    return name
+
+def claim_spare(db_name:str, c) -> bool:
+    """Makes a game database of a spare one: the spare tables are renamed
+        into the new database by one RENAME TABLE, which doesn't copy the data
+        and is atomic. Broken spares (of a provisioning killed in the middle)
+        are removed on the way
+    Parameters:
+        db_name(str): New database name
+        c: mysql cursor
+    Returns:
+        bool: True if a spare was taken and `db_name` is in use, False if
+            there are no spare databases
+    """
+    for spare in list_spares(c)[0]:
+        if not _lock(c, spare):
+            continue # Being created or taken by another `ovo run`
+        try:
+            c.execute('SHOW DATABASES LIKE %s', (spare,))
+            if c.fetchone() is None: # Taken before we've locked it
+                continue
+            c.execute('SHOW TABLES FROM ' + spare)
+            tables = [table for table, in c.fetchall()]
+            if set(tables) != _TABLE_NAMES:
+                print("Removing the broken spare database {}".format(spare), file=stderr)
+                c.execute('DROP DATABASE ' + spare)
+                continue
+            c.execute('CREATE DATABASE ' + db_name)
+            c.execute('RENAME TABLE ' + ', '.join('{0}.{2} TO {1}.{2}'.format(spare, db_name, table)
+                for table in tables))
+            c.execute('DROP DATABASE ' + spare)
+        finally:
+            _unlock(c, spare)
+        c.execute('USE ' + db_name)
+        schema.init_versions(c)
+        return True
+    return False
+
+def replenish():
+    """Starts `ovo provision` in the background"""
+    from subprocess import Popen, DEVNULL
+    Popen([executable, path.abspath(__file__)], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+            start_new_session=True)
+
+def _main(count:int):
+    """Keeps `count` spare databases of the current schema
+    Parameters:
+        count(int): Number of the spare databases
+    """
+    if count < 0:
+        raise ValueError("The number of the spare databases can't be negative")
+    db = get_db_connection(autocommit=True)
+    c = db.cursor()
+    _lock(c, PROVISION_LOCK, -1) # Another `ovo provision` is to finish first
+    current, stale = list_spares(c)
+    for spare in stale + current[count:]:
+        if _lock(c, spare):
+            try:
+                c.execute('DROP DATABASE IF EXISTS ' + spare)
+            finally:
+                _unlock(c, spare)
+            print("Removed the spare database {}".format(spare), file=stderr)
+    started = monotonic()
+    for _ in range(count - len(current)):
+        spare_started = monotonic()
+        name = create_spare(c)
+        print("Created the spare database {} in {:.1f} ms".format(
+            name, (monotonic() - spare_started) * 1000), file=stderr)
+    print("{} spare databases are ready, created {} in {:.1f} ms".format(
+        count, max(count - len(current), 0), (monotonic() - started) * 1000), file=stderr)
+
+def main(args):
+    if is_help_request(args):
+        print(usage, file=stderr)
+        exit(0)
+    if len(args) == 1:
+        _main(_load_config().getint('provision', 'spares', fallback=2))
+    elif len(args) == 2:
+        _main(int(args[1]))
+    else:
+        print("Wrong number of arguments. Try --help for usage", file=stderr)
+        exit(1)
+
+if __name__ == "__main__":
+    main(argv)
@@ -1,18 +1,17 @@
 #!/usr/bin/python3
 from sys import argv, stderr
-from getpass import getpass
-from os import listdir, remove, path
+from os import listdir, path
 from pathlib import Path
-from subprocess import Popen, DEVNULL
-from time import sleep
-
-import mysql.connector
-import bcrypt
 
 from common import is_help_request, \
         get_db_connection, \
+        hash_passwords, \
+        DEFAULT_BCRYPT_ROUNDS, \
         assert_ok_dbname
 from stop import _main as stop
+import control
+import provision
+import schema
 
 usage = """Usage: ovo <run/rerun> [<args>]. Required arguments not specified in the command line will be requested from stdin.
 
@@ -29,74 +28,99 @@ Positional args:
     --judge-url: str            An url to the CTF platform to get tasks from. It must contain protocol (http/https/...) and port if not 80
     --judge-login: str          User login for the CTF platform. No need to specify, if the CTF platform supports getting tasks with no authorization
     --judge-pass: str           User password for the CTF platform. No need to specify, if the CTF platform supports getting tasks with no authorization
-
-If you're running `rerun`, `id` is the only required argument. No arguments will be requested from stdin for `rerun`
+    --bcrypt-rounds: int        The bcrypt cost for the game passwords (12 by default). Applies to the passwords set after the change
+    --workers: int              The number of the web server worker processes (1 by default)
+    --engine: sync/async/hosted The web application: `sync` (WSGI, a thread per request), `async` (ASGI, for
+                                    many long-lived connections) or `hosted` (served under /g/<id>/ by the host
+                                    web server shared by the games, see below). sync by default
+
+Every /api/events stream of the sync and hosted engines takes a worker thread for the whole connection. The
+streams have their own threads, `max_event_streams` of the `[web]` section of /etc/ovo.conf per worker (256 by
+default), besides the 8 threads of the other requests. Above that the worker answers 503 and the client is to
+poll /api/changes until it can reconnect. The async engine doesn't limit the streams, so it's the engine for
+the games with more clients than that
+
+The host web server is started with the first hosted game. It listens on `port` of the `[host]` section of
+/etc/ovo.conf (8000 by default) with `workers` worker processes (1 by default), the --port and --workers of
+the hosted games are ignored. `ovo stop --host` stops it
+
+If you're running `rerun`, `id` is the only required argument. No arguments will be requested from stdin for `rerun`.
+If the game is running and neither the port, nor the workers, nor the engine change, the running web server
+reloads the new values in place. Otherwise it's stopped (the requests being served are finished in
+`drain_timeout` seconds of the `[web]` section of /etc/ovo.conf, 30 by default) and started again
 
 Examples:
     ovo run -i HeLlO -r easy_password --captain-pass harder_password --port 5000 --judge-url http://ctfd_host.ru:5000 --judge-login a --judge-pass b
     ovo rerun -i HeLlO --judge-url https://ctfd_host.ru/path/to/ctfd --captain-pass new_password
+    ovo rerun -i HeLlO --workers 8 --engine async
 """
 
+RESTART_ARGS = ['--port', '--workers', '--engine'] # Can't be changed without restarting the web server
+
 def init_db(db_name:str, c):
-    """Initializes a mysql database for a new game
+    """Initializes a mysql database for a new game. A spare database is taken
+        if there is one (see provision.py), then the spares are replenished in
+        the background
     Parameters:
         db_name(str): New database name
         cursor: mysql cursor
     """
-    assert_ok_dbname(db_name)
-    c.execute('CREATE DATABASE {}'.format(db_name))
-    c.execute('USE ' + db_name)
-    query = "CREATE TABLE users ( \
-            login VARCHAR(3072) PRIMARY KEY NOT NULL, \
-            password TEXT NOT NULL, \
-            is_captain ENUM('Y', 'N') NOT NULL DEFAULT 'N', \
-            avatar VARCHAR(128) \
-            )"
-    c.execute(query)
-    query = "CREATE TABLE tasks ( \
-            id VARCHAR(128) PRIMARY KEY NOT NULL, \
-            name TEXT NOT NULL, \
-            is_solved ENUM('Y', 'N') NOT NULL DEFAULT 'N', \
-            original_link TEXT, \
-            original_id TEXT, \
-            text TEXT \
-            )"
-    c.execute(query)
-    query = "CREATE TABLE solvings ( \
-            user_id VARCHAR(2944) NOT NULL, \
-            task_id VARCHAR(128) NOT NULL, \
-            PRIMARY KEY (`user_id`, `task_id`) \
-            )"
-    c.execute(query)
-    query = "CREATE TABLE files ( \
-            id VARCHAR(128) PRIMARY KEY NOT NULL, \
-            name TEXT NOT NULL \
-            )"
-    c.execute(query)
-    query = "CREATE TABLE comments( \
-            id VARCHAR(128) NOT NULL PRIMARY KEY, \
-            task_id VARCHAR(128) NOT NULL, \
-            user_id VARCHAR(2944) NOT NULL, \
-            text TEXT, \
-            attached_files_ids TEXT \
-            )"
-    c.execute(query)
-    query = "CREATE TABLE session_data( \
-            user_id VARCHAR(2944) NOT NULL PRIMARY KEY, \
-            session_id VARCHAR(128) NOT NULL UNIQUE KEY \
-            )"
-    c.execute(query)
-    query = "CREATE TABLE game_info( \
-            port INTEGER NOT NULL, \
-            files_folder VARCHAR(4096) NOT NULL, \
-            register_pass TEXT NOT NULL, \
-            captain_pass TEXT NOT NULL, \
-            judge_url TEXT, \
-            judge_login TEXT, \
-            judge_pass TEXT, \
-            _uniquer ENUM('0') NOT NULL DEFAULT '0' UNIQUE KEY \
-            )"
-    c.execute(query)
+    if provision.claim_spare(db_name, c):
+        provision.replenish()
+    else:
+        schema.init_db(db_name, c)
+
+def _hash_passwords(args:dict, rounds:int):
+    """Replaces the passwords in the arguments dict with their bcrypt hashes
+    Parameters:
+        args(dict): Arguments dict in the {agument: value} format
+        rounds(int): The bcrypt cost
+    """
+    present = [arg for arg in ['--register-pass', '--captain-pass'] if arg in args.keys()]
+    for arg, hashed in zip(present, hash_passwords([args[arg] for arg in present], rounds)):
+        args[arg] = hashed
+
+def _start_web_server(script:str, game_id:str):
+    """Starts the web server and waits until it's ready
+    Parameters:
+        script(str): The web application, main.py or asgi.py
+        game_id(str or NoneType): The game identifier, None for the host web server
+    """
+    from subprocess import Popen, DEVNULL
+    server = Popen([
+        path.join(path.dirname(path.abspath(__file__)), '../web', script),
+        '--host' if game_id is None else game_id
+        ], stdout=DEVNULL)
+    if not control.wait_ready(game_id, server):
+        if game_id is None:
+            raise RuntimeError("The host web server has failed to start")
+        raise RuntimeError("The web server of the game {} has failed to start".format(game_id))
+
+def _applies_in_place(args:dict, c) -> bool:
+    """Tells if the rerun values can be applied by the running web server of the
+        game without restarting it: the workers reload the game info by themselves
+        (see `watch_game_info` in web/main.py), but not the listening socket, the
+        number of workers, the engine or the schema. The port and the workers of
+        a hosted game are the host web server ones
+    Parameters:
+        args(dict): Arguments dict in the {agument: value} format
+        c: mysql cursor, the game database in use
+    Returns:
+        bool: True if the server is running and nothing of the above changes
+    """
+    if schema.get_schema_version(c) != schema.SCHEMA_VERSION:
+        return False
+    c.execute('SELECT port, workers, engine FROM game_info')
+    current = dict(zip(RESTART_ARGS, c.fetchone()))
+    if current['--engine'] == 'hosted':
+        if control.status(None) != 'ready' or args['--id'] not in control.hosted_games():
+            return False
+        restart_args = ['--engine']
+    else:
+        if control.status(args['--id']) != 'ready':
+            return False
+        restart_args = RESTART_ARGS
+    return all(str(args[arg]) == str(current[arg]) for arg in restart_args if arg in args.keys())
 
 def _main(args:dict, rerun:bool=False):
     """Runs a new OvO game
@@ -109,46 +133,54 @@ def _main(args:dict, rerun:bool=False):
     c = db.cursor()
     c.execute('SHOW DATABASES')
     if('OvO_' + args['--id'] in map(lambda x: x[0], c.fetchall())):
-        if rerun:
-            stop(args['--id'])
-        else:
+        if not rerun:
             raise RuntimeError("The game with {} identifier already exists".format(args['--id']))
     
     if '--files-folder' in args.keys():
         args['--files-folder'] = path.abspath(args['--files-folder'])
-    if '--register-pass' in args.keys():
-        args['--register-pass'] = bcrypt.hashpw(
-                args['--register-pass'].encode('utf-8'),
-                bcrypt.gensalt()
-                ).decode('utf-8')
-    if '--captain-pass' in args.keys():
-        args['--captain-pass'] = bcrypt.hashpw(
-                args['--captain-pass'].encode('utf-8'),
-                bcrypt.gensalt()
-                ).decode('utf-8')
-
+    if '--bcrypt-rounds' in args.keys():
+        args['--bcrypt-rounds'] = int(args['--bcrypt-rounds'])
+        if not (4 <= args['--bcrypt-rounds'] <= 31):
+            raise ValueError("The bcrypt cost must be between 4 and 31")
+    if '--workers' in args.keys():
+        args['--workers'] = int(args['--workers'])
+        if args['--workers'] < 1:
+            raise ValueError("The number of workers must be positive")
+    if args.get('--engine', 'sync') not in ['sync', 'async', 'hosted']:
+        raise ValueError("The engine must be either sync, async or hosted")
+
+    in_place = False
     if rerun: # Updating values
         c.execute('USE OvO_' + args['--id'])
+        in_place = _applies_in_place(args, c)
+        if not in_place:
+            stop(args['--id'])
+        schema.migrate(c)
+        if '--bcrypt-rounds' not in args.keys():
+            c.execute('SELECT bcrypt_rounds FROM game_info')
+            _hash_passwords(args, c.fetchone()[0])
+        else:
+            _hash_passwords(args, args['--bcrypt-rounds'])
         for arg, value in args.items():
             if(arg == '--id'): continue
             key = arg[2:].replace('-', '_')
             assert_ok_dbname(key)
             query = 'UPDATE game_info SET {}=(%s)'
             c.execute(query.format(key), (value,))
+        c.execute('UPDATE game_info SET version = version + 1')
     else: # Saving values
+        args.setdefault('--bcrypt-rounds', DEFAULT_BCRYPT_ROUNDS)
+        args.setdefault('--workers', 1)
+        args.setdefault('--engine', 'sync')
+        if args['--engine'] == 'hosted':
+            args.setdefault('--port', 0) # Not used
+        _hash_passwords(args, args['--bcrypt-rounds'])
         init_db('OvO_' + args['--id'], c)
-        c.execute('INSERT INTO game_info (port, files_folder, register_pass, captain_pass, judge_url, judge_login, judge_pass) \
-                VALUES (%s, %s, %s, %s, %s, %s, %s)', tuple(map(lambda x: args.get(x), [
-                    '--port', '--files-folder', '--register-pass', '--captain-pass', '--judge-url', '--judge-login', '--judge-pass'
-                    ]))) # If some required values were not specified, MySQL will raise an exception
-    if rerun:
-        # Remove the stop-file if exists:
-        c.execute('SELECT files_folder FROM game_info')
-        try:
-            remove(path.join(c.fetchone()[0], 'exit'))
-        except FileNotFoundError:
-            pass
-    else:
+        c.execute('INSERT INTO game_info (port, files_folder, register_pass, captain_pass, judge_url, judge_login, judge_pass, bcrypt_rounds, workers, engine, schema_version) \
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)', tuple(map(lambda x: args.get(x), [
+                    '--port', '--files-folder', '--register-pass', '--captain-pass', '--judge-url', '--judge-login', '--judge-pass', '--bcrypt-rounds', '--workers', '--engine'
+                    ])) + (schema.SCHEMA_VERSION,)) # If some required values were not specified, MySQL will raise an exception
+    if not rerun:
         # Create files directory:
         try:
             Path(args['--files-folder']).mkdir(parents=True, exist_ok=False)
@@ -157,12 +189,18 @@ def _main(args:dict, rerun:bool=False):
                raise ValueError("The folder for files must be empty")
 
     pass # RUN TASKS CATCHER HERE
+    c.execute('SELECT engine FROM game_info')
+    engine, = c.fetchone()
     db.commit()
-    Popen([
-        path.join(path.dirname(path.abspath(__file__)), '../web/main.py'),
-        args['--id']
-        ], stdout=DEVNULL)
-    sleep(1)
+    if in_place:
+        print("The running web server of the game reloads the new values in a few seconds", file=stderr)
+        return
+    if engine == 'hosted':
+        if control.status(None) is None:
+            _start_web_server('main.py', None)
+        control.register_game(args['--id'])
+    else:
+        _start_web_server({'sync': 'main.py', 'async': 'asgi.py'}[engine], args['--id'])
 
 def main(args:list, rerun:bool=False):
     """Runs a new OvO game
@@ -177,7 +215,7 @@ def main(args:list, rerun:bool=False):
 
     to_long = {'-i': '--id', '-r': '--register-pass',
             '-c': '--captain-pass', '-p': '--port', '-f': '--files-folder'}
-    long_only = ['--judge-url', '--judge-login', '--judge-pass']
+    long_only = ['--judge-url', '--judge-login', '--judge-pass', '--bcrypt-rounds', '--workers', '--engine']
     required = ['--id', '--register-pass', '--captain-pass', '--port', '--files-folder']
 
     converted_args = {}
@@ -195,11 +233,14 @@ def main(args:list, rerun:bool=False):
             now_insertable_key = None
 
     if not rerun:
+        if converted_args.get('--engine') == 'hosted':
+            required.remove('--port')
         for arg in required:
             if arg in converted_args.keys():
                 continue
             read_func = None
             if arg.endswith('pass') or arg.endswith('password'):
+                from getpass import getpass
                 read_func = lambda x: getpass('(safe input) ' + x)
             else:
                 read_func = input
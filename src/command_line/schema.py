@@ -0,0 +1,331 @@
+import json
+from sys import stderr
+from os import path, rename
+from time import time_ns
+
+from common import assert_ok_dbname, \
+        generate_id, \
+        id_to_db, \
+        id_from_db
+
+# The current definitions of the game database tables. A new game gets them
+# as they are, existing games are brought to them by `MIGRATIONS`
+TABLES = [
+    "CREATE TABLE users ( \
+            id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, \
+            login VARCHAR(768) NOT NULL UNIQUE KEY, \
+            password TEXT NOT NULL, \
+            is_captain ENUM('Y', 'N') NOT NULL DEFAULT 'N', \
+            avatar BINARY(16) \
+            )",
+    "CREATE TABLE tasks ( \
+            id BINARY(16) PRIMARY KEY NOT NULL, \
+            name TEXT NOT NULL, \
+            is_solved ENUM('Y', 'N') NOT NULL DEFAULT 'N', \
+            original_link TEXT, \
+            original_id TEXT, \
+            text TEXT \
+            )",
+    "CREATE TABLE solvings ( \
+            user_id INT UNSIGNED NOT NULL, \
+            task_id BINARY(16) NOT NULL, \
+            PRIMARY KEY (`user_id`, `task_id`), \
+            KEY task_id (`task_id`) \
+            )",
+    "CREATE TABLE files ( \
+            id BINARY(16) PRIMARY KEY NOT NULL, \
+            name TEXT NOT NULL, \
+            sha256 BINARY(32) \
+            )",
+    "CREATE TABLE blobs( \
+            sha256 BINARY(32) NOT NULL PRIMARY KEY, \
+            size BIGINT UNSIGNED NOT NULL, \
+            refcount INTEGER UNSIGNED NOT NULL \
+            )",
+    "CREATE TABLE comments( \
+            id BINARY(16) NOT NULL PRIMARY KEY, \
+            task_id BINARY(16) NOT NULL, \
+            user_id INT UNSIGNED NOT NULL, \
+            text TEXT, \
+            attached_files_ids TEXT, \
+            created_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6), \
+            KEY task_created (`task_id`, `created_at`), \
+            KEY created (`created_at`) \
+            )",
+    "CREATE TABLE session_data( \
+            user_id INT UNSIGNED NOT NULL PRIMARY KEY, \
+            session_id BINARY(16) NOT NULL UNIQUE KEY \
+            )",
+    "CREATE TABLE events( \
+            id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, \
+            type VARCHAR(32) NOT NULL, \
+            data TEXT NOT NULL, \
+            created_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) \
+            )",
+    "CREATE TABLE versions( \
+            name VARCHAR(32) NOT NULL PRIMARY KEY, \
+            version BIGINT UNSIGNED NOT NULL \
+            )",
+    "CREATE TABLE uploads( \
+            id BINARY(16) NOT NULL PRIMARY KEY, \
+            name TEXT NOT NULL, \
+            size BIGINT UNSIGNED NOT NULL, \
+            received BIGINT UNSIGNED NOT NULL DEFAULT 0, \
+            sha256 BINARY(32), \
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP \
+            )",
+    "CREATE TABLE game_info( \
+            port INTEGER NOT NULL, \
+            files_folder VARCHAR(4096) NOT NULL, \
+            register_pass TEXT NOT NULL, \
+            captain_pass TEXT NOT NULL, \
+            judge_url TEXT, \
+            judge_login TEXT, \
+            judge_pass TEXT, \
+            version INTEGER NOT NULL DEFAULT 0, \
+            bcrypt_rounds INTEGER NOT NULL DEFAULT 12, \
+            workers INTEGER NOT NULL DEFAULT 1, \
+            engine ENUM('sync', 'async', 'hosted') NOT NULL DEFAULT 'sync', \
+            events_compacted BIGINT UNSIGNED NOT NULL DEFAULT 0, \
+            schema_version INTEGER NOT NULL DEFAULT 0, \
+            _uniquer ENUM('0') NOT NULL DEFAULT '0' UNIQUE KEY \
+            )"
+]
+
+def _compact_ids(c):
+    """Replaces the 128 hex digits ids of tasks, files and comments with the
+        BINARY(16) ones (see `common.generate_id`), renaming the files in the
+        game files folder. The existing sessions are dropped
+    Parameters:
+        c: mysql cursor
+    """
+    mapping = {} # old id -> new id
+    for table in ['tasks', 'files', 'comments']:
+        c.execute('SELECT id FROM ' + table)
+        for old_id, in c.fetchall():
+            mapping[old_id] = generate_id()
+    c.execute('SELECT id, attached_files_ids FROM comments')
+    for comment_id, attached in c.fetchall():
+        files_ids = [mapping[i] for i in json.loads(attached) if i in mapping]
+        c.execute('UPDATE comments SET attached_files_ids=(%s) WHERE id=(%s)',
+                (json.dumps(files_ids), comment_id))
+
+    c.execute('CREATE TEMPORARY TABLE id_map (old VARBINARY(128) PRIMARY KEY, new BINARY(16) NOT NULL)')
+    c.executemany('INSERT INTO id_map (old, new) VALUES (%s, %s)',
+            [(old.encode('ascii'), id_to_db(new)) for old, new in mapping.items()])
+    for table, column, nullable in [('tasks', 'id', False), ('files', 'id', False),
+            ('comments', 'id', False), ('comments', 'task_id', False),
+            ('solvings', 'task_id', False), ('users', 'avatar', True)]:
+        null = 'NULL' if nullable else 'NOT NULL'
+        c.execute('ALTER TABLE {} MODIFY {} VARBINARY(128) {}'.format(table, column, null))
+        if nullable: # Dangling references
+            c.execute('UPDATE {0} t LEFT JOIN id_map m ON m.old = t.{1} SET t.{1} = NULL \
+                    WHERE m.old IS NULL'.format(table, column))
+        else:
+            c.execute('DELETE t FROM {0} t LEFT JOIN id_map m ON m.old = t.{1} \
+                    WHERE m.old IS NULL'.format(table, column))
+        c.execute('UPDATE {0} t JOIN id_map m ON m.old = t.{1} SET t.{1} = m.new'.format(table, column))
+        c.execute('ALTER TABLE {} MODIFY {} BINARY(16) {}'.format(table, column, null))
+    c.execute('DROP TEMPORARY TABLE id_map')
+    c.execute('DELETE FROM session_data')
+    c.execute('ALTER TABLE session_data MODIFY session_id BINARY(16) NOT NULL')
+
+    c.execute('SELECT id FROM files')
+    new_files_ids = set(map(lambda x: id_from_db(x[0]), c.fetchall()))
+    c.execute('SELECT files_folder FROM game_info')
+    folder, = c.fetchone()
+    for old_id, new_id in mapping.items():
+        if new_id not in new_files_ids:
+            continue
+        try:
+            rename(path.join(folder, old_id), path.join(folder, new_id))
+        except OSError as e:
+            print("Important warning: couldn't rename the file {} ({})".format(old_id, e), file=stderr)
+
+LOGIN_MAX_LENGTH = 768 # Characters, the longest login a unique key can index
+
+def _check_logins_fit(c):
+    """Makes sure the logins fit the `LOGIN_MAX_LENGTH` column and stay unique
+        in it, otherwise, depending on the sql mode, they would be truncated
+        silently or the migration would fail halfway
+    Parameters:
+        c: mysql cursor
+
+    Raises RuntimeError if they don't
+    """
+    c.execute('SELECT login FROM users WHERE CHAR_LENGTH(login) > (%s)', (LOGIN_MAX_LENGTH,))
+    too_long = [login for login, in c.fetchall()]
+    if too_long:
+        raise RuntimeError("The logins longer than {} characters can't be migrated, shorten or remove them \
+first: {}".format(LOGIN_MAX_LENGTH, ', '.join(login[:32] + '...' for login in too_long)))
+    c.execute('SELECT LEFT(login, %s) l FROM users GROUP BY l HAVING COUNT(*) > 1', (LOGIN_MAX_LENGTH,))
+    colliding = [login for login, in c.fetchall()]
+    if colliding:
+        raise RuntimeError("The logins can't be migrated, they collide in the new column: {}".format(
+            ', '.join(login[:32] for login in colliding)))
+
+# The tables having a version in the `versions` table
+VERSIONED_TABLES = ['tasks', 'users', 'solvings', 'files', 'comments']
+
+def init_versions(c):
+    """Fills the `versions` table. The versions start from the current time in
+        microseconds, so a game recreated with the same id never repeats them
+    Parameters:
+        c: mysql cursor
+    """
+    c.executemany('INSERT INTO versions(name, version) VALUES (%s, %s)',
+            [(table, time_ns() // 1000) for table in VERSIONED_TABLES])
+
+# MIGRATIONS[i] brings a game database from the version i to the version i + 1.
+# Every migration is a list of queries or functions taking mysql cursor
+MIGRATIONS = [
+    [ # 0 -> 1: comments creation time for the paginated comments feed
+        "ALTER TABLE game_info ADD COLUMN schema_version INTEGER NOT NULL DEFAULT 0 \
+                AFTER judge_pass",
+        "ALTER TABLE comments \
+                ADD COLUMN created_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6), \
+                ADD KEY task_created (`task_id`, `created_at`), \
+                ADD KEY created (`created_at`)"
+    ],
+    [ # 1 -> 2: game_info version, so running servers know when to reload it
+        "ALTER TABLE game_info ADD COLUMN version INTEGER NOT NULL DEFAULT 0 \
+                AFTER judge_pass"
+    ],
+    [ # 2 -> 3: per game bcrypt cost
+        "ALTER TABLE game_info ADD COLUMN bcrypt_rounds INTEGER NOT NULL DEFAULT 12 \
+                AFTER version"
+    ],
+    [ # 3 -> 4: compact time-ordered ids
+        _compact_ids
+    ],
+    [ # 4 -> 5: integer surrogate keys for users. Comments of the removed users
+      # get the user id 0, which never exists
+        _check_logins_fit,
+        "ALTER TABLE users DROP PRIMARY KEY, \
+                ADD COLUMN id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST, \
+                MODIFY login VARCHAR(768) NOT NULL, \
+                ADD UNIQUE KEY login (`login`)",
+        "ALTER TABLE solvings ADD COLUMN uid INT UNSIGNED",
+        "UPDATE solvings s JOIN users u ON u.login = s.user_id SET s.uid = u.id",
+        "DELETE FROM solvings WHERE uid IS NULL",
+        "ALTER TABLE solvings DROP PRIMARY KEY, DROP COLUMN user_id, \
+                CHANGE uid user_id INT UNSIGNED NOT NULL FIRST, \
+                ADD PRIMARY KEY (`user_id`, `task_id`), ADD KEY task_id (`task_id`)",
+        "ALTER TABLE comments ADD COLUMN uid INT UNSIGNED",
+        "UPDATE comments cm LEFT JOIN users u ON u.login = cm.user_id SET cm.uid = COALESCE(u.id, 0)",
+        "ALTER TABLE comments DROP COLUMN user_id, \
+                CHANGE uid user_id INT UNSIGNED NOT NULL AFTER task_id",
+        "ALTER TABLE session_data ADD COLUMN uid INT UNSIGNED",
+        "UPDATE session_data s JOIN users u ON u.login = s.user_id SET s.uid = u.id",
+        "DELETE FROM session_data WHERE uid IS NULL",
+        "ALTER TABLE session_data DROP PRIMARY KEY, DROP COLUMN user_id, \
+                CHANGE uid user_id INT UNSIGNED NOT NULL FIRST, ADD PRIMARY KEY (`user_id`)"
+    ],
+    [ # 5 -> 6: number of the web server worker processes
+        "ALTER TABLE game_info ADD COLUMN workers INTEGER NOT NULL DEFAULT 1 \
+                AFTER bcrypt_rounds"
+    ],
+    [ # 6 -> 7: the web application (WSGI or ASGI) serving the game
+        "ALTER TABLE game_info ADD COLUMN engine ENUM('sync', 'async') NOT NULL DEFAULT 'sync' \
+                AFTER workers"
+    ],
+    [ # 7 -> 8: the changes feed of the web API event stream
+        "CREATE TABLE events( \
+                id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, \
+                type VARCHAR(32) NOT NULL, \
+                data TEXT NOT NULL, \
+                created_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) \
+                )"
+    ],
+    [ # 8 -> 9: per table versions for the ETags of the web API
+        "CREATE TABLE versions( \
+                name VARCHAR(32) NOT NULL PRIMARY KEY, \
+                version BIGINT UNSIGNED NOT NULL \
+                )",
+        init_versions
+    ],
+    [ # 9 -> 10: the last event removed by the events log compaction
+        "ALTER TABLE game_info ADD COLUMN events_compacted BIGINT UNSIGNED NOT NULL DEFAULT 0 \
+                AFTER engine"
+    ],
+    [ # 10 -> 11: the unfinished chunked uploads of the web API
+        "CREATE TABLE uploads( \
+                id BINARY(16) NOT NULL PRIMARY KEY, \
+                name TEXT NOT NULL, \
+                size BIGINT UNSIGNED NOT NULL, \
+                received BIGINT UNSIGNED NOT NULL DEFAULT 0, \
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP \
+                )"
+    ],
+    [ # 11 -> 12: the files content stored once per sha256
+        "ALTER TABLE files ADD COLUMN sha256 BINARY(32)",
+        "CREATE TABLE blobs( \
+                sha256 BINARY(32) NOT NULL PRIMARY KEY, \
+                size BIGINT UNSIGNED NOT NULL, \
+                refcount INTEGER UNSIGNED NOT NULL \
+                )",
+        "ALTER TABLE uploads ADD COLUMN sha256 BINARY(32) AFTER received"
+    ],
+    [ # 12 -> 13: the games served by the shared host web server
+        "ALTER TABLE game_info MODIFY COLUMN engine ENUM('sync', 'async', 'hosted') NOT NULL DEFAULT 'sync'"
+    ]
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def create_db(db_name:str, c):
+    """Creates a mysql database with the current schema and no data, i. e. a spare
+        database (see provision.py) or a new game one
+    Parameters:
+        db_name(str): New database name
+        c: mysql cursor
+    """
+    assert_ok_dbname(db_name)
+    c.execute('CREATE DATABASE {}'.format(db_name))
+    c.execute('USE ' + db_name)
+    for query in TABLES:
+        c.execute(query)
+
+def init_db(db_name:str, c):
+    """Creates a mysql database for a new game with the current schema
+    Parameters:
+        db_name(str): New database name
+        c: mysql cursor
+    """
+    create_db(db_name, c)
+    init_versions(c)
+
+def get_schema_version(c) -> int:
+    """Returns the schema version of the game database in use
+    Parameters:
+        c: mysql cursor
+    Returns:
+        int: The schema version
+    """
+    c.execute("SHOW COLUMNS FROM game_info LIKE 'schema_version'")
+    if c.fetchone() is None: # Created before the schema was versioned
+        return 0
+    c.execute('SELECT schema_version FROM game_info')
+    return c.fetchone()[0]
+
+def migrate(c):
+    """Brings the game database in use to the current schema version
+    Parameters:
+        c: mysql cursor
+    """
+    version = get_schema_version(c)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError("The game database schema ({}) is newer than the OvO Manager one ({})".format(
+            version, SCHEMA_VERSION))
+    for version in range(version, SCHEMA_VERSION):
+        print("Migrating the game database to the schema version {}".format(version + 1), file=stderr)
+        for step in MIGRATIONS[version]:
+            if callable(step):
+                step(c)
+            else:
+                c.execute(step)
+        c.execute('UPDATE game_info SET schema_version=(%s)', (version + 1,))
+
+if __name__ == "__main__":
+    print("It's forbidden to run this file", file=stderr)
+    exit(1)
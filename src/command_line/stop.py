@@ -1,39 +1,43 @@
 #!/usr/bin/python3
 from sys import stderr, argv
-from pathlib import Path
-from os import path
-from time import sleep
-
-import mysql.connector
 
 from common import is_help_request, \
-        get_db_connection, \
         assert_ok_dbname
+import control
 
 usage = """Usage: ovo stop <id: str>
+       ovo stop --host
+
+Stops the OvO game with the given id. The web server stops accepting connections and finishes
+the requests being served in `drain_timeout` seconds of the `[web]` section of /etc/ovo.conf
+(30 by default), the event streams are closed at once. Returns when the web server has exited
+(or fails in `timeout` seconds of the `[control]` section, 60 by default)
 
-Stops the OvO game with the given id
+A hosted game is unregistered from the host web server, which answers 404 to its new requests
+at once. `--host` stops the host web server, the hosted games stay registered and are served
+again when it's started with the next hosted game
 """
 
 def _main(game_id:str):
-    """Creates a stop-file for the game with the given id
+    """Stops the web server of the game with the given id, or unregisters the
+        game from the host web server
     Parameters:
         id (str): The game identifier
     """
     assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT files_folder FROM game_info')
-    folder, = c.fetchone()
-    Path(path.join(folder, 'exit')).touch()
-    sleep(1)
+    if control.stop(game_id):
+        return
+    if not control.unregister_game(game_id):
+        print("The game {} isn't running".format(game_id), file=stderr)
 
 def main(args):
     if is_help_request(args):
         print(usage, file=stderr)
         exit(0)
-    if(len(args) == 2):
+    if(len(args) == 2) and (args[1] == '--host'):
+        if not control.stop(None):
+            print("The host web server isn't running", file=stderr)
+    elif(len(args) == 2):
         _main(args[1])
     else:
         print("Wrong number of arguments. Try --help for usage", file=stderr)
@@ -0,0 +1,660 @@
+#!/usr/bin/python3
+import sys
+import json
+import shutil
+import asyncio
+from os import path, remove, getpid, kill, environ
+from signal import signal, getsignal, SIGTERM
+from functools import wraps, partial
+from contextlib import asynccontextmanager
+
+import aiomysql
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import Response, FileResponse, StreamingResponse
+from starlette.routing import Route
+
+sys.path.append(path.join(path.dirname(__file__), '../command_line'))
+from owo import add_file, add_user, add_comment, \
+        rm_comment, mark_user, mark_task, \
+        update_avatar, take_task, reject_task, \
+        authorize, create_upload, finish_upload, \
+        upload_path, content_path
+from common import _load_config, \
+        _load_mysql_auth_data, \
+        game_db_connection, \
+        get_principals_cache, \
+        forget_principal, \
+        generate_id, \
+        id_to_db, \
+        check_password, \
+        PasswordQueueFull
+import control
+import queries
+import uploads
+from uploads import UploadConflict, UploadNotFound
+from queries import check_given_params
+
+# The same API as main.py, but served by an asyncio event loop, so idle
+# connections don't take a thread each. The reads go through an async mysql
+# driver, the writes and bcrypt are run in the default executor
+
+GAME_INFO_POLL_INTERVAL = 5 # seconds
+EVENTS_POLL_INTERVAL = 1 # seconds
+EVENTS_HEARTBEAT = 15 # seconds
+DRAIN_TIMEOUT = 30 # seconds, the default of `[web] drain_timeout`
+
+async def run_sync(func, *args, **kwargs):
+    """Runs a blocking function in the default executor"""
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+async def fetch(query:str, values:tuple=(), one:bool=False):
+    """Executes a query on a pooled connection
+    Parameters:
+        query(str): The query
+        values(tuple, optional): The query values
+        one(bool, optional): If True, only the first row is returned
+    Returns:
+        list[tuple] or tuple or NoneType: The result (as fetchall() or fetchone())
+    """
+    async with app.state.pool.acquire() as db:
+        async with db.cursor() as c:
+            await c.execute(query, values)
+            return await (c.fetchone() if one else c.fetchall())
+
+async def get_game_info() -> dict:
+    """Returns the game info (see `main.get_game_info`). It's read from the
+        database once and then kept in memory (see `watch_game_info`)
+    """
+    if app.state.game_info is None:
+        app.state.game_info = queries.assemble_game_info(await fetch(queries.GAME_INFO_QUERY, one=True))
+    return dict(app.state.game_info[1])
+
+async def watch_game_info(interval:float):
+    """Reloads the game info whenever its version changes"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            version, = await fetch(queries.GAME_INFO_VERSION_QUERY, one=True)
+            if app.state.game_info is None or app.state.game_info[0] != version:
+                app.state.game_info = queries.assemble_game_info(await fetch(queries.GAME_INFO_QUERY, one=True))
+        except Exception as e:
+            print("Couldn't check the game info version ({})".format(e), file=sys.stderr)
+
+async def wait_events(after:int, timeout:float) -> list:
+    """Waits for the events after the given one (see `main.EventsFeed.wait`)"""
+    cond = app.state.events_cond
+    async with cond:
+        try:
+            await asyncio.wait_for(cond.wait_for(
+                lambda: app.state.draining or app.state.events.last_id > after), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return app.state.events.after(after)
+
+async def watch_events(interval:float):
+    """Polls the events table, wakes up the event streams and drops the cached
+        principals of the users marked or removed (see `main.EventsFeed`)
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            last_id = app.state.events.last_id
+            rows = await fetch(queries.EVENTS_QUERY, (last_id, queries.MAX_EVENT_ID))
+            logins = queries.principals_changed(rows)
+            if logins:
+                app.state.principals_epoch += 1
+                for login in logins:
+                    forget_principal(app.state.game_id, login)
+            if rows:
+                async with app.state.events_cond:
+                    app.state.events.add(rows)
+                    app.state.events_cond.notify_all()
+        except Exception as e:
+            print("Couldn't read the events ({})".format(e), file=sys.stderr)
+
+async def drain_events():
+    """Ends the event streams when the worker is stopping (see `main._drain_events`)"""
+    async with app.state.events_cond:
+        app.state.draining = True
+        app.state.events_cond.notify_all()
+
+async def get_principal(request, session_id:str) -> dict:
+    """Returns the minimal info about the session's user (see `main.get_principal`).
+        The result is memoized for the request and cached for a short time or
+        until `watch_events` sees the user marked or removed
+
+    Raises ValueError if the session id doesn't exist
+    """
+    if not hasattr(request.state, 'principals'):
+        request.state.principals = {}
+    memo = request.state.principals
+    if session_id in memo:
+        return memo[session_id]
+    cache = get_principals_cache()
+    principal = cache.get((app.state.game_id, session_id))
+    if principal is None:
+        epoch = app.state.principals_epoch
+        tmp = await fetch(queries.PRINCIPAL_QUERY, (id_to_db(session_id),), one=True)
+        if tmp is None:
+            raise ValueError("Invalid session id")
+        principal = queries.assemble_principal(tmp)
+        if app.state.principals_epoch == epoch: # See `main.get_principal`
+            cache.put((app.state.game_id, session_id), principal)
+    memo[session_id] = principal
+    return principal
+
+async def current_principal(request) -> dict:
+    """Returns `get_principal` for the session of the request"""
+    return await get_principal(request, request.cookies['session_id'])
+
+def _form_keys(form) -> set:
+    """Returns the keys of the form fields, except the uploaded files ones
+        (like flask.request.form.keys())
+    """
+    return {k for k, v in form.multi_items() if isinstance(v, str)}
+
+def assert_is_authorized(func):
+    """A decorator for the route functions. Responds with 403 status code
+        if the request came from an unauthorized user
+    """
+    @wraps(func)
+    async def ans(request):
+        try:
+            await current_principal(request)
+        except (KeyError, ValueError):
+            return Response(status_code=403)
+        return await func(request)
+
+    return ans
+
+def assert_ok_params(required:set, positional:set):
+    """Returns a decorator for the route functions. Responds with 400 status
+        code if the form parameters are not correct (see `main.assert_ok_params`)
+    """
+    def decorator(func):
+        @wraps(func)
+        async def ans(request):
+            if check_given_params(required, required.union(positional),
+                    _form_keys(await request.form())):
+                return await func(request)
+            return Response(status_code=400)
+
+        return ans
+
+    return decorator
+
+def assert_ok_args(required:set, positional:set):
+    """The same as `assert_ok_params`, but for the query string"""
+    def decorator(func):
+        @wraps(func)
+        async def ans(request):
+            if check_given_params(required, required.union(positional),
+                    set(request.query_params.keys())):
+                return await func(request)
+            return Response(status_code=400)
+
+        return ans
+
+    return decorator
+
+def with_versions_etag(*tables):
+    """The same as `main.with_versions_etag`"""
+    def decorator(func):
+        @wraps(func)
+        async def ans(request):
+            etag = queries.versions_etag(await fetch(queries.VERSIONS_QUERY), tables)
+            if queries.etag_matches(request.headers.get('If-None-Match'), etag):
+                resp = Response(status_code=304)
+            else:
+                resp = await func(request)
+                if resp.status_code != 200:
+                    return resp
+            resp.headers['ETag'] = etag
+            resp.headers['Cache-Control'] = 'no-cache'
+            return resp
+
+        return ans
+
+    return decorator
+
+def json_response(obj) -> Response:
+    return Response(json.dumps(obj))
+
+async def bad_value(request, e):
+    # Malformed identifiers, unknown entity types and so on
+    return Response('Bad request: {}'.format(e), status_code=400)
+
+async def upload_conflict(request, e):
+    return Response(json.dumps({'received': e.received}), status_code=409)
+
+async def upload_not_found(request, e):
+    return Response(status_code=404)
+
+async def password_queue_full(request, e):
+    return Response('Too many logins at once, try again later', status_code=503,
+            headers={'Retry-After': '1'})
+
+# ------ BEGIN NON-CONST API METHODS ------
+@assert_ok_params({'login', 'password'}, set())
+async def web_authorize(request):
+    try:
+        session_id = await run_sync(authorize, app.state.game_id, **(await request.form()))
+    except ValueError:
+        return Response(status_code=401)
+    resp = json_response(session_id)
+    resp.set_cookie('session_id', session_id)
+    return resp
+
+@assert_ok_params({'name'}, set())
+@assert_is_authorized
+async def web_add_file(request):
+    form = await request.form()
+    if set(form.keys()) - _form_keys(form) != {'file'}:
+        return Response(status_code=400)
+    f = form['file']
+    # The content is saved before the file is added, so it's never seen without it
+    tmp_path = upload_path((await get_game_info())['files_folder'], generate_id())
+    def save():
+        with open(tmp_path, 'wb') as out:
+            shutil.copyfileobj(f.file, out)
+        try:
+            return add_file(app.state.game_id, form.get('name', f.filename), silent=True, source=tmp_path)
+        finally:
+            if path.exists(tmp_path):
+                remove(tmp_path)
+    return json_response(await run_sync(save))
+
+@assert_ok_params({'name', 'size'}, {'sha256'})
+@assert_is_authorized
+async def web_create_upload(request):
+    # Starts a chunked upload (see `main.web_create_upload`)
+    form = await request.form()
+    size = int(form['size'])
+    return json_response(await run_sync(create_upload, app.state.game_id, form['name'], size,
+        form.get('sha256')))
+
+@assert_is_authorized
+async def web_upload_chunk(request):
+    # Writes a chunk of the upload (see `main.web_upload_chunk`)
+    game_id = app.state.game_id
+    upload_id = request.path_params['upload_id']
+    upload = await run_sync(uploads.get_upload, game_id, upload_id)
+    if upload is None:
+        return Response(status_code=404)
+    start, end = uploads.parse_content_range(request.headers.get('Content-Range'), upload['size'])
+    writer = await run_sync(uploads.ChunkWriter, game_id, upload_id,
+            (await get_game_info())['files_folder'], start)
+    try:
+        async for data in request.stream():
+            data = data[:end + 1 - writer.offset]
+            if data:
+                await run_sync(writer.write, data)
+            if writer.offset > end:
+                break
+    finally:
+        received = await run_sync(writer.close)
+    return json_response({'received': received})
+
+@assert_ok_params({'id'}, {'sha256'})
+@assert_is_authorized
+async def web_finish_upload(request):
+    # Makes a file of the complete upload (see `main.web_finish_upload`)
+    game_id = app.state.game_id
+    form = await request.form()
+    upload_id = form['id']
+    upload = await run_sync(uploads.get_upload, game_id, upload_id)
+    if upload is None:
+        return Response(status_code=404)
+    if upload['received'] != upload['size']:
+        raise UploadConflict(upload['received'])
+    digest = upload['sha256'] or await run_sync(uploads.upload_sha256, game_id, upload_id,
+            (await get_game_info())['files_folder'], upload['size'])
+    if form.get('sha256', digest).lower() != digest:
+        raise ValueError("The checksum doesn't match, {} received".format(digest))
+    file_id = await run_sync(finish_upload, game_id, upload_id, digest)
+    uploads.forget_upload(game_id, upload_id)
+    if file_id is None: # Finished by another request meanwhile
+        return Response(status_code=404)
+    return json_response({'id': file_id, 'sha256': digest})
+
+@assert_ok_params({'login', 'password', 'register_pass'},
+        {'captain_pass', 'avatar'})
+async def web_add_user(request):
+    form = await request.form()
+    game_info = await get_game_info()
+    if not await run_sync(check_password, form['register_pass'], game_info['register_pass']):
+        return Response(status_code=403)
+    args = {k: v for k, v in form.items() if k in {'login', 'password', 'avatar'}}
+    is_captain = False
+    if 'captain_pass' in form.keys():
+        if await run_sync(check_password, form['captain_pass'], game_info['captain_pass']):
+            is_captain = True
+        else:
+            return Response(status_code=403)
+    await run_sync(add_user, app.state.game_id, **args, is_captain=is_captain,
+            bcrypt_rounds=game_info['bcrypt_rounds'])
+    return Response('')
+
+@assert_ok_params({'task_id'}, {'text', 'files_ids'})
+@assert_is_authorized
+async def web_add_comment(request):
+    form = await request.form()
+    user_id = (await current_principal(request))['login']
+    args = {k: v for k, v in form.items() if k != 'files_ids'}
+    args['files_ids'] = form.getlist('files_ids')
+    return json_response(await run_sync(add_comment, app.state.game_id, user_id, **args))
+
+@assert_ok_params({'id'}, set())
+@assert_is_authorized
+async def web_rm_comment(request):
+    form = await request.form()
+    user_info = await current_principal(request)
+    comment_info = queries.assemble_comment(
+            await fetch(queries.COMMENT_QUERY, (id_to_db(form['id']),), one=True))
+    if comment_info is None:
+        return Response(status_code=404)
+    if user_info['is_captain'] or (user_info['login'] == comment_info['user_id']):
+        return json_response(await run_sync(rm_comment, app.state.game_id, form['id']))
+    return Response(status_code=403)
+
+@assert_ok_params({'login', 'new_type'}, set())
+@assert_is_authorized
+async def web_mark_user(request):
+    form = await request.form()
+    if not (await current_principal(request))['is_captain']:
+        return Response(status_code=403)
+    await run_sync(mark_user, app.state.game_id, form['login'], form['new_type'])
+    return Response('')
+
+@assert_ok_params({'id', 'new_type'}, set())
+@assert_is_authorized
+async def web_mark_task(request):
+    form = await request.form()
+    await run_sync(mark_task, app.state.game_id, form['id'], form['new_type'])
+    return Response('')
+
+@assert_ok_params({'avatar'}, set())
+@assert_is_authorized
+async def web_update_avatar(request):
+    form = await request.form()
+    user_id = (await current_principal(request))['login']
+    await run_sync(update_avatar, app.state.game_id, user_id, form['avatar'])
+    return Response('')
+
+def _take_or_reject(func):
+    @assert_ok_params({'task_id', 'user_id'}, set())
+    @assert_is_authorized
+    async def ans(request):
+        form = await request.form()
+        user_info = await current_principal(request)
+        if user_info['is_captain'] or (user_info['login'] == form['user_id']):
+            await run_sync(func, app.state.game_id, task_id=form['task_id'], user_id=form['user_id'])
+            return Response('')
+        return Response(status_code=403)
+
+    return ans
+# ------ END NON-CONST API METHODS ------
+
+async def file_path_and_name(file_id:str) -> tuple:
+    """Returns a path to the file and it's original name, (None, None) if
+        the file doesn't exist
+    """
+    row = await fetch(queries.FILE_NAME_QUERY, (id_to_db(file_id),), one=True)
+    if row is None:
+        return (None, None)
+    return (content_path((await get_game_info())['files_folder'], file_id, row[1]), row[0])
+
+# ------ BEGIN CONST API METHODS ------
+@assert_is_authorized
+async def web_get_upload(request):
+    # The state of a chunked upload (see `main.web_get_upload`)
+    upload = await run_sync(uploads.get_upload, app.state.game_id, request.path_params['upload_id'])
+    if upload is None:
+        return Response(status_code=404)
+    return json_response(upload)
+
+async def send_game_file(request, as_attachment:bool) -> Response:
+    """Makes the response with the file content (see `main.send_game_file`).
+        Starlette serves Range and uses the zero-copy send of the server if it has one
+    """
+    file_path, name = await file_path_and_name(request.path_params['file_id'])
+    if file_path is None:
+        return Response(status_code=404)
+    headers = queries.file_cache_headers(file_path)
+    if queries.etag_matches(request.headers.get('If-None-Match'), headers['ETag']):
+        return Response(status_code=304, headers=headers)
+    offload = queries.file_offload_headers(file_path, name, as_attachment)
+    if offload is not None:
+        return Response(headers=offload)
+    return FileResponse(file_path, filename=name if as_attachment else None, headers=headers)
+
+@assert_is_authorized
+async def web_get_file(request):
+    return await send_game_file(request, False)
+
+@assert_is_authorized
+async def web_download_file(request):
+    return await send_game_file(request, True)
+
+@assert_is_authorized
+@with_versions_etag('users', 'solvings')
+async def web_get_user_info(request):
+    users_ids = [request.path_params['user_id']]
+    rows = await fetch(*queries.users_query(users_ids))
+    return json_response(queries.assemble_users(rows, users_ids)[0])
+
+@assert_is_authorized
+@with_versions_etag('users', 'solvings')
+async def web_get_users(request):
+    return json_response(queries.assemble_users(await fetch(*queries.users_query())))
+
+async def _get_tasks_info(tasks_ids:list=None) -> list:
+    tasks_queries = queries.tasks_queries(tasks_ids)
+    if tasks_queries is None:
+        return []
+    tasks_query, solvings_query, values = tasks_queries
+    return queries.assemble_tasks(await fetch(tasks_query, values),
+            await fetch(solvings_query, values), tasks_ids)
+
+@assert_is_authorized
+@with_versions_etag('tasks', 'solvings', 'users')
+async def web_get_task_info(request):
+    task_id = request.path_params['task_id']
+    id_to_db(task_id) # A malformed id is an error, see `main.get_task_info`
+    tasks = await _get_tasks_info([task_id])
+    if not tasks:
+        return Response(status_code=404)
+    return json_response(tasks[0])
+
+@assert_ok_args(set(), {'ids'})
+@assert_is_authorized
+@with_versions_etag('tasks', 'solvings', 'users')
+async def web_get_tasks(request):
+    if 'ids' in request.query_params.keys():
+        return json_response(await _get_tasks_info(queries.split_ids(request.query_params.getlist('ids'))))
+    return json_response(await _get_tasks_info())
+
+@assert_is_authorized
+@with_versions_etag('solvings', 'users')
+async def web_get_solvings(request):
+    return json_response(queries.assemble_solvings(await fetch(queries.SOLVINGS_QUERY)))
+
+@assert_is_authorized
+@with_versions_etag('files')
+async def web_get_file_info(request):
+    return json_response((await file_path_and_name(request.path_params['file_id']))[1])
+
+@assert_is_authorized
+@with_versions_etag('files')
+async def web_get_files(request):
+    return json_response(queries.assemble_files(await fetch(queries.FILES_QUERY)))
+
+@assert_is_authorized
+@with_versions_etag('comments', 'users')
+async def web_get_comment_info(request):
+    row = await fetch(queries.COMMENT_QUERY, (id_to_db(request.path_params['comment_id']),), one=True)
+    if row is None:
+        return Response(status_code=404)
+    return json_response(queries.assemble_comment(row))
+
+@assert_ok_args(set(), {'task_id', 'limit', 'cursor'})
+@assert_is_authorized
+@with_versions_etag('comments', 'users')
+async def web_get_comments(request):
+    # If there are more comments than `limit`, the next page cursor is sent in X-Next-Cursor
+    args = request.query_params
+    try:
+        limit = args.get('limit')
+        if limit is not None:
+            limit = min(queries.positive_int(limit), queries.MAX_COMMENTS_PAGE)
+        query, values = queries.comments_query(args.get('task_id'), limit, args.get('cursor'))
+    except ValueError:
+        return Response(status_code=400)
+    comments, next_cursor = queries.assemble_comments(await fetch(query, values), limit)
+    resp = json_response(comments)
+    if next_cursor is not None:
+        resp.headers['X-Next-Cursor'] = next_cursor
+    return resp
+
+@assert_ok_args(set(), {'last_event_id'})
+@assert_is_authorized
+async def web_events(request):
+    # Server-sent events stream of the game changes (see `main.web_events`)
+    try:
+        after = queries.parse_event_id(request.headers.get('Last-Event-ID',
+            request.query_params.get('last_event_id')))
+    except ValueError:
+        return Response(status_code=400)
+    if after is None:
+        after = app.state.events.last_id
+
+    async def stream(after):
+        while True:
+            rows = await wait_events(after, EVENTS_HEARTBEAT)
+            if app.state.draining:
+                return
+            if rows is None: # Resuming from an old event
+                last_id = app.state.events.last_id
+                rows = await fetch(queries.EVENTS_QUERY, (after, last_id))
+                if after < (await fetch(queries.EVENTS_COMPACTED_QUERY, one=True))[0]:
+                    yield queries.resync_event(last_id)
+                    after = last_id
+                    continue
+            if not rows:
+                yield ': heartbeat\n\n'
+            for row in rows:
+                yield queries.format_event(row)
+                after = row[0]
+
+    return StreamingResponse(stream(after), media_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@assert_ok_args({'since'}, set())
+@assert_is_authorized
+async def web_changes(request):
+    # The changes happened after the `since` event (see `main.web_changes`)
+    try:
+        since = queries.parse_event_id(request.query_params['since'])
+    except ValueError:
+        return Response(status_code=400)
+    last_id = app.state.events.last_id
+    rows = app.state.events.after(since)
+    compacted = 0
+    newest = None
+    if since > last_id: # Given by another worker (see `main.web_changes`)
+        newest = (await fetch(queries.LAST_EVENT_QUERY, one=True))[0]
+    elif rows is None:
+        rows = await fetch(queries.EVENTS_QUERY, (since, last_id))
+        compacted = (await fetch(queries.EVENTS_COMPACTED_QUERY, one=True))[0]
+    return json_response(queries.assemble_changes(rows or [], since, last_id, compacted, newest))
+# ------ END CONST API METHODS ------
+
+@asynccontextmanager
+async def lifespan(app):
+    game_id = app.state.game_id = environ['OVO_GAME_ID']
+    mysql_username, mysql_password = _load_mysql_auth_data()
+    app.state.pool = await aiomysql.create_pool(
+            host='localhost',
+            user=mysql_username,
+            password=mysql_password,
+            db='OvO_' + game_id,
+            maxsize=_load_config().getint('pool', 'size', fallback=8),
+            autocommit=True
+            )
+    app.state.game_info = None
+    app.state.events = queries.RecentEvents((await fetch(queries.LAST_EVENT_QUERY, one=True))[0])
+    app.state.events_cond = asyncio.Condition()
+    app.state.principals_epoch = 0
+    app.state.draining = False
+    # On SIGTERM uvicorn stops accepting connections and finishes the requests
+    # being served in `timeout_graceful_shutdown` seconds, the event streams end at once
+    loop = asyncio.get_running_loop()
+    handle_exit = getsignal(SIGTERM)
+    if callable(handle_exit):
+        def drain(sig, frame):
+            loop.call_soon_threadsafe(asyncio.ensure_future, drain_events())
+            handle_exit(sig, frame)
+        signal(SIGTERM, drain)
+    watchers = [asyncio.ensure_future(watch_game_info(GAME_INFO_POLL_INTERVAL)),
+            asyncio.ensure_future(watch_events(EVENTS_POLL_INTERVAL))]
+    await run_sync(control.notify_ready, game_id)
+    try:
+        yield
+    finally:
+        for watcher in watchers:
+            watcher.cancel()
+        app.state.pool.close()
+        await app.state.pool.wait_closed()
+
+app = Starlette(
+        routes=[
+            Route('/api/authorize', web_authorize, methods=['POST']),
+            Route('/api/add_file', web_add_file, methods=['POST']),
+            Route('/api/create_upload', web_create_upload, methods=['POST']),
+            Route('/api/upload/{upload_id}', web_upload_chunk, methods=['PUT']),
+            Route('/api/upload/{upload_id}', web_get_upload),
+            Route('/api/finish_upload', web_finish_upload, methods=['POST']),
+            Route('/api/add_user', web_add_user, methods=['POST']),
+            Route('/api/add_comment', web_add_comment, methods=['POST']),
+            Route('/api/rm_comment', web_rm_comment, methods=['POST']),
+            Route('/api/mark_user', web_mark_user, methods=['POST']),
+            Route('/api/mark_task', web_mark_task, methods=['POST']),
+            Route('/api/update_avatar', web_update_avatar, methods=['POST']),
+            Route('/api/take_task', _take_or_reject(take_task), methods=['POST']),
+            Route('/api/reject_task', _take_or_reject(reject_task), methods=['POST']),
+            Route('/api/get_file/{file_id}', web_get_file),
+            Route('/api/download_file/{file_id}', web_download_file),
+            Route('/api/get_user_info/{user_id}', web_get_user_info),
+            Route('/api/get_users', web_get_users),
+            Route('/api/get_task_info/{task_id}', web_get_task_info),
+            Route('/api/get_tasks', web_get_tasks),
+            Route('/api/get_solvings', web_get_solvings),
+            Route('/api/get_file_name/{file_id}', web_get_file_info),
+            Route('/api/get_files', web_get_files),
+            Route('/api/get_comment_info/{comment_id}', web_get_comment_info),
+            Route('/api/get_comments', web_get_comments),
+            Route('/api/events', web_events),
+            Route('/api/changes', web_changes)
+            ],
+        exception_handlers={ValueError: bad_value, PasswordQueueFull: password_queue_full,
+            UploadConflict: upload_conflict, UploadNotFound: upload_not_found},
+        lifespan=lifespan
+        )
+
+if __name__ == "__main__":
+    # The workers import this module by themselves, so the game id is passed in the environment
+    environ['OVO_GAME_ID'] = game_id = sys.argv[1]
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute(queries.GAME_INFO_QUERY)
+        version, game_info = queries.assemble_game_info(c.fetchone())
+    # The main process (the only one or the supervisor of the workers) answers
+    # `ovo run` and `ovo stop`, the workers tell it when their startup is complete
+    control_server = control.ControlServer(game_id, lambda: kill(getpid(), SIGTERM))
+    try:
+        uvicorn.run('asgi:app', host='0.0.0.0', port=game_info['port'], workers=game_info['workers'],
+                timeout_graceful_shutdown=_load_config().getint('web', 'drain_timeout', fallback=DRAIN_TIMEOUT),
+                app_dir=path.dirname(path.abspath(__file__)))
+    finally:
+        control_server.stopped()
@@ -1,40 +1,121 @@
 #!/usr/bin/python3
 import sys
 import json
-from os import path, _exit
+from os import path, remove, stat, getpid, kill
+from signal import signal, siginterrupt, SIGTERM
+from time import sleep
+from threading import Thread, Condition, Lock, BoundedSemaphore
 from functools import wraps
 
 import flask
-import bcrypt
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from gunicorn.app.base import BaseApplication
 
 sys.path.append(path.join(path.dirname(__file__), '../command_line'))
 from owo import add_file, add_user, add_comment, \
         rm_comment, mark_user, mark_task, \
         update_avatar, take_task, reject_task, \
-        authorize
-from common import get_db_connection, \
-        assert_ok_dbname
-
-game_id = None # Must be replaced when executing
+        authorize, create_upload, finish_upload, \
+        upload_path, content_path
+from common import _load_config, \
+        game_db_connection, \
+        close_game_connections, \
+        get_principals_cache, \
+        forget_principal, \
+        generate_id, \
+        id_to_db, \
+        check_password, \
+        PasswordQueueFull
+import control
+import queries
+import uploads
+from uploads import UploadConflict, UploadNotFound
+from queries import check_given_params
+
+GAME_INFO_POLL_INTERVAL = 5 # seconds
+WORKER_THREADS = 8 # Per worker process
+DRAIN_TIMEOUT = 30 # seconds, the default of `[web] drain_timeout`
+HOST_PORT = 8000 # The default of `[host] port`
+EVENTS_POLL_INTERVAL = 1 # seconds
+EVENTS_HEARTBEAT = 15 # seconds
+MAX_EVENT_STREAMS = 256 # Per worker process, the default of `[web] max_event_streams`
+
+_game_info_cache = {} # game_id -> (version, game info)
+_hosted_games = (None, frozenset()) # (the list file stat, the games), see `is_served`
+# Every event stream takes a worker thread for the whole connection, so the workers
+# have that many threads more than `WORKER_THREADS` and the streams are limited to
+# them, never taking the threads of the other requests. The waiting threads cost
+# only their (mostly virtual) stacks
+_max_event_streams = max(_load_config().getint('web', 'max_event_streams', fallback=MAX_EVENT_STREAMS), 0)
+_event_streams = BoundedSemaphore(_max_event_streams)
 
 app = flask.Flask(__name__)
+app.config['GAME_ID'] = None # Must be replaced when executing, except the host server
 
-def _parse_mysql_vomit(vomit:list) -> list:
-    """Takes mysql's cursor's fetchall() result and returns it beautified
-            if there was one field in SELECT, otherwise raises a ValueError
+def current_game_id() -> str:
+    """Returns the identifier of the game the request is for (see `GameDispatcher`),
+        the game served by the app outside the requests
+    """
+    if flask.has_request_context():
+        return flask.request.environ.get('ovo.game_id', app.config['GAME_ID'])
+    return app.config['GAME_ID']
+
+def is_served(game_id:str) -> bool:
+    """Tells if the app serves the game: the only game of the app or, for the
+        host server, a game registered with it (see `control.register_game`).
+        The list of the registered games is only reread when its file changes
+    Parameters:
+        game_id(str): The game identifier
+    Returns:
+        bool: True if the game is served
+    """
+    global _hosted_games
+    if app.config['GAME_ID'] is not None:
+        return game_id == app.config['GAME_ID']
+    try:
+        file_stat = stat(control.hosted_games_path())
+    except FileNotFoundError:
+        return False
+    key = (file_stat.st_ino, file_stat.st_mtime_ns)
+    if _hosted_games[0] != key:
+        _hosted_games = (key, frozenset(control.hosted_games()))
+    return game_id in _hosted_games[1]
+
+class GameDispatcher:
+    """Routes the requests to the host server by the path prefix:
+        /g/<game id>/api/... is /api/... of the game, if it's registered
+    Parameters:
+        wsgi_app: The WSGI application of the games
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        parts = environ.get('PATH_INFO', '').split('/', 3)
+        if len(parts) < 3 or parts[1] != 'g' or not is_served(parts[2]):
+            start_response('404 NOT FOUND', [('Content-Type', 'text/plain')])
+            return [b'Unknown game']
+        environ['ovo.game_id'] = parts[2]
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + '/g/' + parts[2]
+        environ['PATH_INFO'] = '/' + (parts[3] if len(parts) > 3 else '')
+        return self.wsgi_app(environ, start_response)
+
+def get_users_info(users_ids:list=None) -> list:
+    """Returns the info of several users. Makes one query, no matter
+        how many users there are
     Parameters:
-        vomit(list[tuple[X]]): A mysql's cursor's fetchall() result
+        users_ids(list[str], optional): The users identifiers. If not specified,
+            all the users are returned
     Returns:
-        list[X]: The beautified result as a map object (see examples below)
-    Examples:
-        list(_parse_mysql_vomit([(1,), (2,), ("x",)])) == [1, 2, "x"]
-        list(_parse_mysql_vomit([(1, 2), (3, 4)])) -> ValueError
+        list[dict]: The users info (see `get_user_info`). If `users_ids` is
+            specified, the users are in the same order, the placeholder
+            dict is given for the users which don't exist
     """
-    if not all(map(lambda x: len(x) == 1, vomit)):
-        raise ValueError("Only one field must be requested in the sql query")
-    return map(lambda x: x[0], vomit)
+    if users_ids is not None and len(users_ids) == 0:
+        return []
+    with game_db_connection(current_game_id()) as db:
+        c = db.cursor()
+        c.execute(*queries.users_query(users_ids))
+        return queries.assemble_users(c.fetchall(), users_ids)
 
 def get_user_info(user_id:str) -> dict:
     """Returns the user info like a dict
@@ -51,19 +132,29 @@ def get_user_info(user_id:str) -> dict:
         {'login': 'DELETED', 'is_captain': False, 'avatar': None,
         'solving': []}
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT is_captain, avatar FROM users WHERE login=(%s)',
-            (user_id,))
-    user_info = c.fetchone()
-    if user_info is None:
-        return {'login': 'DELETED', 'is_captain': False, 'avatar': None, 'solving': []}
-    else:
-        c.execute('SELECT task_id FROM solvings WHERE user_id=(%s)', (user_id,))
-        return {'login': user_id, 'is_captain': (True if user_info[0] == 'Y' else False),
-                'avatar': user_info[1], 'solving': list(_parse_mysql_vomit(c.fetchall()))}
+    return get_users_info([user_id])[0]
+
+def get_tasks_info(tasks_ids:list=None) -> list:
+    """Returns the info of several tasks. Makes a constant number of queries,
+        no matter how many tasks there are
+    Parameters:
+        tasks_ids(list[str], optional): The tasks identifiers. If not specified,
+            all the tasks are returned
+    Returns:
+        list[dict]: The tasks info (see `get_task_info`). If `tasks_ids` is
+            specified, the tasks are in the same order, unknown ids are skipped
+    """
+    tasks_queries = queries.tasks_queries(tasks_ids)
+    if tasks_queries is None:
+        return []
+    tasks_query, solvings_query, values = tasks_queries
+    with game_db_connection(current_game_id()) as db:
+        c = db.cursor()
+        c.execute(tasks_query, values)
+        tasks_rows = c.fetchall()
+        c.execute(solvings_query, values)
+        solvings_rows = c.fetchall()
+    return queries.assemble_tasks(tasks_rows, solvings_rows, tasks_ids)
 
 def get_task_info(task_id:str) -> dict:
     """Returns the task info like a dict
@@ -78,18 +169,34 @@ def get_task_info(task_id:str) -> dict:
             original_id(str or NoneType) - The task identifier on main platform
             text(str or NoneType) - The task text
             solvers(list[str]) - ids of users, who took the task
+        NoneType: If the task doesn't exist
+
+    Raises ValueError if the id is malformed
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT * FROM tasks WHERE id=(%s)', (task_id,))
-    ans = dict(zip(['id', 'name', 'is_solved', 'original_link', 'original_id', 'text'],
-            c.fetchone()))
-    ans['is_solved'] = True if ans['is_solved'] == 'Y' else False
-    c.execute('SELECT user_id FROM solvings WHERE task_id=(%s)', (task_id,))
-    ans['solvers'] = list(_parse_mysql_vomit(c.fetchall()))
-    return ans
+    id_to_db(task_id) # Unlike the ids list of `get_tasks_info`, a malformed id is an error
+    tasks = get_tasks_info([task_id])
+    return tasks[0] if tasks else None
+
+def get_comments_info(task_id:str=None, limit:int=None, cursor:str=None) -> tuple:
+    """Returns a page of comments in the creation order. Makes one query
+    Parameters:
+        task_id(str, optional): If specified, only the comments to this task are returned
+        limit(int, optional): The max number of comments to be returned. If not
+            specified, all the (remaining) comments are returned
+        cursor(str, optional): The cursor got with the previous page
+    Returns:
+        tuple: (comments, next_cursor), where comments is a list of dicts
+            (see `get_comment_info`) and next_cursor is the cursor for the next
+            page or None if there are no more comments
+
+    Raises ValueError if the cursor is malformed
+    """
+    query, values = queries.comments_query(task_id, limit, cursor)
+    with game_db_connection(current_game_id()) as db:
+        c = db.cursor()
+        c.execute(query, values)
+        rows = c.fetchall()
+    return queries.assemble_comments(rows, limit)
 
 def get_comment_info(comment_id:str) -> dict:
     """Returns the comment info like a dict
@@ -99,21 +206,31 @@ def get_comment_info(comment_id:str) -> dict:
         dict: A dict with the following keys:
             id(str) - The comment identifier
             task_id(str) - The identifier of the task the comment attached to
-            user_id(str) - The comment's author identifier
+            user_id(str) - The comment's author login ('DELETED' if the user was removed)
             text(str or NoneType) - The comment text
             attached_files(list[str]) - A list of ids of files attached to the comment
+        NoneType: If the comment doesn't exist
+
+    Raises ValueError if the id is malformed
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT * FROM comments WHERE id=(%s)', (comment_id,))
-    ans = dict(zip(['id', 'task_id', 'user_id', 'text', 'attached_files'], c.fetchone()))
-    ans['attached_files'] = json.loads(ans['attached_files'])
-    return ans
+    with game_db_connection(current_game_id()) as db:
+        c = db.cursor()
+        c.execute(queries.COMMENT_QUERY, (id_to_db(comment_id),))
+        return queries.assemble_comment(c.fetchone())
+
+def _load_game_info(game_id:str) -> tuple:
+    """Reads the game info from the database
+    Returns:
+        tuple: (version, game_info), see `get_game_info`
+    """
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute(queries.GAME_INFO_QUERY)
+        return queries.assemble_game_info(c.fetchone())
 
 def get_game_info() -> dict:
-    """Returns the game info as a dict
+    """Returns the game info as a dict. The info is read from the database
+        once and then kept in memory (see `watch_game_info`)
     Returns:
         dict: A dict with the following keys:
             port(int) - The network port to run web interface on
@@ -124,35 +241,182 @@ def get_game_info() -> dict:
             judge_url(str or NoneType) - The main platform URL
             judge_login(str or NoneType) - A username for the main platform
             judge_pass(str or NoneType) - A password for the main platform
+            bcrypt_rounds(int) - The bcrypt cost for the game passwords
+            workers(int) - The number of the web server worker processes
+            engine(str) - The web application serving the game: sync, async
+                or hosted (by the host server)
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT * FROM game_info')
-    ans = dict(zip(['port', 'files_folder', 'register_pass', 'captain_pass', \
-            'judge_url', 'judge_login', 'judge_pass'], c.fetchone()))
-    return ans
-
-def get_user_info_s(session_id:str) -> dict:
-    """Returns the user info by his session id
+    game_id = current_game_id()
+    cached = _game_info_cache.get(game_id)
+    if cached is None:
+        cached = _game_info_cache[game_id] = _load_game_info(game_id)
+    return dict(cached[1])
+
+def watch_game_info(interval:float):
+    """Reloads the cached game info of every game whenever its version changes
+        (i. e. the game was rerun with new values). The games that aren't served
+        anymore are forgotten. Runs forever, so it's supposed to be called in
+        a background thread, not by request handlers
+    Parameters:
+        interval(float): Number of seconds between the version checks
+    """
+    while True:
+        sleep(interval)
+        for game_id, cached in list(_game_info_cache.items()):
+            if not is_served(game_id):
+                del _game_info_cache[game_id]
+                close_game_connections(game_id)
+                continue
+            try:
+                with game_db_connection(game_id) as db:
+                    c = db.cursor()
+                    c.execute(queries.GAME_INFO_VERSION_QUERY)
+                    version, = c.fetchone()
+                if cached[0] != version:
+                    _game_info_cache[game_id] = _load_game_info(game_id)
+            except Exception as e:
+                print("Couldn't check the game {} info version ({})".format(game_id, e), file=sys.stderr)
+
+class EventsFeed:
+    """Polls the events table in one background thread per process and wakes
+        up the event streams, so the database load doesn't depend on the
+        number of clients. It also drops the cached principals of the users
+        marked or removed by any process (see `get_principal`)
+    Parameters:
+        game_id(str): The game identifier
+        interval(float): Number of seconds between the polls
+    """
+    def __init__(self, game_id:str, interval:float):
+        self.game_id = game_id
+        self.interval = interval
+        self.draining = False
+        self.principals_epoch = 0 # Incremented whenever principals are dropped
+        with game_db_connection(game_id) as db:
+            c = db.cursor()
+            c.execute(queries.LAST_EVENT_QUERY)
+            self._recent = queries.RecentEvents(c.fetchone()[0])
+        self._cond = Condition()
+        Thread(target=self._run, daemon=True).start()
+
+    def last_id(self) -> int:
+        """Returns the id of the last event known"""
+        with self._cond:
+            return self._recent.last_id
+
+    def wait(self, after:int, timeout:float) -> list:
+        """Waits for the events after the given one
+        Parameters:
+            after(int): The event id
+            timeout(float): Max number of seconds to wait
+        Returns:
+            list[tuple] or NoneType: The events (empty if there are no new ones
+                or the process is draining), see `queries.RecentEvents.after`
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.draining or self._recent.last_id > after, timeout)
+            return self._recent.after(after)
+
+    def after(self, after:int) -> tuple:
+        """Returns the events after the given one without waiting
+        Returns:
+            tuple: (the id of the last event known, the events or None,
+                see `queries.RecentEvents.after`)
+        """
+        with self._cond:
+            return (self._recent.last_id, self._recent.after(after))
+
+    def drain(self):
+        """Wakes up the waiting streams for them to end, see `_drain_events`"""
+        with self._cond:
+            self.draining = True
+            self._cond.notify_all()
+
+    def _run(self):
+        game_id = self.game_id
+        while True:
+            sleep(self.interval)
+            if not is_served(game_id): # Unregistered from the host server
+                with _events_feeds_lock:
+                    _events_feeds.pop(game_id, None)
+                # The events aren't watched anymore, the next feed starts without the cache
+                forget_principal(game_id)
+                self.drain()
+                return
+            try:
+                with game_db_connection(game_id) as db:
+                    c = db.cursor()
+                    c.execute(queries.EVENTS_QUERY, (self._recent.last_id, queries.MAX_EVENT_ID))
+                    rows = c.fetchall()
+                logins = queries.principals_changed(rows)
+                if logins:
+                    self.principals_epoch += 1
+                    for login in logins:
+                        forget_principal(game_id, login)
+                if rows:
+                    with self._cond:
+                        self._recent.add(rows)
+                        self._cond.notify_all()
+            except Exception as e:
+                print("Couldn't read the events ({})".format(e), file=sys.stderr)
+
+_events_feeds = {} # game_id -> EventsFeed
+_events_feeds_lock = Lock()
+
+def get_events_feed(game_id:str) -> EventsFeed:
+    """Starts the events feed of the game in the process on the first call"""
+    with _events_feeds_lock:
+        if game_id not in _events_feeds:
+            _events_feeds[game_id] = EventsFeed(game_id, EVENTS_POLL_INTERVAL)
+        return _events_feeds[game_id]
+
+def _drain_events():
+    """Ends the event streams of the process when it's stopping, otherwise they
+        would hold the drain until the deadline. The clients reconnect with
+        Last-Event-ID and get the events they missed
+    """
+    with _events_feeds_lock:
+        feeds = list(_events_feeds.values())
+    for feed in feeds:
+        feed.drain()
+
+def get_principal(session_id:str) -> dict:
+    """Returns the minimal info about the session's user. The result is
+        memoized for the current request and cached for a short time or until
+        the events feed sees the user marked or removed
     Parameters:
         session_id(str): The session identifier
     Returns:
-        dict: User info (got from `get_user_info`)
+        dict: A dict with the following keys:
+            login(str) - the user login
+            is_captain(bool) - if the user is a captain
 
     Raises ValueError if the session id doesn't exist
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT user_id FROM session_data WHERE session_id=(%s)',
-            (session_id,))
-    tmp = c.fetchone()
-    if tmp is None:
-        raise ValueError("Invalid session id")
-    return get_user_info(tmp[0])
+    memo = flask.g.setdefault('principals', {})
+    if session_id in memo:
+        return memo[session_id]
+    cache = get_principals_cache()
+    game_id = current_game_id()
+    principal = cache.get((game_id, session_id))
+    if principal is None:
+        feed = get_events_feed(game_id)
+        epoch = feed.principals_epoch
+        with game_db_connection(game_id) as db:
+            c = db.cursor()
+            c.execute(queries.PRINCIPAL_QUERY, (id_to_db(session_id),))
+            tmp = c.fetchone()
+        if tmp is None:
+            raise ValueError("Invalid session id")
+        principal = queries.assemble_principal(tmp)
+        cache.put((game_id, session_id), principal)
+        if feed.principals_epoch != epoch: # It may be read before a change the feed has dropped already
+            cache.pop((game_id, session_id))
+    memo[session_id] = principal
+    return principal
+
+def current_principal() -> dict:
+    """Returns `get_principal` for the session of the current request"""
+    return get_principal(flask.request.cookies['session_id'])
 
 def assert_is_authorized(func):
     """A decorator for flask route functions.
@@ -163,7 +427,7 @@ def assert_is_authorized(func):
     @wraps(func)
     def ans(*args, **kwargs):
         try:
-            get_user_info_s(flask.request.cookies['session_id'])
+            current_principal()
         except (KeyError, ValueError):
             return flask.abort(403)
 
@@ -171,27 +435,6 @@ def assert_is_authorized(func):
 
     return ans
 
-def check_given_params(required_params:set,
-        all_params:set, given_params:set) -> bool:
-    """Checks if all the required params where given
-        and all the given params are valid
-    Parameters:
-        required_params(set): The set of params keys
-            required for the method
-        all_params(set): The set of valid params keys
-            for the method
-        given_params(set): The set of given params keys
-    Returns:
-        bool: True, if the given params are correct,
-            otherwise False
-    """
-    if len(required_params.intersection(given_params)) < \
-            len(required_params):
-        return False
-    if len(given_params - all_params) > 0:
-        return False
-    return True
-
 def assert_ok_params(required:set, positional:set):
     """Returns a decorator for flask route functions.
         Interrupts with 400 status code if the request
@@ -222,6 +465,85 @@ def assert_ok_params(required:set, positional:set):
 
     return decorator
 
+def assert_ok_args(required:set, positional:set):
+    """Returns a decorator for flask route functions.
+        Interrupts with 400 status code if the query string
+        arguments are not correct. Same as `assert_ok_params`,
+        but for the query string instead of the form
+    Parameters:
+        required(set): A set of arguments required for
+            the api method
+        positional(set): A set of poistional arguments for
+            the api method
+    """
+    def decorator(func):
+        @wraps(func)
+        def ans(*args, **kwargs):
+            if check_given_params(
+                    required,
+                    required.union(positional),
+                    set(flask.request.args.keys())
+                    ):
+                return func(*args, **kwargs)
+            else:
+                return flask.abort(400)
+
+        return ans
+
+    return decorator
+
+def with_versions_etag(*tables):
+    """Returns a decorator for flask route functions.
+        Sets the ETag of the response made of the versions
+        of the given tables and answers 304 without calling
+        the route function if the client's If-None-Match
+        matches it
+    Parameters:
+        tables(str): The tables the response depends on
+    """
+    def decorator(func):
+        @wraps(func)
+        def ans(*args, **kwargs):
+            # The versions are read before the data, so a change made in between
+            # can only make the ETag stale, not the data
+            with game_db_connection(current_game_id()) as db:
+                c = db.cursor()
+                c.execute(queries.VERSIONS_QUERY)
+                etag = queries.versions_etag(c.fetchall(), tables)
+            if queries.etag_matches(flask.request.headers.get('If-None-Match'), etag):
+                resp = app.make_response(('', 304))
+            else:
+                resp = app.make_response(func(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+            resp.headers['ETag'] = etag
+            resp.headers['Cache-Control'] = 'no-cache'
+            return resp
+
+        return ans
+
+    return decorator
+
+@app.errorhandler(ValueError)
+def bad_value(e):
+    # Malformed identifiers, unknown entity types and so on
+    return app.make_response(('Bad request: {}'.format(e), 400))
+
+@app.errorhandler(PasswordQueueFull)
+def password_queue_full(e):
+    resp = app.make_response(('Too many logins at once, try again later', 503))
+    resp.headers['Retry-After'] = '1'
+    return resp
+
+@app.errorhandler(UploadConflict)
+def upload_conflict(e):
+    # The client resumes the upload from `received`
+    return app.make_response((json.dumps({'received': e.received}), 409))
+
+@app.errorhandler(UploadNotFound)
+def upload_not_found(e):
+    return app.make_response(('Not found', 404))
+
 # UI:
 pass
 
@@ -231,11 +553,12 @@ pass
 @assert_ok_params({'login', 'password'}, set())
 def web_authorize():
     try:
-        session_id = authorize(game_id, **flask.request.form)
+        session_id = authorize(current_game_id(), **flask.request.form)
         resp = app.make_response(
                 json.dumps(session_id)
                 )
-        resp.set_cookie('session_id', session_id)
+        # The games of the host server share the origin, so the cookie is kept under the game prefix
+        resp.set_cookie('session_id', session_id, path=flask.request.script_root + '/')
         return resp
     except ValueError:
         return flask.abort(401)
@@ -247,50 +570,108 @@ def web_add_file():
     if set(flask.request.files.keys()) != {'file'}:
         return flask.abort(400)
     f = flask.request.files['file']
-    file_id = add_file(game_id, flask.request.form.get('name', f.filename), silent=True)
-    f.save(path.join(get_game_info()['files_folder'], file_id))
+    # The content is saved before the file is added, so it's never seen without it
+    tmp_path = upload_path(get_game_info()['files_folder'], generate_id())
+    f.save(tmp_path)
+    try:
+        file_id = add_file(current_game_id(), flask.request.form.get('name', f.filename),
+                silent=True, source=tmp_path)
+    finally:
+        if path.exists(tmp_path):
+            remove(tmp_path)
     return json.dumps(file_id)
 
+@app.route('/api/create_upload', methods=['POST'])
+@assert_ok_params({'name', 'size'}, {'sha256'})
+@assert_is_authorized
+def web_create_upload():
+    # Starts a chunked upload, see uploads.py. If the content with the given sha256
+    # is in the game already, the upload is complete at once
+    size = int(flask.request.form['size'])
+    return json.dumps(create_upload(current_game_id(), flask.request.form['name'], size,
+        flask.request.form.get('sha256')))
+
+@app.route('/api/upload/<upload_id>', methods=['PUT'])
+@assert_is_authorized
+def web_upload_chunk(upload_id):
+    # The chunk is given as the body with the Content-Range header. If it doesn't
+    # start at the number of bytes received or another chunk is being written,
+    # 409 with that number is returned
+    game_id = current_game_id()
+    upload = uploads.get_upload(game_id, upload_id)
+    if upload is None:
+        return flask.abort(404)
+    start, end = uploads.parse_content_range(flask.request.headers.get('Content-Range'), upload['size'])
+    writer = uploads.ChunkWriter(game_id, upload_id, get_game_info()['files_folder'], start)
+    try:
+        while writer.offset <= end:
+            data = flask.request.stream.read(min(uploads.CHUNK_SIZE, end + 1 - writer.offset))
+            if not data:
+                break
+            writer.write(data)
+    finally:
+        received = writer.close()
+    return json.dumps({'received': received})
+
+@app.route('/api/finish_upload', methods=['POST'])
+@assert_ok_params({'id'}, {'sha256'})
+@assert_is_authorized
+def web_finish_upload():
+    # Makes a file of the complete upload. If `sha256` is given, it's checked first
+    game_id = current_game_id()
+    upload_id = flask.request.form['id']
+    upload = uploads.get_upload(game_id, upload_id)
+    if upload is None:
+        return flask.abort(404)
+    if upload['received'] != upload['size']:
+        raise UploadConflict(upload['received'])
+    digest = upload['sha256'] or \
+            uploads.upload_sha256(game_id, upload_id, get_game_info()['files_folder'], upload['size'])
+    if flask.request.form.get('sha256', digest).lower() != digest:
+        raise ValueError("The checksum doesn't match, {} received".format(digest))
+    file_id = finish_upload(game_id, upload_id, digest)
+    uploads.forget_upload(game_id, upload_id)
+    if file_id is None: # Finished by another request meanwhile
+        return flask.abort(404)
+    return json.dumps({'id': file_id, 'sha256': digest})
+
 @app.route('/api/add_user', methods=['POST'])
 @assert_ok_params({'login', 'password', 'register_pass'},
         {'captain_pass', 'avatar'})
 def web_add_user():
-    if not bcrypt.checkpw(
-            flask.request.form['register_pass'].encode('utf-8'),
-            get_game_info()['register_pass'].encode('utf-8')
-            ):
-        return flaks.abort(403)
+    game_info = get_game_info()
+    if not check_password(flask.request.form['register_pass'], game_info['register_pass']):
+        return flask.abort(403)
     args = {k: v for k, v in flask.request.form.items() if k in {'login', \
             'password', 'avatar'}}
     is_captain = False
     if 'captain_pass' in flask.request.form.keys():
-        if bcrypt.checkpw(
-                flask.request.form['captain_pass'].encode('utf-8'),
-                get_game_info()['captain_pass'].encode('utf-8')
-                ):
+        if check_password(flask.request.form['captain_pass'], game_info['captain_pass']):
             is_captain = True
         else:
             return flask.abort(403)
-    add_user(game_id, **args, is_captain=is_captain)
+    add_user(current_game_id(), **args, is_captain=is_captain, bcrypt_rounds=game_info['bcrypt_rounds'])
     return ''
 
 @app.route('/api/add_comment', methods=['POST'])
 @assert_ok_params({'task_id'}, {'text', 'files_ids'})
 @assert_is_authorized
 def web_add_comment():
-    user_id = get_user_info_s(flask.request.cookies['session_id'])['login']
+    user_id = current_principal()['login']
     args = {k: v for k, v in flask.request.form.items() if k != 'files_ids'}
     args['files_ids'] = flask.request.form.getlist('files_ids')
-    return json.dumps(add_comment(game_id, user_id, **args))
+    return json.dumps(add_comment(current_game_id(), user_id, **args))
 
 @app.route('/api/rm_comment', methods=['POST'])
 @assert_ok_params({'id'}, set())
 @assert_is_authorized
 def web_rm_comment():
-    user_info = get_user_info_s(flask.request.cookies['session_id'])
+    user_info = current_principal()
     comment_info = get_comment_info(flask.request.form['id'])
+    if comment_info is None:
+        return flask.abort(404)
     if user_info['is_captain'] or (user_info['login'] == comment_info['user_id']):
-        return json.dumps(rm_comment(game_id, flask.request.form['id']))
+        return json.dumps(rm_comment(current_game_id(), flask.request.form['id']))
     else:
         return flask.abort(403)
 
@@ -298,33 +679,33 @@ def web_rm_comment():
 @assert_ok_params({'login', 'new_type'}, set())
 @assert_is_authorized
 def web_mark_user():
-    if not get_user_info_s(flask.request.cookies['session_id'])['is_captain']:
+    if not current_principal()['is_captain']:
         return flask.abort(403)
-    mark_user(game_id, *(flask.request.form[i] for i in ['login', 'new_type']))
+    mark_user(current_game_id(), *(flask.request.form[i] for i in ['login', 'new_type']))
     return ''
 
 @app.route('/api/mark_task', methods=['POST'])
 @assert_ok_params({'id', 'new_type'}, set())
 @assert_is_authorized
 def web_mark_task():
-    mark_task(game_id, *(flask.request.form[i] for i in ['id', 'new_type']))
+    mark_task(current_game_id(), *(flask.request.form[i] for i in ['id', 'new_type']))
     return ''
 
 @app.route('/api/update_avatar', methods=['POST'])
 @assert_ok_params({'avatar'}, set())
 @assert_is_authorized
 def web_update_avatar():
-    user_id = get_user_info_s(flask.request.cookies['session_id'])['login']
-    update_avatar(game_id, user_id, flask.request.form['avatar'])
+    user_id = current_principal()['login']
+    update_avatar(current_game_id(), user_id, flask.request.form['avatar'])
     return ''
 
 @app.route('/api/take_task', methods=['POST'])
 @assert_ok_params({'task_id', 'user_id'}, set())
 @assert_is_authorized
 def web_take_task():
-    user_info = get_user_info_s(flask.request.cookies['session_id'])
+    user_info = current_principal()
     if user_info['is_captain'] or (user_info['login'] == flask.request.form['user_id']):
-        take_task(game_id, **flask.request.form)
+        take_task(current_game_id(), **flask.request.form)
         return ''
     else:
         return flask.abort(403)
@@ -333,9 +714,9 @@ def web_take_task():
 @assert_ok_params({'task_id', 'user_id'}, set())
 @assert_is_authorized
 def web_reject_task():
-    user_info = get_user_info_s(flask.request.cookies['session_id'])
+    user_info = current_principal()
     if user_info['is_captain'] or (user_info['login'] == flask.request.form['user_id']):
-        reject_task(game_id, **flask.request.form)
+        reject_task(current_game_id(), **flask.request.form)
         return ''
     else:
         return flask.abort(403)
@@ -349,124 +730,276 @@ def file_path_and_name(file_id:str) -> tuple:
     Returns:
         tuple: (path_to_file, original_filename) if the file exists, (None, None) otherwise
     """
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT name FROM files WHERE id=(%s)', (file_id,))
-    name = c.fetchone()
-    if name is None:
+    with game_db_connection(current_game_id()) as db:
+        c = db.cursor()
+        c.execute(queries.FILE_NAME_QUERY, (id_to_db(file_id),))
+        row = c.fetchone()
+    if row is None:
         return (None, None)
     else:
-        return (path.join(get_game_info()['files_folder'], file_id), name[0])
+        return (content_path(get_game_info()['files_folder'], file_id, row[1]), row[0])
 
 # ------ BEGIN CONST API METHODS ------
+@app.route('/api/upload/<upload_id>')
+@assert_is_authorized
+def web_get_upload(upload_id):
+    # The state of a chunked upload, to know where to resume it from
+    upload = uploads.get_upload(current_game_id(), upload_id)
+    if upload is None:
+        return flask.abort(404)
+    return json.dumps(upload)
+
+def send_game_file(file_id:str, as_attachment:bool):
+    """Makes the response with the file content. It supports If-None-Match and
+        Range and can be cached forever. The content is sent either by the front
+        proxy (see `queries.file_offload_headers`) or with sendfile by gunicorn
+    Parameters:
+        file_id(str): The file identifier
+        as_attachment(bool): If the file is to be downloaded
+    """
+    file_path, name = file_path_and_name(file_id)
+    if file_path is None:
+        return flask.abort(404)
+    headers = queries.file_cache_headers(file_path)
+    if queries.etag_matches(flask.request.headers.get('If-None-Match'), headers['ETag']):
+        return app.response_class(status=304, headers=headers)
+    offload = queries.file_offload_headers(file_path, name, as_attachment)
+    if offload is not None:
+        return app.response_class(headers=offload)
+    resp = flask.send_file(file_path, as_attachment=as_attachment, attachment_filename=name,
+            conditional=True, add_etags=False)
+    resp.headers.update(headers)
+    return resp
+
 @app.route('/api/get_file/<file_id>')
 @assert_is_authorized
 def web_get_file(file_id):
-    path, name = file_path_and_name(file_id)
-    if path is None:
-        return flask.abort(404)
-    return flask.send_file(path)
+    return send_game_file(file_id, False)
 
 @app.route('/api/download_file/<file_id>')
 @assert_is_authorized
 def web_download_file(file_id):
-    path, name = file_path_and_name(file_id)
-    if path is None:
-        return flask.abort(404)
-    return flask.send_file(path, as_attachment=True, attachment_filename=name)
+    return send_game_file(file_id, True)
 
 @app.route('/api/get_user_info/<user_id>')
 @assert_is_authorized
+@with_versions_etag('users', 'solvings')
 def web_get_user_info(user_id):
     return json.dumps(get_user_info(user_id))
 
 @app.route('/api/get_users')
 @assert_is_authorized
+@with_versions_etag('users', 'solvings')
 def web_get_users():
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT login FROM users')
-    return json.dumps(
-            [get_user_info(uid) for uid in _parse_mysql_vomit(c.fetchall())]
-            )
+    return json.dumps(get_users_info())
 
 @app.route('/api/get_task_info/<task_id>')
 @assert_is_authorized
+@with_versions_etag('tasks', 'solvings', 'users')
 def web_get_task_info(task_id):
-    return json.dumps(get_task_info(task_id))
+    task_info = get_task_info(task_id)
+    if task_info is None:
+        return flask.abort(404)
+    return json.dumps(task_info)
 
 @app.route('/api/get_tasks')
+@assert_ok_args(set(), {'ids'})
 @assert_is_authorized
+@with_versions_etag('tasks', 'solvings', 'users')
 def web_get_tasks():
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT id FROM tasks')
-    return json.dumps(
-            [get_task_info(tid) for tid in _parse_mysql_vomit(c.fetchall())]
-            )
+    if 'ids' in flask.request.args.keys():
+        return json.dumps(get_tasks_info(queries.split_ids(flask.request.args.getlist('ids'))))
+    return json.dumps(get_tasks_info())
 
 @app.route('/api/get_solvings')
 @assert_is_authorized
+@with_versions_etag('solvings', 'users')
 def web_get_solvings():
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT * FROM solvings')
-    return json.dumps(
-            [dict(zip(['user_id', 'task_id'], i)) for i in c.fetchall()]
-            )
+    with game_db_connection(current_game_id()) as db:
+        c = db.cursor()
+        c.execute(queries.SOLVINGS_QUERY)
+        return json.dumps(queries.assemble_solvings(c.fetchall()))
 
 @app.route('/api/get_file_name/<file_id>')
 @assert_is_authorized
+@with_versions_etag('files')
 def web_get_file_info(file_id):
     return json.dumps(file_path_and_name(file_id)[1])
 
 @app.route('/api/get_files')
 @assert_is_authorized
+@with_versions_etag('files')
 def web_get_files():
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT * FROM files')
-    return json.dumps(
-            [dict(zip(['id', 'name'], i)) for i in c.fetchall()]
-            )
+    with game_db_connection(current_game_id()) as db:
+        c = db.cursor()
+        c.execute(queries.FILES_QUERY)
+        return json.dumps(queries.assemble_files(c.fetchall()))
 
 @app.route('/api/get_comment_info/<comment_id>')
 @assert_is_authorized
+@with_versions_etag('comments', 'users')
 def web_get_comment_info(comment_id):
-    return json.dumps(get_comment_info(comment_id))
+    comment_info = get_comment_info(comment_id)
+    if comment_info is None:
+        return flask.abort(404)
+    return json.dumps(comment_info)
 
 @app.route('/api/get_comments')
+@assert_ok_args(set(), {'task_id', 'limit', 'cursor'})
 @assert_is_authorized
+@with_versions_etag('comments', 'users')
 def web_get_comments():
-    assert_ok_dbname(game_id)
-    db = get_db_connection()
-    c = db.cursor()
-    c.execute('USE OvO_' + game_id)
-    c.execute('SELECT id FROM comments')
-    return json.dumps(
-            [get_comment_info(cid) for cid in _parse_mysql_vomit(c.fetchall())]
-            )
+    # If there are more comments than `limit`, the next page cursor is sent in X-Next-Cursor
+    try:
+        limit = flask.request.args.get('limit')
+        if limit is not None:
+            limit = min(queries.positive_int(limit), queries.MAX_COMMENTS_PAGE)
+        comments, next_cursor = get_comments_info(
+                flask.request.args.get('task_id'),
+                limit,
+                flask.request.args.get('cursor')
+                )
+    except ValueError:
+        return flask.abort(400)
+    resp = app.make_response(json.dumps(comments))
+    if next_cursor is not None:
+        resp.headers['X-Next-Cursor'] = next_cursor
+    return resp
+
+@app.route('/api/events')
+@assert_ok_args(set(), {'last_event_id'})
+@assert_is_authorized
+def web_events():
+    # Server-sent events stream of the game changes. A client resumes from the
+    # event given in the Last-Event-ID header (or the last_event_id argument),
+    # otherwise gets only the events happened after connecting
+    try:
+        after = queries.parse_event_id(flask.request.headers.get('Last-Event-ID',
+            flask.request.args.get('last_event_id')))
+    except ValueError:
+        return flask.abort(400)
+    game_id = current_game_id()
+    feed = get_events_feed(game_id)
+    if after is None:
+        after = feed.last_id()
+
+    def stream(after):
+        while True:
+            rows = feed.wait(after, EVENTS_HEARTBEAT)
+            if feed.draining:
+                return
+            if rows is None: # Resuming from an old event
+                last_id = feed.last_id()
+                with game_db_connection(game_id) as db:
+                    c = db.cursor()
+                    c.execute(queries.EVENTS_QUERY, (after, last_id))
+                    rows = c.fetchall()
+                    c.execute(queries.EVENTS_COMPACTED_QUERY)
+                    compacted, = c.fetchone()
+                if after < compacted: # The events to resume from were removed
+                    yield queries.resync_event(last_id)
+                    after = last_id
+                    continue
+            if not rows:
+                yield ': heartbeat\n\n'
+            for row in rows:
+                yield queries.format_event(row)
+                after = row[0]
+
+    if not _event_streams.acquire(blocking=False):
+        resp = app.make_response(('Too many event streams, poll /api/changes instead', 503))
+        resp.headers['Retry-After'] = str(EVENTS_HEARTBEAT)
+        return resp
+    resp = flask.Response(stream(after), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(_event_streams.release)
+    return resp
+
+@app.route('/api/changes')
+@assert_ok_args({'since'}, set())
+@assert_is_authorized
+def web_changes():
+    # The changes happened after the `since` event, see `queries.assemble_changes`
+    try:
+        since = queries.parse_event_id(flask.request.args['since'])
+    except ValueError:
+        return flask.abort(400)
+    last_id, rows = get_events_feed(current_game_id()).after(since)
+    compacted = 0
+    newest = None
+    if since > last_id: # Given by another worker, the feed of this one lags behind
+        with game_db_connection(current_game_id()) as db:
+            c = db.cursor()
+            c.execute(queries.LAST_EVENT_QUERY)
+            newest, = c.fetchone()
+    elif rows is None:
+        with game_db_connection(current_game_id()) as db:
+            c = db.cursor()
+            c.execute(queries.EVENTS_QUERY, (since, last_id))
+            rows = c.fetchall()
+            # Read after the events, so the events removed before reading them are noticed
+            c.execute(queries.EVENTS_COMPACTED_QUERY)
+            compacted, = c.fetchone()
+    return json.dumps(queries.assemble_changes(rows or [], since, last_id, compacted, newest))
 # ------ END CONST API METHODS ------
 
-class WaitForExit(FileSystemEventHandler):
-    def on_created(self, event):
-        if(not event.is_directory) and (event.src_path.split('/')[-1] == 'exit'):
-            _exit(0)
+def _when_ready(server):
+    control_server.ready()
+
+def _on_exit(server):
+    control_server.stopped()
+
+def _post_worker_init(worker):
+    Thread(target=watch_game_info, args=(GAME_INFO_POLL_INTERVAL,), daemon=True).start()
+    # On SIGTERM the worker stops accepting connections and finishes the requests
+    # being served in `graceful_timeout` seconds, the event streams end at once
+    handle_exit = worker.handle_exit
+    def drain(sig, frame):
+        Thread(target=_drain_events, daemon=True).start() # Not to take the locks in a signal handler
+        handle_exit(sig, frame)
+    signal(SIGTERM, drain)
+    siginterrupt(SIGTERM, False)
+
+class GameServer(BaseApplication):
+    """The pre-forking WSGI server of the game (or of the hosted games)
+    Parameters:
+        port(int): The network port to run on
+        workers(int): The number of the worker processes
+        drain_timeout(int): Max number of seconds to finish the requests being
+            served when stopping
+    """
+    def __init__(self, port:int, workers:int, drain_timeout:int):
+        self.options = {
+                'bind': '0.0.0.0:{}'.format(port),
+                'workers': workers,
+                'worker_class': 'gthread',
+                'threads': WORKER_THREADS + _max_event_streams,
+                'graceful_timeout': drain_timeout,
+                'when_ready': _when_ready,
+                'on_exit': _on_exit,
+                'post_worker_init': _post_worker_init
+                }
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return app
 
 if __name__ == "__main__":
-    game_id = sys.argv[1]
-    game_info = get_game_info()
-    observer = Observer()
-    observer.schedule(WaitForExit(), path=game_info['files_folder'])
-    observer.start()
-    app.run('0.0.0.0', port=game_info['port'])
+    config = _load_config()
+    if sys.argv[1] == '--host': # The games with the `hosted` engine, see `GameDispatcher`
+        game_id = None
+        app.wsgi_app = GameDispatcher(app.wsgi_app)
+        port = config.getint('host', 'port', fallback=HOST_PORT)
+        workers = config.getint('host', 'workers', fallback=1)
+    else:
+        game_id = app.config['GAME_ID'] = sys.argv[1]
+        game_info = get_game_info()
+        port, workers = game_info['port'], game_info['workers']
+    # The master process answers `ovo run` and `ovo stop`, SIGTERM makes gunicorn
+    # finish the requests being served before the workers exit
+    control_server = control.ControlServer(game_id, lambda: kill(getpid(), SIGTERM))
+    GameServer(port, workers, config.getint('web', 'drain_timeout', fallback=DRAIN_TIMEOUT)).run()
@@ -0,0 +1,469 @@
+# The SQL queries of the game API and the functions turning their results into
+# the API responses. Doesn't depend on a web framework or a mysql driver, so it's
+# shared by the WSGI (main.py) and the ASGI (asgi.py) applications. All the
+# queries use the `%s` placeholders
+import sys
+import json
+import binascii
+import mimetypes
+from os import path
+from urllib.parse import quote
+from functools import lru_cache
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from collections import deque
+
+sys.path.append(path.join(path.dirname(__file__), '../command_line'))
+from common import _load_config, \
+        id_to_db, \
+        id_from_db
+
+MAX_COMMENTS_PAGE = 500
+
+def positive_int(s:str) -> int:
+    """Parses a positive integer, raises ValueError otherwise"""
+    ans = int(s)
+    if ans <= 0:
+        raise ValueError("Positive integer expected")
+    return ans
+
+def check_given_params(required_params:set,
+        all_params:set, given_params:set) -> bool:
+    """Checks if all the required params where given
+        and all the given params are valid
+    Parameters:
+        required_params(set): The set of params keys
+            required for the method
+        all_params(set): The set of valid params keys
+            for the method
+        given_params(set): The set of given params keys
+    Returns:
+        bool: True, if the given params are correct,
+            otherwise False
+    """
+    if len(required_params.intersection(given_params)) < \
+            len(required_params):
+        return False
+    if len(given_params - all_params) > 0:
+        return False
+    return True
+
+def split_ids(values:list) -> list:
+    """Splits the comma separated ids of the `ids` query string arguments"""
+    return [i for ids in values for i in ids.split(',') if i]
+
+def well_formed_ids(ids:list) -> list:
+    """Returns the ids `id_to_db` accepts, the malformed ones can't belong to
+        any entity, so they are skipped like the unknown ones
+    """
+    ans = []
+    for i in ids:
+        try:
+            id_to_db(i)
+        except ValueError:
+            continue
+        ans.append(i)
+    return ans
+
+def deleted_user_info() -> dict:
+    return {'login': 'DELETED', 'is_captain': False, 'avatar': None, 'solving': []}
+
+def users_query(users_ids:list=None) -> tuple:
+    """Returns the query for `assemble_users`
+    Parameters:
+        users_ids(list[str], optional): The users identifiers. If not specified,
+            all the users are selected
+    Returns:
+        tuple: (query, values)
+    """
+    query = 'SELECT u.login, u.is_captain, u.avatar, s.task_id FROM users u \
+            LEFT JOIN solvings s ON s.user_id = u.id'
+    if users_ids is None:
+        return (query, ())
+    query += ' WHERE u.login IN ({})'.format(', '.join(['%s'] * len(users_ids)))
+    return (query, tuple(users_ids))
+
+def assemble_users(rows:list, users_ids:list=None) -> list:
+    """Makes the users info of the `users_query` result
+    Parameters:
+        rows(list[tuple]): The query result
+        users_ids(list[str], optional): The ids given to `users_query`
+    Returns:
+        list[dict]: The users info. If `users_ids` is specified, the users are
+            in the same order, the placeholder dict is given for the users
+            which don't exist
+    """
+    users = {}
+    for login, is_captain, avatar, task_id in rows:
+        if login not in users:
+            users[login] = {'login': login, 'is_captain': (True if is_captain == 'Y' else False),
+                    'avatar': id_from_db(avatar), 'solving': []}
+        if task_id is not None:
+            users[login]['solving'].append(id_from_db(task_id))
+    if users_ids is None:
+        return list(users.values())
+    return [users.get(uid) or deleted_user_info() for uid in users_ids]
+
+def tasks_queries(tasks_ids:list=None) -> tuple:
+    """Returns the queries for `assemble_tasks`
+    Parameters:
+        tasks_ids(list[str], optional): The tasks identifiers. If not specified,
+            all the tasks are selected
+    Returns:
+        tuple or NoneType: (tasks_query, solvings_query, values), the values are
+            the same for both the queries. None if none of the ids is well formed,
+            i. e. no tasks are selected
+    """
+    tasks_query = 'SELECT id, name, is_solved, original_link, original_id, text FROM tasks'
+    solvings_query = 'SELECT s.task_id, u.login FROM solvings s JOIN users u ON u.id = s.user_id'
+    if tasks_ids is None:
+        return (tasks_query, solvings_query, ())
+    tasks_ids = well_formed_ids(tasks_ids)
+    if not tasks_ids:
+        return None
+    placeholders = ', '.join(['%s'] * len(tasks_ids))
+    tasks_query += ' WHERE id IN ({})'.format(placeholders)
+    solvings_query += ' WHERE s.task_id IN ({})'.format(placeholders)
+    return (tasks_query, solvings_query, tuple(map(id_to_db, tasks_ids)))
+
+def assemble_tasks(tasks_rows:list, solvings_rows:list, tasks_ids:list=None) -> list:
+    """Makes the tasks info of the `tasks_queries` results
+    Parameters:
+        tasks_rows(list[tuple]): The tasks query result
+        solvings_rows(list[tuple]): The solvings query result
+        tasks_ids(list[str], optional): The ids given to `tasks_queries`
+    Returns:
+        list[dict]: The tasks info. If `tasks_ids` is specified, the tasks are
+            in the same order, unknown ids are skipped
+    """
+    tasks = {}
+    for row in tasks_rows:
+        task = dict(zip(['id', 'name', 'is_solved', 'original_link', 'original_id', 'text'], row))
+        task['id'] = id_from_db(task['id'])
+        task['is_solved'] = True if task['is_solved'] == 'Y' else False
+        task['solvers'] = []
+        tasks[task['id']] = task
+    for task_id, user_id in solvings_rows:
+        task_id = id_from_db(task_id)
+        if task_id in tasks:
+            tasks[task_id]['solvers'].append(user_id)
+    if tasks_ids is None:
+        return list(tasks.values())
+    return [tasks[tid] for tid in dict.fromkeys(map(str.lower, tasks_ids)) if tid in tasks]
+
+def encode_comments_cursor(created_at:datetime, comment_id:str) -> str:
+    """Makes an opaque cursor pointing right after the given comment
+    Parameters:
+        created_at(datetime): The comment creation time
+        comment_id(str): The comment identifier
+    Returns:
+        str: The cursor
+    """
+    raw = json.dumps([created_at.isoformat(), comment_id])
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_comments_cursor(cursor:str) -> tuple:
+    """Decodes the cursor made by `encode_comments_cursor`
+    Parameters:
+        cursor(str): The cursor
+    Returns:
+        tuple: (created_at, comment_id)
+
+    Raises ValueError if the cursor is malformed
+    """
+    try:
+        created_at, comment_id = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+        return (datetime.fromisoformat(created_at), str(comment_id))
+    except (TypeError, binascii.Error, UnicodeError, json.JSONDecodeError) as e:
+        raise ValueError("Malformed cursor") from e
+
+COMMENT_QUERY = 'SELECT cm.id, cm.task_id, COALESCE(u.login, \'DELETED\'), cm.text, cm.attached_files_ids \
+        FROM comments cm LEFT JOIN users u ON u.id = cm.user_id WHERE cm.id=(%s)'
+
+def comments_query(task_id:str=None, limit:int=None, cursor:str=None) -> tuple:
+    """Returns the query for `assemble_comments`
+    Parameters:
+        task_id(str, optional): If specified, only the comments to this task are selected
+        limit(int, optional): The max number of comments in the page
+        cursor(str, optional): The cursor got with the previous page
+    Returns:
+        tuple: (query, values)
+
+    Raises ValueError if the cursor is malformed
+    """
+    conditions, values = [], []
+    if task_id is not None:
+        conditions.append('cm.task_id=(%s)')
+        values.append(id_to_db(task_id))
+    if cursor is not None:
+        created_at, comment_id = decode_comments_cursor(cursor)
+        conditions.append('(cm.created_at > (%s) OR (cm.created_at = (%s) AND cm.id > (%s)))')
+        values += [created_at, created_at, id_to_db(comment_id)]
+    query = 'SELECT cm.id, cm.task_id, COALESCE(u.login, \'DELETED\'), cm.text, cm.attached_files_ids, \
+            cm.created_at FROM comments cm LEFT JOIN users u ON u.id = cm.user_id'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY cm.created_at, cm.id'
+    if limit is not None:
+        query += ' LIMIT {:d}'.format(limit + 1) # One more to know if there is a next page
+    return (query, tuple(values))
+
+def assemble_comment(row:tuple) -> dict:
+    """Makes the comment info of a row of `COMMENT_QUERY` or `comments_query`,
+        None if there is no row (the comment doesn't exist)
+    """
+    if row is None:
+        return None
+    comment = dict(zip(['id', 'task_id', 'user_id', 'text', 'attached_files'], row))
+    comment['id'] = id_from_db(comment['id'])
+    comment['task_id'] = id_from_db(comment['task_id'])
+    comment['attached_files'] = json.loads(comment['attached_files'])
+    return comment
+
+def assemble_comments(rows:list, limit:int=None) -> tuple:
+    """Makes the page of comments of the `comments_query` result
+    Parameters:
+        rows(list[tuple]): The query result
+        limit(int, optional): The limit given to `comments_query`
+    Returns:
+        tuple: (comments, next_cursor), next_cursor is None if there
+            are no more comments
+    """
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_comments_cursor(rows[-1][5], id_from_db(rows[-1][0]))
+    return ([assemble_comment(row) for row in rows], next_cursor)
+
+PRINCIPAL_QUERY = 'SELECT u.login, u.is_captain FROM session_data s \
+        JOIN users u ON u.id = s.user_id WHERE s.session_id=(%s)'
+
+def assemble_principal(row:tuple) -> dict:
+    """Makes the principal of the `PRINCIPAL_QUERY` result row"""
+    return {'login': row[0], 'is_captain': (True if row[1] == 'Y' else False)}
+
+PRINCIPAL_EVENTS = {'user_marked', 'user_removed'}
+
+def principals_changed(rows:list) -> set:
+    """Returns the logins of the users whose principals are changed by the
+        events, so the cached ones are to be dropped
+    Parameters:
+        rows(list[tuple]): The `EVENTS_QUERY` result
+    Returns:
+        set[str]: The logins
+    """
+    return {json.loads(data)['login'] for _, event_type, data in rows if event_type in PRINCIPAL_EVENTS}
+
+GAME_INFO_VERSION_QUERY = 'SELECT version FROM game_info'
+
+GAME_INFO_QUERY = 'SELECT version, port, files_folder, register_pass, captain_pass, \
+        judge_url, judge_login, judge_pass, bcrypt_rounds, workers, engine FROM game_info'
+
+def assemble_game_info(row:tuple) -> tuple:
+    """Makes the game info of the `GAME_INFO_QUERY` result row
+    Returns:
+        tuple: (version, game_info)
+    """
+    return (row[0], dict(zip(['port', 'files_folder', 'register_pass', 'captain_pass', \
+            'judge_url', 'judge_login', 'judge_pass', 'bcrypt_rounds', 'workers', 'engine'], row[1:])))
+
+SOLVINGS_QUERY = 'SELECT u.login, s.task_id FROM solvings s JOIN users u ON u.id = s.user_id'
+
+def assemble_solvings(rows:list) -> list:
+    return [{'user_id': user_id, 'task_id': id_from_db(task_id)} for user_id, task_id in rows]
+
+FILES_QUERY = 'SELECT id, name FROM files'
+
+def assemble_files(rows:list) -> list:
+    return [{'id': id_from_db(file_id), 'name': name} for file_id, name in rows]
+
+FILE_NAME_QUERY = 'SELECT name, sha256 FROM files WHERE id=(%s)'
+
+FILE_MAX_AGE = 365 * 24 * 3600 # seconds. The content of a file id never changes
+
+def file_cache_headers(file_path:str) -> dict:
+    """Returns the ETag and Cache-Control headers of a file content. The
+        content is named by its sha256 or by its file id (see `owo.content_path`),
+        so the name is the ETag
+    """
+    return {'ETag': '"{}"'.format(path.basename(file_path)),
+            'Cache-Control': 'private, max-age={}, immutable'.format(FILE_MAX_AGE)}
+
+@lru_cache(maxsize=None)
+def _file_offload() -> tuple:
+    """Returns the `file_offload` and `file_offload_prefix` options of the `[web]`
+        section of the conf file
+    """
+    config = _load_config()
+    mode = config.get('web', 'file_offload', fallback='none')
+    if mode not in ['none', 'x-accel-redirect', 'x-sendfile']:
+        print("Warning: unknown file_offload {}, the files are sent by the app".format(mode),
+                file=sys.stderr)
+        mode = 'none'
+    return (mode, config.get('web', 'file_offload_prefix', fallback='/ovo-files'))
+
+def file_offload_headers(file_path:str, name:str, as_attachment:bool) -> dict:
+    """Returns the headers making the front proxy send the file content (nginx
+        `X-Accel-Redirect` to `file_offload_prefix` followed by the absolute path,
+        or `X-Sendfile` with the path), so the app doesn't copy it
+    Parameters:
+        file_path(str): The path of the file content
+        name(str): The file name
+        as_attachment(bool): If the file is to be downloaded
+    Returns:
+        dict or NoneType: The headers, None if the offload is off
+    """
+    mode, prefix = _file_offload()
+    if mode == 'none':
+        return None
+    file_path = path.abspath(file_path)
+    headers = file_cache_headers(file_path)
+    headers['Content-Type'] = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if as_attachment:
+        headers['Content-Disposition'] = "attachment; filename*=UTF-8''{}".format(quote(name))
+    if mode == 'x-accel-redirect':
+        headers['X-Accel-Redirect'] = quote(prefix.rstrip('/') + file_path)
+    else:
+        headers['X-Sendfile'] = file_path
+    return headers
+
+VERSIONS_QUERY = 'SELECT name, version FROM versions'
+
+def versions_etag(rows:list, tables:list) -> str:
+    """Makes the ETag of a response depending on the given tables
+    Parameters:
+        rows(list[tuple]): The `VERSIONS_QUERY` result
+        tables(list[str]): The tables the response depends on
+    Returns:
+        str: The ETag, quoted
+    """
+    versions = dict(rows)
+    return '"{}"'.format('-'.join(str(versions.get(table, 0)) for table in tables))
+
+def etag_matches(if_none_match:str, etag:str) -> bool:
+    """Checks if the If-None-Match header value matches the ETag
+    Parameters:
+        if_none_match(str): The header value, may be None
+        etag(str): The current ETag, quoted
+    Returns:
+        bool: True if the client has the current version
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+EVENTS_BATCH = 1000 # Max number of events read at once
+MAX_EVENT_ID = 2 ** 64 - 1
+
+EVENTS_QUERY = 'SELECT id, type, data FROM events WHERE id > (%s) AND id <= (%s) \
+        ORDER BY id LIMIT {:d}'.format(EVENTS_BATCH)
+
+LAST_EVENT_QUERY = 'SELECT COALESCE(MAX(id), 0) FROM events'
+
+def parse_event_id(value:str) -> int:
+    """Parses the Last-Event-ID header (or the `last_event_id` argument)
+    Parameters:
+        value(str or NoneType): The header value
+    Returns:
+        int or NoneType: The event id, None if not given
+
+    Raises ValueError if the id is malformed
+    """
+    if value is None:
+        return None
+    ans = int(value)
+    if not (0 <= ans <= MAX_EVENT_ID):
+        raise ValueError("Malformed event id")
+    return ans
+
+def format_event(row:tuple) -> str:
+    """Makes the server-sent event of the `EVENTS_QUERY` result row"""
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(*row)
+
+EVENTS_COMPACTED_QUERY = 'SELECT events_compacted FROM game_info'
+
+def resync_event(last_id:int) -> str:
+    """Makes the server-sent event telling the client that the events it
+        has missed were removed, so it has to load the whole game again
+    Parameters:
+        last_id(int): The id of the last event known, the stream goes on after it
+    """
+    return 'id: {}\nevent: resync\ndata: {{}}\n\n'.format(last_id)
+
+def assemble_changes(rows:list, since:int, last_id:int, compacted:int=0, newest:int=None) -> dict:
+    """Makes the `/api/changes` response
+    Parameters:
+        rows(list[tuple]): The events after `since` (the `EVENTS_QUERY` result)
+        since(int): The id of the last event the client has seen
+        last_id(int): The id of the last event known
+        compacted(int, optional): The last event removed by the compaction,
+            only needed if `rows` were read from the database
+        newest(int, optional): The last event in the database (`LAST_EVENT_QUERY`),
+            only needed if `since` is after `last_id`. Then `since` was given by
+            another process knowing more events, and the client gets no changes
+            until this one knows them too, unless there is no such event at all
+    Returns:
+        dict: {'resync': bool, 'changes': list[dict], 'last': int, 'more': bool}.
+            If `resync`, the client has missed the removed events (or is from
+            another game), so it has to load the whole game again and then ask
+            for the changes since `last`. Otherwise `changes` are the events (with
+            the `seq`, `type` and `data` keys) and, if `more`, there are more of
+            them after `last`
+    """
+    if since < compacted or (since > last_id and (newest is None or since > newest)):
+        return {'resync': True, 'changes': [], 'last': last_id, 'more': False}
+    if since > last_id:
+        return {'resync': False, 'changes': [], 'last': since, 'more': False}
+    rows = [row for row in rows if row[0] <= last_id]
+    more = len(rows) >= EVENTS_BATCH # Else the ids up to `last_id` not in `rows` were rolled back
+    rows = rows[:EVENTS_BATCH]
+    return {'resync': False,
+            'changes': [{'seq': seq, 'type': event_type, 'data': json.loads(data)} for seq, event_type, data in rows],
+            'last': rows[-1][0] if more else last_id, 'more': more}
+
+class RecentEvents:
+    """The latest events kept in memory, so the event streams don't query
+        the database unless a client resumes from an old event. Not thread-safe
+    Parameters:
+        last_id(int): The id of the last event existing before
+        size(int, optional): Max number of the events kept
+    """
+    def __init__(self, last_id:int, size:int=EVENTS_BATCH):
+        self.last_id = last_id
+        self.size = size
+        self._events = deque()
+        self._floor = last_id # The events after it are kept
+
+    def add(self, rows:list):
+        """Adds the new events. Their ids are given in the commit order (see
+            `owo._lock_events`), so the ones missing were rolled back
+        """
+        self._events.extend(rows)
+        if rows:
+            self.last_id = rows[-1][0]
+        while len(self._events) > self.size:
+            self._floor = self._events.popleft()[0]
+
+    def after(self, after:int) -> list:
+        """Returns the kept events after the given one
+        Parameters:
+            after(int): The event id
+        Returns:
+            list[tuple] or NoneType: The events, None if some of them are not kept
+                anymore (then they are to be read with `EVENTS_QUERY` up to `last_id`)
+        """
+        if after < self._floor:
+            return None
+        return [row for row in self._events if row[0] > after]
+
+if __name__ == "__main__":
+    print("It's forbidden to run this file", file=sys.stderr)
+    exit(1)
@@ -0,0 +1,207 @@
+# The chunked uploads of the game API: a client creates an upload
+# (`owo.create_upload`), PUTs the ranges of the content one after another and
+# then finishes it (`owo.finish_upload`). A broken transfer is resumed from the
+# `received` offset. If the client gives the content sha256 and the game has the
+# content already, nothing is to be PUT. The chunks are streamed to the upload
+# file with a bounded buffer, the sha256 of the content is computed while it's
+# being written. A chunk is written only by the request holding the lock of the
+# upload file, so concurrent requests never overwrite each other's ranges.
+# Doesn't depend on a web framework, so it's shared by main.py and asgi.py
+import sys
+import re
+import fcntl
+import hashlib
+from os import path, fsync
+
+sys.path.append(path.join(path.dirname(__file__), '../command_line'))
+from common import game_db_connection, \
+        id_to_db, \
+        id_from_db, \
+        file_sha256, \
+        TTLCache
+from owo import upload_path
+
+CHUNK_SIZE = 1 << 16 # Bytes read from a request body at once
+HASHERS_KEPT = 1024 # Max number of the uploads with a hasher kept, see `_hashers`
+HASHER_TTL = 3600 # seconds, an upload not continued for so long loses its hasher
+
+_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+# (game id, upload id) -> (offset, sha256 of the content before it). The
+# hashers of the uploads written by this process, so the content isn't read
+# again when finishing. Another process continuing the upload drops it, the
+# abandoned uploads expire
+_hashers = TTLCache(HASHERS_KEPT, HASHER_TTL)
+
+class UploadConflict(Exception):
+    """The chunk doesn't continue the upload
+    Parameters:
+        received(int): The number of bytes received, the next chunk must start there
+    """
+    def __init__(self, received:int):
+        super().__init__("The upload has {} bytes received".format(received))
+        self.received = received
+
+class UploadNotFound(Exception):
+    """The upload was finished or removed while the request was being served"""
+    def __init__(self):
+        super().__init__("The upload doesn't exist")
+
+def parse_content_range(value:str, size:int) -> tuple:
+    """Parses the Content-Range header of a chunk
+    Parameters:
+        value(str or NoneType): The header value, like `bytes 0-1023/4096`
+        size(int): The upload size
+    Returns:
+        tuple: (start, end), the first and the last byte of the chunk
+
+    Raises ValueError if the header is malformed or doesn't match the upload
+    """
+    match = _CONTENT_RANGE.fullmatch((value or '').strip())
+    if match is None:
+        raise ValueError("Malformed Content-Range")
+    start, end, total = map(int, match.groups())
+    if total != size or start > end or end >= size:
+        raise ValueError("Content-Range doesn't match the upload")
+    return (start, end)
+
+def get_upload(game_id:str, upload_id:str) -> dict:
+    """Returns the upload state
+    Parameters:
+        game_id(str): The game identifier
+        upload_id(str): The upload identifier
+    Returns:
+        dict or NoneType: {'name': str, 'size': int, 'received': int, 'sha256': str},
+            None if the upload doesn't exist. `sha256` is only known if the content
+            was known when the upload was created
+    """
+    with game_db_connection(game_id) as db:
+        c = db.cursor()
+        c.execute('SELECT name, size, received, sha256 FROM uploads WHERE id=(%s)', (id_to_db(upload_id),))
+        row = c.fetchone()
+    if row is None:
+        return None
+    return dict(zip(['name', 'size', 'received', 'sha256'], row[:3] + (id_from_db(row[3]),)))
+
+def _take_hasher(game_id:str, upload_id:str, offset:int):
+    """Returns the hasher of the upload content up to the offset, None if this
+        process doesn't have it
+    """
+    kept = _hashers.pop((game_id, upload_id))
+    if offset == 0:
+        return hashlib.sha256()
+    if kept is not None and kept[0] == offset:
+        return kept[1]
+    return None
+
+class ChunkWriter:
+    """Writes a chunk of the upload to its file. The chunk is given by parts
+        with `write`, the progress is saved by `close` even if the transfer
+        was broken in the middle. The upload file is locked until `close`, the
+        chunk is only taken if it starts where the upload ends
+    Parameters:
+        game_id(str): The game identifier
+        upload_id(str): The upload identifier
+        files_folder(str): The game files folder
+        start(int): The offset of the chunk (see `parse_content_range`)
+
+    Raises UploadConflict if another chunk is being written, the chunk doesn't
+        continue the upload or the upload is complete. Raises UploadNotFound if
+        the upload file is gone (the upload was finished meanwhile)
+    """
+    def __init__(self, game_id:str, upload_id:str, files_folder:str, start:int):
+        self.game_id = game_id
+        self.upload_id = upload_id
+        self.start = start
+        self.offset = start
+        upload = get_upload(game_id, upload_id)
+        if upload is None:
+            raise UploadNotFound()
+        if upload['received'] == upload['size']: # There is no file if the content was known
+            raise UploadConflict(upload['received'])
+        try:
+            self._file = open(upload_path(files_folder, upload_id), 'r+b')
+        except FileNotFoundError:
+            raise UploadNotFound()
+        try:
+            try: # The lock is per open file, so it works between the threads too
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadConflict(self._received())
+            received = self._received() # Read under the lock, so it can't change until `close`
+            if received != start:
+                raise UploadConflict(received)
+        except BaseException:
+            self._file.close()
+            raise
+        self._file.seek(start)
+        self._hasher = _take_hasher(game_id, upload_id, start)
+
+    def _received(self) -> int:
+        upload = get_upload(self.game_id, self.upload_id)
+        if upload is None:
+            raise UploadNotFound()
+        return upload['received']
+
+    def write(self, data:bytes):
+        self._file.write(data)
+        if self._hasher is not None:
+            self._hasher.update(data)
+        self.offset += len(data)
+
+    def close(self) -> int:
+        """Saves the progress
+        Returns:
+            int: The number of bytes received
+
+        Raises UploadConflict if the upload was continued by another request meanwhile,
+            UploadNotFound if it was finished
+        """
+        try:
+            self._file.flush()
+            fsync(self._file.fileno()) # The progress is never ahead of the content
+            with game_db_connection(self.game_id) as db:
+                c = db.cursor()
+                c.execute('UPDATE uploads SET received=(%s) WHERE id=(%s) AND received=(%s)',
+                        (self.offset, id_to_db(self.upload_id), self.start))
+                db.commit()
+                continued = (c.rowcount > 0)
+        finally:
+            self._file.close() # Releases the lock
+        if not continued:
+            raise UploadConflict(self._received())
+        if self._hasher is not None:
+            _hashers.put((self.game_id, self.upload_id), (self.offset, self._hasher))
+        return self.offset
+
+def forget_upload(game_id:str, upload_id:str):
+    """Drops what this process keeps about the upload, call it when the upload
+        is finished or removed
+    """
+    _hashers.pop((game_id, upload_id))
+
+def upload_sha256(game_id:str, upload_id:str, files_folder:str, size:int) -> str:
+    """Returns the sha256 of the complete upload content. It's read from the
+        file only if the upload was written by another process. Not for the
+        uploads with a known content (see `get_upload`)
+    Parameters:
+        game_id(str): The game identifier
+        upload_id(str): The upload identifier
+        files_folder(str): The game files folder
+        size(int): The upload size
+    Returns:
+        str: The hex digest
+
+    Raises UploadNotFound if the upload file is gone (the upload was finished meanwhile)
+    """
+    hasher = _take_hasher(game_id, upload_id, size)
+    if hasher is None:
+        try:
+            return file_sha256(upload_path(files_folder, upload_id))
+        except FileNotFoundError:
+            raise UploadNotFound()
+    return hasher.hexdigest()
+
+if __name__ == "__main__":
+    print("It's forbidden to run this file", file=sys.stderr)
+    exit(1)
@@ -1,14 +1,17 @@
-from os import listdir, path
-from sys import stderr
+from os import listdir, path, remove, stat
+from sys import stderr, executable
 from subprocess import run, PIPE
 from importlib.machinery import SourceFileLoader
 import json
+import hashlib
 import requests
 from time import sleep
 
 import bcrypt
 
 common = SourceFileLoader('common', '../src/command_line/common.py').load_module()
+ovo_main = SourceFileLoader('ovo_main', '../src/command_line/main.py').load_module()
+control = SourceFileLoader('control', '../src/command_line/control.py').load_module()
 from test_station import TestStation
 
 def _run_and_check(cmd:list) -> str:
@@ -59,11 +62,11 @@ def test_run_stop_rerun_cleanup():
     _run_and_check(['../src/command_line/main.py', 'run', '--id', game_id, '--register-pass', '1', \
             '--captain-pass', '2', '--files-folder', './new', '--port', '5000'])
     assert('new' in listdir())
-    assert('exit' not in listdir('new'))
+    assert(control.status(game_id) == 'ready')
     c.execute('USE OvO_' + game_id)
     c.execute('SHOW TABLES')
     assert(set(_parse_mysql_vomit(c.fetchall())) == {'users', 'tasks', 'solvings', \
-            'files', 'comments', 'session_data', 'game_info'})
+            'files', 'comments', 'session_data', 'events', 'versions', 'uploads', 'blobs', 'game_info'})
     c.execute('SELECT COUNT(*) FROM users')
     assert(c.fetchone() == (0,))
     c.execute('SELECT COUNT(*) FROM tasks')
@@ -92,9 +95,11 @@ def test_run_stop_rerun_cleanup():
         ))
 
     _run_and_check(['../src/command_line/main.py', 'stop', game_id])
-    assert('exit' in listdir('new'))
-    _run_and_check(['../src/command_line/main.py', 'rerun', '--id', game_id])
-    assert('exit' not in listdir('new'))
+    assert(control.status(game_id) is None)
+    _run_and_check(['../src/command_line/main.py', 'rerun', '--id', game_id, '--workers', '3'])
+    assert(control.status(game_id) == 'ready')
+    c.execute('SELECT workers FROM game_info')
+    assert(c.fetchone() == (3,))
     c.execute('SELECT COUNT(*) FROM users')
     assert(c.fetchone() == (0,))
     c.execute('SELECT COUNT(*) FROM tasks')
@@ -110,8 +115,22 @@ def test_run_stop_rerun_cleanup():
     c.execute('SELECT COUNT(*) FROM game_info')
     assert(c.fetchone() == (1,))
 
-    c.execute('USE mysql') # Must do this, otherwise cleanup will freeze
-    db.close()
+    # Only the game info changes, the running server reloads it in place
+    control_inode = stat(control.socket_path(game_id)).st_ino
+    _run_and_check(['../src/command_line/main.py', 'rerun', '--id', game_id, '--captain-pass', '3', \
+            '--workers', '3'])
+    assert(control.status(game_id) == 'ready')
+    assert(stat(control.socket_path(game_id)).st_ino == control_inode)
+    c.execute('SELECT captain_pass FROM game_info')
+    assert(bcrypt.checkpw(
+        b'3',
+        c.fetchone()[0].encode('utf-8')
+        ))
+
+    # A session left in the game database holds a metadata lock, cleanup must kill it
+    c.execute('START TRANSACTION')
+    c.execute('SELECT COUNT(*) FROM users')
+    c.fetchall()
     _run_and_check(['../src/command_line/main.py', 'cleanup', game_id])
     db = common.get_db_connection()
     c = db.cursor()
@@ -119,6 +138,34 @@ def test_run_stop_rerun_cleanup():
     c.execute('SHOW DATABASES')
     assert('OvO_' + game_id not in _parse_mysql_vomit(c.fetchall()))
 
+def test_provision():
+    game_id = 'TeSTing'
+    db = common.get_db_connection(autocommit=True)
+    c = db.cursor()
+    _run_and_check(['../src/command_line/main.py', 'provision', '1'])
+    c.execute('SHOW DATABASES')
+    spares = [name for name in _parse_mysql_vomit(c.fetchall()) if name.startswith('OvOspare_')]
+    assert(len(spares) == 1)
+
+    _run_and_check(['../src/command_line/main.py', 'run', '--id', game_id, '--register-pass', '1', \
+            '--captain-pass', '2', '--files-folder', './new', '--port', '5000'])
+    c.execute('SHOW DATABASES')
+    assert(spares[0] not in _parse_mysql_vomit(c.fetchall())) # Taken by the game
+    c.execute('USE OvO_' + game_id)
+    c.execute('SHOW TABLES')
+    assert(set(_parse_mysql_vomit(c.fetchall())) == {'users', 'tasks', 'solvings', \
+            'files', 'comments', 'session_data', 'events', 'versions', 'uploads', 'blobs', 'game_info'})
+    c.execute('SELECT COUNT(*) FROM versions')
+    assert(c.fetchone() == (5,))
+    c.execute('SELECT COUNT(*) FROM game_info')
+    assert(c.fetchone() == (1,))
+    _run_and_check(['../src/command_line/main.py', 'cleanup', game_id])
+
+    sleep(3) # The spares replenished in the background
+    _run_and_check(['../src/command_line/main.py', 'provision', '0'])
+    c.execute('SHOW DATABASES')
+    assert(not [name for name in _parse_mysql_vomit(c.fetchall()) if name.startswith('OvOspare_')])
+
 def test_owo():
     game_id = 'TeSTing'
     common.assert_ok_dbname(game_id)
@@ -141,7 +188,22 @@ def test_owo():
         _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'add', 'task', '--text', '*empty*', \
             '--original-link', 'http://google.com', '--name', 'First task'])
         )
-    c.execute('SELECT * FROM tasks')
+    later_tid = json.loads(
+        _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'add', 'task', '--name', 'Later task'])
+        )
+    assert(len(tid) == 32 and tid < later_tid) # The ids are time-ordered
+    _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'rm', 'task', later_tid])
+    with open('tasks.csv', 'w') as f:
+        f.write('name,original-link\nImported 1,http://a.com\nImported 2,\n')
+    imported = json.loads(
+        _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'import', 'tasks', 'tasks.csv'])
+        )
+    remove('tasks.csv')
+    c.execute('SELECT name, original_link FROM tasks WHERE id IN (UNHEX(%s), UNHEX(%s)) ORDER BY id', imported)
+    assert(c.fetchall() == [('Imported 1', 'http://a.com'), ('Imported 2', None)])
+    for imported_tid in imported:
+        _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'rm', 'task', imported_tid])
+    c.execute('SELECT LOWER(HEX(id)), name, is_solved, original_link, original_id, text FROM tasks')
     assert(c.fetchall() == [(tid, 'First task', 'N', 'http://google.com', None, '*empty*')])
     cid1 = json.loads(
         _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'add', 'comment', '--task-id', tid, \
@@ -155,18 +217,19 @@ def test_owo():
         _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'add', 'comment', '--file-id', fid2, \
                 '--text', 'two files', '--user-id', 'user2', '--file-id', fid3, '--task-id', tid])
         )
-    c.execute('SELECT login, is_captain, avatar FROM users')
+    c.execute('SELECT login, is_captain, LOWER(HEX(avatar)) FROM users')
     assert(set(c.fetchall()) == {('user1', 'N', None), ('user2', 'Y', fid0)})
     c.execute('SELECT password FROM users')
     assert(bcrypt.checkpw(b'abcde', c.fetchone()[0].encode('utf-8')))
     assert(bcrypt.checkpw(b'edcba', c.fetchone()[0].encode('utf-8')))
-    c.execute('SELECT * FROM tasks')
+    c.execute('SELECT LOWER(HEX(id)), name, is_solved, original_link, original_id, text FROM tasks')
     assert(set(c.fetchall()) == {(tid, 'First task', 'N', 'http://google.com', None, '*empty*')})
-    c.execute('SELECT * FROM solvings')
+    c.execute('SELECT u.login, LOWER(HEX(s.task_id)) FROM solvings s JOIN users u ON u.id = s.user_id')
     assert(set(c.fetchall()) == set())
-    c.execute('SELECT * FROM files')
+    c.execute('SELECT LOWER(HEX(id)), name FROM files')
     assert(set(c.fetchall()) == {(fid0, 'user2 avatar'), (fid1, '1'), (fid2, '2'), (fid3, '3')})
-    c.execute('SELECT * FROM comments')
+    c.execute('SELECT LOWER(HEX(cm.id)), LOWER(HEX(cm.task_id)), u.login, cm.text, cm.attached_files_ids \
+            FROM comments cm JOIN users u ON u.id = cm.user_id')
     assert(set(c.fetchall()) == {(cid1, tid, 'user1', '*empty*', json.dumps([])),
         (cid2, tid, 'user1', 'one file', json.dumps([fid1])),
         (cid3, tid, 'user2', 'two files', json.dumps([fid2, fid3]))
@@ -186,21 +249,33 @@ def test_owo():
     assert(c.fetchall() == [('Y',)])
 
     _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'update_avatar', 'user1', fid2])
-    c.execute('SELECT avatar FROM users ORDER BY login')
+    c.execute('SELECT LOWER(HEX(avatar)) FROM users ORDER BY login')
     assert(set(_parse_mysql_vomit(c.fetchall())) == {fid0, fid2})
 
     _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'take_task', '--user-id', 'user1', \
             '--task-id', tid])
-    c.execute('SELECT * FROM solvings')
+    c.execute('SELECT u.login, LOWER(HEX(s.task_id)) FROM solvings s JOIN users u ON u.id = s.user_id')
     assert(set(c.fetchall()) == {('user1', tid)})
     _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'take_task', '--task-id', tid, \
             '--user-id', 'user2'])
-    c.execute('SELECT * FROM solvings')
+    c.execute('SELECT u.login, LOWER(HEX(s.task_id)) FROM solvings s JOIN users u ON u.id = s.user_id')
     assert(set(c.fetchall()) == {('user1', tid), ('user2', tid)})
     _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'reject_task', '--task-id', tid, \
             '--user-id', 'user1'])
-    c.execute('SELECT * FROM solvings')
+    c.execute('SELECT u.login, LOWER(HEX(s.task_id)) FROM solvings s JOIN users u ON u.id = s.user_id')
     assert(set(c.fetchall()) == {('user2', tid)})
+    c.execute("SELECT type, data FROM events WHERE type IN ('task_taken', 'task_rejected') ORDER BY id")
+    assert(c.fetchall() == [('task_taken', json.dumps({'task_id': tid, 'user_id': 'user1'})),
+        ('task_taken', json.dumps({'task_id': tid, 'user_id': 'user2'})),
+        ('task_rejected', json.dumps({'task_id': tid, 'user_id': 'user1'}))])
+    c.execute('SELECT COUNT(*), MAX(id) FROM events')
+    events_count, last_event = c.fetchone()
+    assert(json.loads(_run_and_check(['../src/command_line/main.py', 'owo', game_id, \
+            'compact_events', '2'])) == events_count - 2)
+    c.execute('SELECT id FROM events')
+    assert(sorted(i for i, in c.fetchall()) == [last_event - 1, last_event])
+    c.execute('SELECT events_compacted FROM game_info')
+    assert(c.fetchone() == (last_event - 2,))
 
     for entity, entity_id in zip(['user', 'comment', 'task', 'file'], ['user2', cid3, tid, fid0]):
         query = 'SELECT COUNT(*) FROM {}s'.format(entity)
@@ -220,11 +295,12 @@ def test_owo():
     db.close()
     _run_and_check(['../src/command_line/main.py', 'cleanup', game_id])
 
-def test_web_api():
+def test_web_api(engine='sync'):
     game_id = 'TeSTing'
-    host = 'http://localhost:5000'
+    host = 'http://localhost:8000/g/' + game_id if engine == 'hosted' else 'http://localhost:5000'
     _run_and_check(['../src/command_line/main.py', 'run', '--id', 'TeSTing', '--register-pass', '1', \
-            '--captain-pass', '1', '--files-folder', './new', '--port', '5000'])
+            '--captain-pass', '1', '--files-folder', './new', '--port', '5000', '--workers', '2', \
+            '--engine', engine])
     r = requests.post(host + '/api/add_user', data={'login': 'user1', 'password': 'abcde', \
             'register_pass': '1'})
     assert(r.status_code == 200)
@@ -252,6 +328,13 @@ def test_web_api():
     assert(len(r.json()) == 1)
     assert(r.json()[0] == {'id': tid, 'name': 'First task', 'is_solved': False, 'original_link': \
             'http://google.com', 'original_id': None, 'text': '*empty*', 'solvers': []})
+    r = requests.get(host + '/api/get_tasks', params={'ids': tid + ',unknown'}, cookies=cookies1)
+    assert(r.status_code == 200)
+    assert([t['id'] for t in r.json()] == [tid])
+    r = requests.get(host + '/api/get_task_info/unknown', cookies=cookies1)
+    assert(r.status_code == 400)
+    r = requests.get(host + '/api/get_task_info/' + '0' * 32, cookies=cookies1)
+    assert(r.status_code == 404)
     r = requests.post(host + '/api/add_comment', data={'task_id': tid, 'text': '*empty*'}, \
             cookies=cookies1)
     assert(r.status_code == 200)
@@ -288,12 +371,68 @@ def test_web_api():
         r = requests.get(host + '/api/download_file/' + file_info['id'], cookies=cookies1)
         assert(r.status_code == 200)
         assert(r.content == raw)
+        assert('immutable' in r.headers['Cache-Control'])
+        r = requests.get(host + '/api/get_file/' + file_info['id'], cookies=cookies1, \
+                headers={'If-None-Match': r.headers['ETag']})
+        assert(r.status_code == 304)
+        r = requests.get(host + '/api/get_file/' + file_info['id'], cookies=cookies1, \
+                headers={'Range': 'bytes=10-19'})
+        assert(r.status_code == 206)
+        assert(r.content == raw[10:20])
     r = requests.get(host + '/api/get_comments', cookies=cookies2)
     assert(r.status_code == 200)
     assert(dsorted(r.json()) == dsorted([{'id': cid1, 'task_id': tid, 'user_id': 'user1', \
             'text': '*empty*', 'attached_files': []}, {'id': cid2, 'task_id': tid, 'user_id': 'user1', \
             'text': 'one file', 'attached_files': [fid1]}, {'id': cid3, 'task_id': tid, 'user_id': 'user2', \
             'text': 'two files', 'attached_files': [fid2, fid3]}]))
+    r = requests.get(host + '/api/get_comments', params={'task_id': tid, 'limit': 2}, cookies=cookies1)
+    assert(r.status_code == 200)
+    assert([i['id'] for i in r.json()] == [cid1, cid2])
+    r = requests.get(host + '/api/get_comments', params={'task_id': tid, 'limit': 2, \
+            'cursor': r.headers['X-Next-Cursor']}, cookies=cookies1)
+    assert(r.status_code == 200)
+    assert([i['id'] for i in r.json()] == [cid3])
+    assert('X-Next-Cursor' not in r.headers)
+    r = requests.get(host + '/api/get_comments', params={'cursor': 'garbage'}, cookies=cookies1)
+    assert(r.status_code == 400)
+    r = requests.get(host + '/api/events', cookies=cookies1, stream=True, timeout=10, \
+            headers={'Last-Event-ID': '0'})
+    assert(r.status_code == 200)
+    events = []
+    for line in r.iter_lines(decode_unicode=True):
+        if line.startswith('event: '):
+            events.append(line[len('event: '):])
+        if len(events) == 9:
+            break
+    r.close()
+    assert(events == ['user_added', 'file_added', 'user_added'] + ['file_added'] * 3 + \
+            ['task_added'] + ['comment_added'] * 2)
+    r = requests.get(host + '/api/events', cookies=cookies1, headers={'Last-Event-ID': 'x'})
+    assert(r.status_code == 400)
+    r = requests.get(host + '/api/changes', params={'since': 0}, cookies=cookies1)
+    assert(r.status_code == 200)
+    changes = r.json()
+    assert(not changes['resync'])
+    assert([i['type'] for i in changes['changes'][:9]] == events)
+    assert(changes['changes'][0]['data'] == {'login': 'user1', 'is_captain': False, 'avatar': None})
+    r = requests.get(host + '/api/changes', params={'since': changes['last']}, cookies=cookies1)
+    assert(r.status_code == 200)
+    assert(all(i['seq'] > changes['last'] for i in r.json()['changes']))
+    # `since` given by a worker which has read an event the others haven't read yet
+    _run_and_check(['../src/command_line/main.py', 'owo', game_id, 'add', 'task', '--name', 'Second task'])
+    db = common.get_db_connection(autocommit=True)
+    c = db.cursor()
+    c.execute('SELECT MAX(id) FROM OvO_{}.events'.format(game_id))
+    newest, = c.fetchone()
+    r = requests.get(host + '/api/changes', params={'since': newest}, cookies=cookies1)
+    assert(r.status_code == 200)
+    assert(not r.json()['resync'])
+    assert(r.json()['last'] >= newest)
+    r = requests.get(host + '/api/changes', params={'since': 10 ** 9}, cookies=cookies1)
+    assert(r.status_code == 200)
+    assert(r.json()['resync'])
+    r = requests.get(host + '/api/changes', cookies=cookies1)
+    assert(r.status_code == 400)
     r = requests.post(host + '/api/mark_user', data={'login': 'user1', 'new_type': 'default'}, \
             cookies=cookies2)
     assert(r.status_code == 200)
@@ -306,6 +445,10 @@ def test_web_api():
     r = requests.post(host + '/api/mark_user', data={'login': 'user2', 'new_type': 'default'}, \
             cookies=cookies2)
     assert(r.status_code == 200)
+    sleep(2) # Every worker drops the cached principal when it sees the event
+    r = requests.post(host + '/api/mark_user', data={'login': 'user1', 'new_type': 'default'}, \
+            cookies=cookies2)
+    assert(r.status_code == 403)
     r = requests.get(host + '/api/get_user_info/user1', cookies=cookies2)
     assert(r.status_code == 200)
     assert(r.json()['is_captain'])
@@ -321,11 +464,22 @@ def test_web_api():
     r = requests.get(host + '/api/get_task_info/' + tid, cookies=cookies1)
     assert(r.status_code == 200)
     assert(r.json()['is_solved'])
+    etag = r.headers['ETag']
+    r = requests.get(host + '/api/get_task_info/' + tid, cookies=cookies2, \
+            headers={'If-None-Match': etag})
+    assert(r.status_code == 304)
+    assert(r.headers['ETag'] == etag)
     r = requests.post(host + '/api/update_avatar', data={'avatar': fid2}, cookies=cookies1)
     assert(r.status_code == 200)
     r = requests.get(host + '/api/get_user_info/user1', cookies=cookies2)
     assert(r.status_code == 200)
     assert(r.json()['avatar'] == fid2)
+    r = requests.get(host + '/api/get_comment_info/unknown', cookies=cookies1)
+    assert(r.status_code == 400)
+    r = requests.get(host + '/api/get_comment_info/' + '0' * 32, cookies=cookies1)
+    assert(r.status_code == 404)
+    r = requests.post(host + '/api/rm_comment', data={'id': '0' * 32}, cookies=cookies1)
+    assert(r.status_code == 404)
     r = requests.get(host + '/api/get_comment_info/' + cid1, cookies=cookies1)
     assert(r.status_code == 200)
     assert(r.json() == {'id': cid1, 'task_id': tid, 'user_id': 'user1', 'text': '*empty*', \
@@ -333,8 +487,10 @@ def test_web_api():
     r = requests.post(host + '/api/take_task', data={'user_id': 'user1', 'task_id': tid}, \
             cookies=cookies1)
     assert(r.status_code == 200)
-    r = requests.get(host + '/api/get_task_info/' + tid, cookies=cookies2)
+    r = requests.get(host + '/api/get_task_info/' + tid, cookies=cookies2, \
+            headers={'If-None-Match': etag})
     assert(r.status_code == 200)
+    assert(r.headers['ETag'] != etag)
     assert(r.json()['solvers'] == ['user1'])
     r = requests.post(host + '/api/take_task', data={'user_id': 'user2', 'task_id': tid}, \
             cookies=cookies2)
@@ -353,12 +509,91 @@ def test_web_api():
     assert(r.status_code == 200)
     assert(len(r.json()) == 2)
     assert(all(i['id'] in [cid1, cid2] for i in r.json()))
+    raw = open(__file__, 'rb').read()
+    half = len(raw) // 2
+    r = requests.post(host + '/api/create_upload', data={'name': 'chunked', 'size': len(raw)}, \
+            cookies=cookies1)
+    assert(r.status_code == 200)
+    assert(r.json()['received'] == 0)
+    uid = r.json()['id']
+    r = requests.put(host + '/api/upload/' + uid, data=raw[:half], cookies=cookies1, \
+            headers={'Content-Range': 'bytes 0-{}/{}'.format(half - 1, len(raw))})
+    assert(r.status_code == 200)
+    assert(r.json() == {'received': half})
+    r = requests.put(host + '/api/upload/' + uid, data=raw[:half], cookies=cookies1, \
+            headers={'Content-Range': 'bytes 0-{}/{}'.format(half - 1, len(raw))})
+    assert(r.status_code == 409)
+    assert(r.json() == {'received': half})
+    r = requests.post(host + '/api/finish_upload', data={'id': uid}, cookies=cookies1)
+    assert(r.status_code == 409)
+    r = requests.get(host + '/api/upload/' + uid, cookies=cookies2)
+    assert(r.status_code == 200)
+    assert(r.json() == {'name': 'chunked', 'size': len(raw), 'received': half, 'sha256': None})
+    r = requests.put(host + '/api/upload/' + uid, data=raw[half:], cookies=cookies1, \
+            headers={'Content-Range': 'bytes {}-{}/{}'.format(half, len(raw) - 1, len(raw))})
+    assert(r.status_code == 200)
+    r = requests.post(host + '/api/finish_upload', data={'id': uid, 'sha256': '0' * 64}, cookies=cookies1)
+    assert(r.status_code == 400)
+    r = requests.post(host + '/api/finish_upload', data={'id': uid, \
+            'sha256': hashlib.sha256(raw).hexdigest()}, cookies=cookies1)
+    assert(r.status_code == 200)
+    fid4 = r.json()['id']
+    r = requests.get(host + '/api/get_file/' + fid4, cookies=cookies2)
+    assert(r.status_code == 200)
+    assert(r.content == raw)
+    r = requests.get(host + '/api/upload/' + uid, cookies=cookies2)
+    assert(r.status_code == 404)
+    # The same content is known, so nothing is uploaded
+    r = requests.post(host + '/api/create_upload', data={'name': 'same', 'size': len(raw), \
+            'sha256': hashlib.sha256(raw).hexdigest()}, cookies=cookies2)
+    assert(r.status_code == 200)
+    assert(r.json()['received'] == len(raw))
+    uid = r.json()['id']
+    r = requests.put(host + '/api/upload/' + uid, data=raw[:half], cookies=cookies2, \
+            headers={'Content-Range': 'bytes 0-{}/{}'.format(half - 1, len(raw))})
+    assert(r.status_code == 409)
+    assert(r.json() == {'received': len(raw)})
+    r = requests.post(host + '/api/finish_upload', data={'id': uid}, cookies=cookies2)
+    assert(r.status_code == 200)
+    fid5 = r.json()['id']
+    assert(fid5 != fid4)
+    r = requests.get(host + '/api/get_file/' + fid5, cookies=cookies1)
+    assert(r.status_code == 200)
+    assert(r.content == raw)
     _run_and_check(['../src/command_line/main.py', 'cleanup', game_id])
 
+def test_web_api_async():
+    test_web_api(engine='async')
+
+def test_web_api_hosted():
+    test_web_api(engine='hosted')
+    assert(control.status(None) == 'ready')
+    r = requests.get('http://localhost:8000/g/TeSTing/api/get_tasks')
+    assert(r.status_code == 404)
+    _run_and_check(['../src/command_line/main.py', 'stop', '--host'])
+    assert(control.status(None) is None)
+
+STARTUP_BUDGET_MS = 150
+
+def test_startup():
+    for cmd in [['stop', '--help'], ['cleanup', '--help'], ['owo', '--help'], ['run', '--help'], \
+            ['provision', '--help']]:
+        p = run([executable, '-X', 'importtime', '../src/command_line/main.py'] + cmd, \
+                stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        assert(p.returncode == 0)
+        imports = ovo_main.parse_importtime(p.stderr)
+        names = set(map(lambda x: x[0], imports))
+        assert(not names & {'mysql', 'mysql.connector', 'bcrypt', 'getpass', 'subprocess', 'flask'})
+        assert(sum(i[2] for i in imports if i[3] == 0) < STARTUP_BUDGET_MS * 1000)
+
 if __name__ == "__main__":
     ts = TestStation()
+    ts.add_test(test_startup)
     ts.add_test(test_run_stop_rerun_cleanup)
+    ts.add_test(test_provision)
     ts.add_test(test_owo)
     ts.add_test(test_web_api)
+    ts.add_test(test_web_api_async)
+    ts.add_test(test_web_api_hosted)
     ts.run_tests()
     exit(0)